@@ -0,0 +1,175 @@
+"""CPU cost against bandwidth saved by websocket compression settings.
+
+Replays terminal output traces through tornado's permessage-deflate
+compressor, one websocket message per output frame as TermSocket sends
+them, and reports the compression ratio and CPU time per megabyte for each
+setting, plus what that means for a class of students::
+
+    python bench_compression.py
+    python bench_compression.py --trace session.cast --students 100 --rate 20
+
+Without --trace, synthetic traces modelled on compiler output, progress
+bars, an htop-like full-screen program and coloured ls listings are used.
+A trace is either raw terminal output (split into 4096 byte frames) or an
+asciicast v2 recording, whose output events are used as the frames.
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+import itertools
+import json
+import random
+import time
+
+from tornado.websocket import _PerMessageDeflateCompressor
+
+FRAME_OVERHEAD = 4          # websocket frame header for a typical message
+
+
+def compiler_trace(rng, frames=3000):
+    for i in range(frames):
+        lines = []
+        for _ in range(rng.randint(1, 4)):
+            lines.append(
+                '\x1b[1msrc/module%d.c:%d:%d: \x1b[35mwarning: \x1b[0m'
+                'unused variable \x1b[1m\'tmp%d\'\x1b[0m '
+                '[\x1b[35m-Wunused-variable\x1b[0m]\r\n'
+                '  %4d |     int tmp%d = 0;\r\n'
+                '      |         \x1b[32m^~~~~\x1b[0m\r\n' % (
+                    rng.randint(1, 40), rng.randint(1, 2000),
+                    rng.randint(1, 80), i, rng.randint(1, 2000), i))
+        yield ''.join(lines)
+
+
+def progress_trace(rng, frames=5000):
+    for i in range(frames):
+        done = i * 40 // frames
+        yield ('\r\x1b[K\x1b[32m[%s%s]\x1b[0m %3d%% %5.1f MB/s eta 0:%02d' % (
+            '#' * done, '.' * (40 - done), i * 100 // frames,
+            rng.uniform(5, 50), rng.randint(0, 59)))
+
+
+def htop_trace(rng, frames=300, rows=24, cols=80):
+    for _ in range(frames):
+        out = ['\x1b[?25l']
+        for cpu in range(4):
+            used = rng.randint(0, 30)
+            out.append('\x1b[%d;1H  %d\x1b[1m[\x1b[32m%s\x1b[31m%s\x1b[0m%s'
+                       '\x1b[1m%5.1f%%]\x1b[0m' % (
+                           cpu + 1, cpu, '|' * (used // 2),
+                           '|' * (used - used // 2), ' ' * (30 - used),
+                           rng.uniform(0, 100)))
+        for row in range(6, rows):
+            out.append('\x1b[%d;1H%6d student  20   0 %7dM %6dM S %5.1f %4.1f '
+                       '%2d:%02d.%02d \x1b[36mpython3\x1b[0m main.py\x1b[K' % (
+                           row + 1, rng.randint(100, 99999),
+                           rng.randint(10, 9000), rng.randint(1, 900),
+                           rng.uniform(0, 100), rng.uniform(0, 20),
+                           rng.randint(0, 59), rng.randint(0, 59),
+                           rng.randint(0, 99)))
+        out.append('\x1b[%d;%dH\x1b[?25h' % (rows, cols))
+        yield ''.join(out)
+
+
+def ls_trace(rng, frames=1000):
+    colors = ['\x1b[01;34m', '\x1b[01;32m', '\x1b[0m', '\x1b[01;36m']
+    for _ in range(frames):
+        yield ''.join(
+            '-rw-r--r-- 1 student student %8d Oct %2d %02d:%02d %sfile_%05d.txt'
+            '\x1b[0m\r\n' % (rng.randint(0, 10 ** 6), rng.randint(1, 31),
+                             rng.randint(0, 23), rng.randint(0, 59),
+                             rng.choice(colors), rng.randint(0, 99999))
+            for _ in range(rng.randint(1, 20)))
+
+
+SYNTHETIC_TRACES = {
+    'compiler': compiler_trace,
+    'progress': progress_trace,
+    'htop': htop_trace,
+    'ls': ls_trace,
+}
+
+
+def load_trace(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if path.endswith('.cast'):
+        frames = []
+        for line in data.decode('utf-8').splitlines()[1:]:
+            event = json.loads(line)
+            if event[1] == 'o':
+                frames.append(event[2].encode('utf-8'))
+        return frames
+    return [data[i:i + 4096] for i in range(0, len(data), 4096)]
+
+
+def measure(frames, level, mem_level, wbits, takeover, min_size):
+    compressor = _PerMessageDeflateCompressor(
+        takeover, wbits,
+        {'compression_level': level, 'mem_level': mem_level})
+    raw = wire = 0
+    start = time.process_time()
+    for frame in frames:
+        raw += len(frame) + FRAME_OVERHEAD
+        if len(frame) < min_size:
+            wire += len(frame) + FRAME_OVERHEAD
+        else:
+            wire += len(compressor.compress(frame)) + FRAME_OVERHEAD
+    cpu = time.process_time() - start
+    return raw, wire, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--trace", action="append", default=[],
+                        help="Raw output or .cast file to replay (repeatable)")
+    parser.add_argument("--students", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=10.0,
+                        help="Average output per student, KB/s")
+    parser.add_argument("--json", action="store_true",
+                        help="Wrap frames as JSON stdout messages instead of "
+                             "the binary subprotocol")
+    parser.add_argument("--levels", default="0,1,3,6,9")
+    parser.add_argument("--window-bits", default="15,12,9")
+    parser.add_argument("--mem-level", type=int, default=8)
+    parser.add_argument("--min-size", type=int, default=32)
+    args = parser.parse_args()
+
+    if args.trace:
+        traces = {path: load_trace(path) for path in args.trace}
+    else:
+        traces = {name: [frame.encode('utf-8')
+                         for frame in make(random.Random(42))]
+                  for name, make in SYNTHETIC_TRACES.items()}
+
+    levels = [int(x) for x in args.levels.split(',')]
+    wbits_choices = [int(x) for x in args.window_bits.split(',')]
+    for name, frames in traces.items():
+        if args.json:
+            frames = [json.dumps(['stdout', f.decode('utf-8', 'replace')])
+                      .encode('utf-8') for f in frames]
+        else:
+            frames = [b'\x01' + f for f in frames]
+        total = sum(len(f) for f in frames)
+        print("\n%s: %d frames, %.1f KB, mean frame %d bytes" % (
+            name, len(frames), total / 1e3, total // len(frames)))
+        print("%5s %5s %8s %8s %6s %9s %11s %9s" % (
+            "level", "wbits", "takeover", "min_size", "ratio", "cpu s/MB",
+            "uplink Mb/s", "cpu %core"))
+        for level, wbits, takeover, min_size in itertools.product(
+                levels, wbits_choices, (True, False), (0, args.min_size)):
+            raw, wire, cpu = measure(frames, level, args.mem_level, wbits,
+                                     takeover, min_size)
+            # The class-wide figures scale the trace to the chosen rate
+            class_raw = args.students * args.rate * 1e3
+            uplink = class_raw * wire / raw * 8 / 1e6
+            cpu_share = class_raw * cpu / raw * 100
+            print("%5d %5d %8s %8d %6.2f %9.4f %11.2f %9.1f" % (
+                level, wbits, takeover, min_size, raw / wire,
+                cpu / raw * 1e6, uplink, cpu_share))
+        print("uncompressed uplink: %.2f Mb/s" % (
+            args.students * args.rate * 8 / 1e3))
+
+
+if __name__ == "__main__":
+    main()
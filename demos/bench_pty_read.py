@@ -0,0 +1,72 @@
+"""Event loop latency with many noisy terminals.
+
+Starts N terminals that print compiler-like output as fast as they can, and
+measures how late a periodic 10ms timer fires on the IOLoop while they run.
+Run it once per reader mode to compare::
+
+    python bench_pty_read.py --terminals 100
+    python bench_pty_read.py --terminals 100 --blocking
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+import asyncio
+import time
+
+from tornado.ioloop import IOLoop
+
+from terminado import NamedTermManager
+
+NOISY_COMMAND = ['sh', '-c', 'while :; do echo "main.c:42:13: warning: '
+                 'unused variable \\"x\\" [-Wunused-variable]"; done']
+TICK = 0.01
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+async def run(args):
+    term_manager = NamedTermManager(shell_command=NOISY_COMMAND,
+                                    nonblocking_read=not args.blocking)
+    if args.max_read_size:
+        term_manager.max_read_size = args.max_read_size
+    terminals = [term_manager.new_named_terminal()[1]
+                 for _ in range(args.terminals)]
+
+    lateness = []
+    end = time.monotonic() + args.duration
+    while time.monotonic() < end:
+        expected = time.monotonic() + TICK
+        await asyncio.sleep(TICK)
+        lateness.append(time.monotonic() - expected)
+    # Nobody is attached, so everything read went to the preopen buffers.
+    drained = sum(term.preopen_buffer.size + term.preopen_buffer.dropped_bytes
+                  for term in terminals)
+
+    await term_manager.kill_all()
+
+    ms = [x * 1000 for x in lateness]
+    print("mode=%s terminals=%d max_read_size=%d ticks=%d" % (
+        "blocking" if args.blocking else "nonblocking", args.terminals,
+        term_manager.max_read_size, len(ms)))
+    print("loop latency ms: p50=%.2f p99=%.2f max=%.2f" % (
+        percentile(ms, 50), percentile(ms, 99), max(ms)))
+    print("throughput: %.1f MB/s" % (drained / args.duration / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--terminals", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--blocking", action="store_true",
+                        help="Use the legacy poll()+blocking read path")
+    parser.add_argument("--max-read-size", type=int, default=0,
+                        help="Per-wakeup read budget in non-blocking mode")
+    args = parser.parse_args()
+    IOLoop.current().run_sync(lambda: run(args))
+
+
+if __name__ == "__main__":
+    main()
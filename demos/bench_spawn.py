@@ -0,0 +1,138 @@
+"""Output latency of running terminals while new ones are being started.
+
+A few terminals run ``cat``; every few milliseconds a timestamp is typed
+into one of them and the time until it is echoed back is recorded. This is
+measured with nothing else going on, and then during a burst of terminal
+starts, made with new_named_terminal() on the event loop and with
+new_named_terminal_async() on a thread::
+
+    python bench_spawn.py
+    python bench_spawn.py --burst 50 --shell bash
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from tornado.ioloop import IOLoop
+
+from terminado import NamedTermManager
+
+
+class EchoProbe(object):
+    """A client that times how long typed markers take to come back."""
+    binary = True
+    size = (None, None)
+    saturated = False
+
+    def __init__(self, term):
+        self.term = term
+        self.received = b''
+        self.sent = {}
+        self.latencies = []
+        term.clients.append(self)
+
+    def ping(self, n):
+        marker = b'<%d>' % n
+        self.sent[marker] = time.perf_counter()
+        self.term.write(marker + b'\n')
+
+    def on_pty_output(self, output):
+        self.received += output.data
+        for marker in [m for m in self.sent if m in self.received]:
+            self.latencies.append(time.perf_counter() - self.sent.pop(marker))
+        self.received = self.received[-64:]
+
+    def on_pty_died(self):
+        pass
+
+
+async def measure(probes, duration, interval, burst=None):
+    for probe in probes:
+        probe.latencies = []
+    task = asyncio.ensure_future(burst()) if burst else None
+    deadline = time.perf_counter() + duration
+    n = 0
+    while time.perf_counter() < deadline or (task and not task.done()):
+        for probe in probes:
+            n += 1
+            probe.ping(n)
+        await asyncio.sleep(interval)
+    # Let the last echoes arrive
+    await asyncio.sleep(0.1)
+    if task:
+        await task
+    return sorted(l for probe in probes for l in probe.latencies)
+
+
+def report(label, latencies, elapsed=None):
+    ms = [l * 1e3 for l in latencies]
+    print("%-14s %6d %8.2f %8.2f %8.2f %10s" % (
+        label, len(ms), statistics.median(ms),
+        ms[int(len(ms) * 0.99) - 1], ms[-1],
+        '%.2f' % elapsed if elapsed is not None else '-'))
+
+
+async def run(args):
+    tm = NamedTermManager(shell_command=['cat'])
+    probes = []
+    for i in range(args.probes):
+        name, term = tm.new_named_terminal()
+        probes.append(EchoProbe(term))
+    shell = args.shell.split()
+    spawned = []
+
+    async def sync_burst():
+        start = time.perf_counter()
+        for i in range(args.burst):
+            spawned.append(tm.new_named_terminal(shell_command=shell)[1])
+            # Give the loop a turn between requests, as separate HTTP
+            # requests would
+            await asyncio.sleep(0)
+        timings['sync'] = time.perf_counter() - start
+
+    async def async_burst():
+        start = time.perf_counter()
+        results = await asyncio.gather(*(
+            tm.new_named_terminal_async(shell_command=shell)
+            for i in range(args.burst)))
+        spawned.extend(term for name, term in results)
+        timings['async'] = time.perf_counter() - start
+
+    timings = {}
+    print("%-14s %6s %8s %8s %8s %10s" % (
+        "", "echoes", "p50 ms", "p99 ms", "max ms", "burst s"))
+    try:
+        report("idle", await measure(probes, args.duration, args.interval))
+        for label, burst in (('sync', sync_burst), ('async', async_burst)):
+            latencies = await measure(probes, args.duration, args.interval,
+                                      burst)
+            report(label, latencies, timings[label])
+            await asyncio.gather(*(term.terminate(force=True)
+                                   for term in spawned))
+            spawned.clear()
+            # Let the EOFs be processed before the next round
+            await asyncio.sleep(0.5)
+    finally:
+        await tm.kill_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--probes", type=int, default=4,
+                        help="Running terminals to measure")
+    parser.add_argument("--burst", type=int, default=30,
+                        help="Terminals to start in each burst")
+    parser.add_argument("--shell", default="sh",
+                        help="Command the new terminals run")
+    parser.add_argument("--duration", type=float, default=1.0)
+    parser.add_argument("--interval", type=float, default=0.005,
+                        help="Seconds between probe echoes")
+    args = parser.parse_args()
+    IOLoop.current().run_sync(lambda: run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -14,5 +14,6 @@ def run_and_show_browser(url, term_manager):
     except KeyboardInterrupt:
         print(" Shutting down on SIGINT")
     finally:
-        term_manager.shutdown()
+        if term_manager is not None:
+            loop.run_sync(term_manager.shutdown)
         loop.close()
\ No newline at end of file
@@ -1,12 +1,39 @@
+import atexit
 import json
+import logging
 import os
+import tempfile
+import threading
 
 
 class JSONDatabase():
-    def __init__(self, path_to_json_file):
+    """User data kept in memory and saved to a JSON file.
+
+    By default every change rewrites the file before returning. With
+    ``flush_interval`` set (in seconds), changes only mark the data dirty
+    and a background thread saves it at most that often, so a burst of
+    logins costs one write. Call :meth:`close` on shutdown to save anything
+    still pending; it is also registered to run at exit. The thread isn't
+    copied into a forked child, so create the database after forking.
+    """
+
+    def __init__(self, path_to_json_file, flush_interval=None):
         self.path_to_json_file = path_to_json_file
         self.data = None
+        self.flush_interval = flush_interval
+        # Guards self.data against the writer thread serialising it mid-change
+        self._lock = threading.RLock()
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._closed = False
+        self._writer = None
         self.pull()
+        if flush_interval is not None:
+            self._writer = threading.Thread(target=self._write_behind,
+                                            name="JSONDatabase writer",
+                                            daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
 
     def get_data(self):
         if not os.path.isfile(self.path_to_json_file):
@@ -21,10 +48,56 @@ class JSONDatabase():
         self.data = self.get_data()
 
     def push(self):
-        if not os.path.exists(os.path.dirname(self.path_to_json_file)):
-            os.makedirs(os.path.dirname(self.path_to_json_file), exist_ok=True)
-        with open(self.path_to_json_file, "w") as write_file:
-            json.dump(self.data, write_file)
+        if self._writer is not None and not self._closed:
+            self._dirty.set()
+            return
+        self.flush()
+
+    def flush(self):
+        """Write the data to disk now.
+
+        The file is replaced atomically, so a crash mid-write leaves the
+        previous version in place.
+        """
+        with self._lock:
+            self._dirty.clear()
+            serialized = json.dumps(self.data)
+        directory = os.path.dirname(self.path_to_json_file)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as write_file:
+                write_file.write(serialized)
+            os.replace(tmp_path, self.path_to_json_file)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _write_behind(self):
+        while not self._stop.is_set():
+            self._dirty.wait()
+            # Let more changes pile up before writing them all at once
+            if self._stop.wait(self.flush_interval):
+                return
+            try:
+                self.flush()
+            except OSError:
+                logging.getLogger(__name__).exception(
+                    "Saving %s failed; will retry", self.path_to_json_file)
+                self._dirty.set()
+
+    def close(self):
+        """Stop the background writer and save any pending changes."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer is not None:
+            self._stop.set()
+            self._dirty.set()
+            self._writer.join()
+            atexit.unregister(self.close)
+        self.flush()
 
     def check_username(self, username):
         if username in self.data.keys():
@@ -47,12 +120,13 @@ class JSONDatabase():
         return user_data.get('remember', None)
 
     def set_user_data(self, username, key, value):
-        if not self.check_username(username):
-            self.data[username] = {key: value}
-        else:
-            user_data = self.data.get(username)
-            user_data[key] = value
-            self.data[username] = user_data
+        with self._lock:
+            if not self.check_username(username):
+                self.data[username] = {key: value}
+            else:
+                user_data = self.data.get(username)
+                user_data[key] = value
+                self.data[username] = user_data
 
     def save_remember(self, username, remember):
         remember_bool = True if remember == 'on' else False
@@ -61,4 +135,4 @@ class JSONDatabase():
 
     def save_username_password(self, username, password):
         self.set_user_data(username, 'psw', password)
-        self.push()
\ No newline at end of file
+        self.push()
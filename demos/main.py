@@ -8,11 +8,19 @@ import tornado.web
 # This demo requires tornado_xstatic and XStatic-term.js
 import tornado_xstatic
 from database import JSONDatabase
+import sharding
 import argparse
+import asyncio
+import os
 import pathlib
+import subprocess
+import tempfile
+import uuid
 
 import terminado
-from terminado import TermSocket, NamedTermManager
+from terminado import (TermSocket, TermEventSocket, TermMuxSocket, TermScreensHandler,
+                       TermSessionsHandler, TermRecordingHandler, TermSearchHandler,
+                       NamedTermManager, TmuxTermManager, AuditLog, OutputIndex)
 from common_demo_stuff import run_and_show_browser, STATIC_DIR, TEMPLATE_DIR
 
 
@@ -21,15 +29,43 @@ parser.add_argument("-p", "--password", dest="admin_password", required=True, ty
                     help="Password for user 'admin' to access admin pane")
 parser.add_argument("-d", "--database", dest="db_json_path", default=None, type=str,
                     help="Path to json file, where will be info about usernanes and passwords. Default: data dir in project folder")
+parser.add_argument("-w", "--workers", dest="workers", default=0, type=int,
+                    help="Serve student terminals from this many worker processes, sharded by name. Default: 0, all in one process")
+parser.add_argument("--tmux-control", dest="tmux_control", action="store_true",
+                    help="Run student shells as windows of one tmux server, driven over a single control mode connection, "
+                         "instead of a pty and tmux client each")
+parser.add_argument("--pool", dest="pool_size", default=0, type=int,
+                    help="Keep this many student shells started ahead of logins (per worker). Default: 0")
+parser.add_argument("--audit-dir", dest="audit_dir", default=None, type=str,
+                    help="Record the commands students type in a file per student in this directory")
+parser.add_argument("--audit-output", dest="audit_output", action="store_true",
+                    help="Record what students' terminals print as well")
+parser.add_argument("--record-dir", dest="record_dir", default=None, type=str,
+                    help="Record students' sessions as asciicasts in this directory, to replay from /_recordings/")
+parser.add_argument("--search", dest="search", action="store_true",
+                    help="Index students' terminal output for the last hour, to search at /_search?q=words")
 args = parser.parse_args()
+if args.tmux_control and args.workers:
+    parser.error("--tmux-control can't be combined with --workers")
+if args.search and args.workers:
+    parser.error("--search can't be combined with --workers")
 if args.db_json_path is None:
     path_to_db = pathlib.Path(terminado.__file__).parents[2] / 'data' / 'database.json'
 else:
     path_to_db = pathlib.Path(args.db_json_path)
 
-DATABASE = JSONDatabase(path_to_db)
-DATABASE.save_username_password("admin", args.admin_password)
-ws_pathes = {}
+# Opened by main(), in the front process only; see open_database().
+DATABASE = None
+
+
+def open_database():
+    # Logins only mark the database dirty; it is written out at most once a
+    # second from a background thread, and on shutdown. That thread doesn't
+    # survive a fork, so this must run after the workers are started.
+    global DATABASE
+    DATABASE = JSONDatabase(path_to_db, flush_interval=1.0)
+    DATABASE.save_username_password("admin", args.admin_password)
+
 
 class BaseHandler(tornado.web.RequestHandler):
     def get_current_user(self):
@@ -89,26 +125,193 @@ class LogoutHandler(BaseHandler):
 class PageHandler(BaseHandler):
     """Render the /ttyX pages"""
 
-    def get(self, term_name):
+    async def get(self, term_name):
         if not self.current_user:
             self.redirect("/login")
             return
         username = self.current_user.decode('UTF-8')
         if username == 'admin':
+            # Sharded, the terminals are spread over the workers, and there
+            # are no events to follow; the list is of registered students.
+            events_url = None if self.application.settings['term_manager'] is None else "/_events"
             return self.render("ex.html", static=self.static_url,
                                xstatic=self.application.settings['xstatic_url'],
-                               values=list(ws_pathes.values()), keys=list(ws_pathes.keys()))
+                               events_url=events_url, sessions_url="/_sessions")
         else:
-            term_name, terminal = self.application\
-                .settings['term_manager']\
-                .new_named_terminal(name=username, shell_command=['tmux', 'new-session', '-A', '-s', username])
-            ws_pathes[username] = "/_websocket/students/" + term_name
+            # Sharded, the worker owning this name starts the terminal when
+            # the websocket connects.
+            if self.application.settings['term_manager'] is not None:
+                # Reloading the page reattaches to the same terminal; a new
+                # one is started without holding up everyone else's.
+                await self.application.settings['term_manager']\
+                    .get_named_terminal_async(username, owner=username,
+                                              shell_command=student_shell(username))
             return self.render("termpage.html", static=self.static_url,
                                xstatic=self.application.settings['xstatic_url'],
-                               ws_url_path="/_websocket/students/" + term_name)
+                               ws_url_path="/_websocket/students/" + username)
+
+class AdminOnly(object):
+    """Refuses anyone but the admin"""
+    def get_current_user(self):
+        return self.get_secure_cookie("user")
+
+    def prepare(self):
+        if self.current_user != b'admin':
+            raise tornado.web.HTTPError(403)
+
+
+class AdminEventSocket(AdminOnly, TermEventSocket):
+    """Live list of student terminals for the admin page"""
+
+
+class AdminMuxSocket(AdminOnly, TermMuxSocket):
+    """Every student's terminal over one websocket, for the grid page"""
+
+
+class AdminScreensHandler(AdminOnly, TermScreensHandler):
+    """Text of students' screens, for polling overviews"""
+
+
+class AdminSessionsHandler(AdminOnly, TermSessionsHandler):
+    """Pages of the student terminal list, for the admin page"""
+
+
+class AdminRecordingHandler(AdminOnly, TermRecordingHandler):
+    """Recorded student sessions, to replay with asciinema"""
+
+
+class AdminSearchHandler(AdminOnly, TermSearchHandler):
+    """Who printed what, for finding students stuck on the same error"""
+
+
+class StudentDirectoryHandler(AdminSessionsHandler):
+    """The student list when sharded, from the database
+
+    The terminals are in the workers; a student's is started on their
+    worker when it is first opened.
+    """
+    def initialize(self):
+        pass
+
+    def sessions(self, owner, search, offset, limit):
+        names = sorted(name for name in DATABASE.data
+                       if name != 'admin' and (owner is None or name == owner)
+                       and (not search or search in name))
+        return len(names), [{'name': name, 'owner': name}
+                            for name in names[offset:offset + limit]]
+
+
+class GridHandler(AdminOnly, tornado.web.RequestHandler):
+    """Thumbnails of every student's screen, any of which can be enlarged"""
+    def get(self):
+        self.render("grid.html", xstatic=self.application.settings['xstatic_url'],
+                    events_url="/_events", mux_url="/_mux")
+
+
+def student_shell(username):
+    if args.tmux_control:
+        # Already in a tmux window of its own
+        return [os.environ.get('SHELL', 'bash')]
+    return ['tmux', 'new-session', '-A', '-s', username]
+
+
+async def tmux(*args):
+    """Run a tmux command without blocking the event loop, returning its status"""
+    proc = await asyncio.create_subprocess_exec(
+        'tmux', *args, stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return await proc.wait()
+
+
+class StudentTermManager(NamedTermManager):
+    """Starts a student's tmux session when their terminal is first asked for
+
+    Pooled terminals are tmux sessions with placeholder names; a student
+    logging in without a session of their own gets one of them, renamed.
+    """
+    def pool_command(self):
+        return student_shell('pool_' + uuid.uuid4().hex[:12])
+
+    def take_pooled(self, argv, cwd):
+        # Checking for a session to reattach to means waiting for tmux, so
+        # only terminals started with new_terminal_async() are pooled.
+        return None
+
+    async def take_pooled_async(self, argv, cwd):
+        if not self.pool_size or cwd is not None or argv[:-1] != student_shell('')[:-1]:
+            return None
+        username = argv[-1]
+        if await tmux('has-session', '-t', '=' + username) == 0:
+            # Reattach to the session they already have
+            return None
+        term = self.pop_pooled()
+        self.fill_pool()
+        if term is not None:
+            await tmux('rename-session', '-t', '=' + term.ptyproc.argv[-1], username)
+        return term
+
+    async def discard_pooled(self, term):
+        super(StudentTermManager, self).discard_pooled(term)
+        # Ending the tmux client leaves its placeholder session behind
+        await tmux('kill-session', '-t', '=' + term.ptyproc.argv[-1])
+
+    async def get_terminal_async(self, term_name):
+        return await self.get_named_terminal_async(
+            term_name, owner=term_name, shell_command=student_shell(term_name))
+
+
+def make_term_manager(cls=NamedTermManager):
+    # Coalesce output into one frame per ~8ms (one display refresh at 120Hz).
+    # A viewer on a slow link drops output and is resynced, rather than
+    # slowing the student's terminal down; only when every viewer is behind
+    # do we stop reading and let the terminal block. With the screen model,
+    # switching to a student shows their screen at once, and resyncs are a
+    # snapshot rather than a replay of the output missed. Session history beyond the in-memory
+    # budget goes to temporary files, so the admin can scroll back through it.
+    # Student shells can be started ahead of logins, so the first login of
+    # a class doesn't queue up behind everyone else's shell starting.
+    # Each worker has its own audit log; a student's terminal is always on
+    # the same worker, so only one writes to their file.
+    if cls is TmuxTermManager:
+        # Students get a plain shell, which the pool can provide as is
+        shell_command = student_shell('')
+    else:
+        shell_command = ['tmux','new-session', '-A', '-s', 'main']
+    audit_log = None
+    if args.audit_dir is not None:
+        audit_log = AuditLog(args.audit_dir, output=args.audit_output)
+    term_manager = cls(shell_command=shell_command, max_terminals=100,
+                       output_flush_interval=0.008, slow_client_policy='drop',
+                       flow_control=True, screen_model=True,
+                       scrollback_dir=tempfile.gettempdir(),
+                       pool_size=args.pool_size, audit_log=audit_log,
+                       recording_dir=args.record_dir,
+                       search_index=OutputIndex() if args.search else None)
+    term_manager.fill_pool()
+    return term_manager
+
+
+def make_worker_app():
+    term_manager = make_term_manager(StudentTermManager)
+    application = tornado.web.Application([
+        (r"/_websocket/students/(\w+)", TermSocket, {'term_manager': term_manager}),
+    ])
+    return application, term_manager
+
 
 def main():
-    term_manager = NamedTermManager(shell_command=['tmux','new-session', '-A', '-s', 'main'], max_terminals=100)
+    workers = []
+    if args.workers:
+        # Fork before anything here touches the IOLoop
+        workers = [sharding.Worker(i, make_worker_app) for i in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        term_manager = None
+    elif args.tmux_control:
+        term_manager = make_term_manager(TmuxTermManager)
+    else:
+        term_manager = make_term_manager(StudentTermManager)
+    open_database()
     handlers = [
         (r"/", MainHandler),
         (r"/login", LoginHandler),
@@ -121,19 +324,43 @@ def main():
         (r"/(registration_user_exists.html)", tornado.web.StaticFileHandler, {'path': './templates'}),
         (r"/(registration_no_password.html)", tornado.web.StaticFileHandler, {'path': './templates'}),
         (r"/(avatar.png)", tornado.web.StaticFileHandler, {'path': './templates'}),
-        (r"/_websocket/students/(\w+)", TermSocket, {'term_manager': term_manager}),
-        #(r"/_websocket/students/(\w+)", TermSocket, {'term_manager': term_manager}),
         (r"/students/(\w+)/?|/admin", PageHandler),
         (r"/xstatic/(.*)", tornado_xstatic.XStaticFileHandler)
     ]
+    if term_manager is not None:
+        handlers.append((r"/_websocket/students/(\w+)", TermSocket, {'term_manager': term_manager}))
+        handlers.append((r"/_events", AdminEventSocket, {'term_manager': term_manager}))
+        handlers.append((r"/_mux", AdminMuxSocket, {'term_manager': term_manager}))
+        handlers.append((r"/_screens", AdminScreensHandler, {'term_manager': term_manager}))
+        handlers.append((r"/_sessions", AdminSessionsHandler, {'term_manager': term_manager}))
+        handlers.append((r"/grid", GridHandler))
+        if args.search:
+            handlers.append((r"/_search", AdminSearchHandler,
+                             {'search_index': term_manager.search_index}))
+    else:
+        handlers.append((r"/_sessions", StudentDirectoryHandler))
+    if args.record_dir is not None:
+        # Workers record to the same directory, so this works sharded too
+        handlers.append((r"/_recordings/?(.*)", AdminRecordingHandler,
+                         {'recording_dir': args.record_dir}))
     application = tornado.web.Application(handlers, static_path=STATIC_DIR,
                               template_path=TEMPLATE_DIR,
                               xstatic_url=tornado_xstatic.url_maker('/xstatic/'),
                               term_manager=term_manager, cookie_secret="__TODO:_GENERATE_YOUR_OWN_RANDOM_VALUE_HERE__")
 
-    application.listen(8700, 'localhost')
+    if workers:
+        frontend = sharding.ShardedFrontend(application, workers,
+                                            rb"GET /_websocket/students/(\w+)[ ?]")
+        frontend.listen(8700, 'localhost')
+    else:
+        application.listen(8700, 'localhost')
     # run_and_show_browser("http://localhost:8700/login", term_manager)
-    run_and_show_browser("http://localhost:8700/", term_manager)
+    try:
+        run_and_show_browser("http://localhost:8700/", term_manager)
+    finally:
+        for worker in workers:
+            worker.stop()
+        DATABASE.close()
     # run_and_show_browser("http://localhost:8700/public/new", term_manager)
 
 
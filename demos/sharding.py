@@ -0,0 +1,174 @@
+"""Spread terminals over worker processes, so a class can use every core.
+
+The front process accepts every connection. It peeks at the request line
+without consuming it: websocket requests for a terminal are handed, socket
+and all, to the worker that owns that terminal name (chosen by hashing the
+name), and everything else is served by the front process itself. Each
+worker runs its own IOLoop, HTTP server and terminal manager, and reads
+the handed-over request from the start as if it had accepted it.
+
+Passing sockets relies on SCM_RIGHTS, so this only works on Unix.
+"""
+from __future__ import print_function, absolute_import
+
+import json
+import logging
+import os
+import re
+import signal
+import socket
+import zlib
+
+import tornado.httpserver
+import tornado.netutil
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+
+log = logging.getLogger(__name__)
+
+# Longest request line we wait for before giving up on routing it
+MAX_REQUEST_LINE = 4096
+# How long to wait for the rest of a request line that arrived in pieces
+PEEK_RETRY = 0.01
+
+
+def shard_for(name, nshards):
+    """The index of the shard that owns terminal ``name``."""
+    return zlib.crc32(name.encode('utf-8')) % nshards
+
+
+class Worker(object):
+    """A child process serving the terminals of one shard.
+
+    ``make_app`` is called in the child to build its
+    :class:`tornado.web.Application`, and must return it together with the
+    terminal manager, which is shut down when the worker exits.
+    """
+
+    def __init__(self, index, make_app):
+        self.index = index
+        self.make_app = make_app
+        self.pid = None
+        self.channel = None
+
+    def start(self):
+        """Fork the worker. Call this before the parent creates an IOLoop."""
+        parent_end, child_end = socket.socketpair(socket.AF_UNIX,
+                                                  socket.SOCK_SEQPACKET)
+        pid = os.fork()
+        if pid == 0:
+            parent_end.close()
+            status = 0
+            try:
+                self._run(child_end)
+            except BaseException:
+                log.exception("Worker %d failed", self.index)
+                status = 1
+            # Skip the parent's atexit handlers and other inherited cleanup
+            os._exit(status)
+        child_end.close()
+        self.pid = pid
+        self.channel = parent_end
+
+    def _run(self, channel):
+        loop = IOLoop.current()
+        app, term_manager = self.make_app()
+        server = tornado.httpserver.HTTPServer(app)
+        channel.setblocking(False)
+
+        def stop(*args):
+            loop.add_callback_from_signal(shutdown)
+
+        async def shutdown():
+            loop.remove_handler(channel)
+            await term_manager.shutdown()
+            loop.stop()
+
+        def on_connection(fd, events):
+            try:
+                msg, fds, flags, addr = socket.recv_fds(channel, 1024, 1)
+            except BlockingIOError:
+                return
+            if not msg:
+                # The front process has gone away.
+                loop.add_callback(shutdown)
+                return
+            conn = socket.socket(fileno=fds[0])
+            conn.setblocking(False)
+            address = tuple(json.loads(msg.decode('utf-8')))
+            server.handle_stream(IOStream(conn), address)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)    # The front handles ^C
+        loop.add_handler(channel, on_connection, IOLoop.READ)
+        log.info("Worker %d (pid %d) started", self.index, os.getpid())
+        loop.start()
+
+    def hand_over(self, conn, address):
+        """Pass an accepted connection to the worker."""
+        socket.send_fds(self.channel, [json.dumps(address).encode('utf-8')],
+                        [conn.fileno()])
+
+    def stop(self):
+        if self.pid is not None:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+                os.waitpid(self.pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+            self.pid = None
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+
+
+class ShardedFrontend(object):
+    """Accepts connections, routing terminal websockets to their worker.
+
+    ``route`` is a bytes regex matched against the start of each request;
+    its first group is the terminal name. Other requests go to ``app``.
+    """
+
+    def __init__(self, app, workers, route):
+        self.workers = workers
+        self.route = re.compile(route)
+        self.server = tornado.httpserver.HTTPServer(app)
+
+    def listen(self, port, address=''):
+        for sock in tornado.netutil.bind_sockets(port, address):
+            tornado.netutil.add_accept_handler(sock, self._on_accept)
+
+    def _on_accept(self, conn, address):
+        conn.setblocking(False)
+        IOLoop.current().add_handler(
+            conn, lambda fd, events: self._route(conn, address), IOLoop.READ)
+
+    def _route(self, conn, address):
+        loop = IOLoop.current()
+        try:
+            head = conn.recv(MAX_REQUEST_LINE, socket.MSG_PEEK)
+        except BlockingIOError:
+            return
+        except OSError:
+            head = b''
+        loop.remove_handler(conn)
+        if not head:
+            conn.close()
+            return
+        if b'\n' not in head and len(head) < MAX_REQUEST_LINE:
+            # Wait for the rest of the line, without spinning on the data
+            # that is already there.
+            loop.call_later(PEEK_RETRY, self._on_accept, conn, address)
+            return
+        match = self.route.match(head)
+        if match is None:
+            self.server.handle_stream(IOStream(conn), address)
+            return
+        name = match.group(1).decode('utf-8')
+        worker = self.workers[shard_for(name, len(self.workers))]
+        try:
+            worker.hand_over(conn, address)
+        except OSError:
+            log.exception("Could not pass terminal %s to worker %d",
+                          name, worker.index)
+        conn.close()
@@ -4,9 +4,18 @@
 # Copyright (c) 2014, Ramalingam Saravanan <sarava@sarava.net>
 # Distributed under the terms of the Simplified BSD License.
 
-from .websocket import TermSocket
+from .websocket import TermSocket, TermEventSocket, TermMuxSocket
+from .api import (TermScreensHandler, TermSessionsHandler, TermRecordingHandler,
+                  TermSearchHandler)
+from .audit import AuditLog
+from .recording import Recorder
 from .management import (TermManagerBase, SingleTermManager,
-                         UniqueTermManager, NamedTermManager)
+                         UniqueTermManager, NamedTermManager, FLOW_CONTROL,
+                         OutputRingBuffer)
+from .screen import Screen
+from .scrollback import Scrollback
+from .search import OutputIndex
+from .tmux import TmuxTermManager
 
 import logging
 # Prevent a warning about no attached handlers in Python 2
@@ -0,0 +1,255 @@
+"""JSON HTTP handlers for looking at a NamedTermManager's terminals.
+"""
+# Copyright (c) Jupyter Development Team
+# Distributed under the terms of the Simplified BSD License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import time
+
+from tornado.ioloop import IOLoop
+import tornado.web
+
+from .recording import replay
+
+
+def _read_lines(lines, size):
+    """Join lines from an iterator until there are ``size`` characters."""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        size -= len(line)
+        if size <= 0:
+            break
+    return ''.join(chunk)
+
+
+def _list_recordings(directory):
+    recordings = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.cast') and entry.is_file():
+            stat = entry.stat()
+            recordings.append({'name': entry.name, 'size': stat.st_size,
+                               'modified': stat.st_mtime})
+    recordings.sort(key=lambda r: r['modified'], reverse=True)
+    return recordings
+
+
+class TermScreensHandler(tornado.web.RequestHandler):
+    """Snapshots of the text on many terminals' screens, in one request.
+
+    ``GET ?terminal=name:version&terminal=name...`` asks for each named
+    terminal, with the version of its screen the client already has, if
+    any; with no ``terminal`` arguments, every terminal is included. The
+    reply holds ``screens``, mapping names to ``{"version", "rows", "cols",
+    "cursor": [row, col], "lines"}`` for terminals whose screen has changed
+    since the given version, ``unchanged``, listing the rest, and
+    ``missing``, listing terminals that don't exist or have no screen.
+    ``lines`` has the text of each row with trailing blanks, and trailing
+    blank rows, removed.
+
+    Only terminals of a manager with ``screen_model`` on have screens. Like
+    :class:`~terminado.TermSocket`, this leaves authentication to you.
+    """
+
+    def initialize(self, term_manager):
+        self.term_manager = term_manager
+
+    def get(self):
+        known = {}
+        requested = self.get_arguments('terminal')
+        if not requested:
+            requested = list(self.term_manager.terminals)
+        for arg in requested:
+            name, _, version = arg.rpartition(':')
+            if not name or not version.isdigit():
+                name, version = arg, None
+            known[name] = None if version is None else int(version)
+
+        screens = {}
+        unchanged = []
+        missing = []
+        for name, version in known.items():
+            terminal = self.term_manager.terminals.get(name)
+            screen = terminal.screen if terminal is not None else None
+            if screen is None:
+                missing.append(name)
+            elif screen.version == version:
+                unchanged.append(name)
+            else:
+                lines = screen.display()
+                while lines and not lines[-1]:
+                    lines.pop()
+                screens[name] = {
+                    'version': screen.version,
+                    'rows': screen.rows,
+                    'cols': screen.cols,
+                    'cursor': [screen.y, screen.x],
+                    'lines': lines,
+                }
+        self.set_header('Cache-Control', 'no-store')
+        self.write({
+            'screens': screens,
+            'unchanged': unchanged,
+            'missing': missing,
+        })
+
+
+class TermSessionsHandler(tornado.web.RequestHandler):
+    """A page of a NamedTermManager's terminals, as JSON.
+
+    ``GET ?offset=0&limit=50&owner=name&q=text`` replies with ``total``, the
+    number of terminals matching the filters, and ``sessions``, a list of
+    :meth:`~terminado.NamedTermManager.session_info` dicts ordered by name.
+    ``owner`` keeps only that user's terminals, and ``q`` those whose name
+    or owner contains it. ``limit`` is capped at :attr:`max_limit`.
+
+    Like :class:`~terminado.TermSocket`, this leaves authentication to you.
+    """
+
+    #: Largest page that can be asked for.
+    max_limit = 500
+
+    def initialize(self, term_manager):
+        self.term_manager = term_manager
+
+    def _int_argument(self, name, default):
+        value = self.get_argument(name, None)
+        if value is None:
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            value = -1
+        if value < 0:
+            raise tornado.web.HTTPError(400, "%s must be a number >= 0", name)
+        return value
+
+    def sessions(self, owner, search, offset, limit):
+        """Return ``(total, page)``; override to list something else."""
+        return self.term_manager.sessions(owner=owner, search=search,
+                                          offset=offset, limit=limit)
+
+    def get(self):
+        offset = self._int_argument('offset', 0)
+        limit = min(self._int_argument('limit', 50), self.max_limit)
+        total, page = self.sessions(self.get_argument('owner', None),
+                                    self.get_argument('q', None),
+                                    offset, limit)
+        self.set_header('Cache-Control', 'no-store')
+        self.write({
+            'total': total,
+            'offset': offset,
+            'sessions': page,
+        })
+
+
+class TermRecordingHandler(tornado.web.RequestHandler):
+    """Recordings of terminal sessions made with ``recording_dir`` set.
+
+    With no name in the URL, ``GET`` lists the recordings as JSON:
+    ``{"recordings": [{"name", "size", "modified"}]}``, newest first. With
+    the name of one, it replies with the recording in asciicast v2 format,
+    from ``?start=seconds`` into it if given, and up to ``&end=seconds``;
+    see :func:`terminado.recording.replay`. Seeking is quick however long
+    the recording is, and a recording still being made can be replayed.
+    Files are read on a thread, so a slow disk doesn't hold up terminals.
+
+    Route it with one optional capturing group, e.g.
+    ``(r"/recordings/(.*)", TermRecordingHandler, {'recording_dir': path})``.
+    Like :class:`~terminado.TermSocket`, this leaves authentication to you.
+    """
+
+    #: Bytes of the recording sent between flushes to the client.
+    chunk_size = 65536
+
+    def initialize(self, recording_dir):
+        self.recording_dir = recording_dir
+
+    def _float_argument(self, name, default):
+        value = self.get_argument(name, None)
+        if value is None:
+            return default
+        try:
+            return float(value)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "%s must be a number", name)
+
+    async def get(self, name=None):
+        if not name:
+            await self.list_recordings()
+            return
+        if os.path.basename(name) != name or not name.endswith('.cast'):
+            raise tornado.web.HTTPError(404)
+        path = os.path.join(self.recording_dir, name)
+        if not os.path.isfile(path):
+            raise tornado.web.HTTPError(404)
+        start = self._float_argument('start', 0)
+        end = self._float_argument('end', None)
+
+        self.set_header('Content-Type', 'application/x-asciicast')
+        self.set_header('Cache-Control', 'no-store')
+        loop = IOLoop.current()
+        lines = replay(path, start, end)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(
+                    None, _read_lines, lines, self.chunk_size)
+                if not chunk:
+                    break
+                self.write(chunk)
+                await self.flush()
+        finally:
+            lines.close()
+
+    async def list_recordings(self):
+        recordings = await IOLoop.current().run_in_executor(
+            None, _list_recordings, self.recording_dir)
+        self.set_header('Cache-Control', 'no-store')
+        self.write({'recordings': recordings})
+
+
+class TermSearchHandler(tornado.web.RequestHandler):
+    """Search an :class:`~terminado.OutputIndex` of what terminals printed.
+
+    ``GET ?q=segmentation+fault&within=600`` replies with ``sessions``, the
+    terminals that printed a line with all those words in the last
+    ``within`` seconds, most recent first, each with its ``name``,
+    ``owner`` and ``matches``, a list of ``{"time", "line"}``. Leave out
+    ``within`` to search everything still indexed, and add ``owner`` to
+    search one user's terminals. At most ``limit`` lines are returned, up to
+    :attr:`max_limit`.
+
+    Like :class:`~terminado.TermSocket`, this leaves authentication to you.
+    """
+
+    #: Most lines that can be asked for.
+    max_limit = 1000
+
+    def initialize(self, search_index):
+        self.search_index = search_index
+
+    _int_argument = TermSessionsHandler._int_argument
+
+    def get(self):
+        query = self.get_argument('q', '')
+        if not query.strip():
+            raise tornado.web.HTTPError(400, "q is required")
+        within = self._int_argument('within', None)
+        limit = min(self._int_argument('limit', 100), self.max_limit)
+        since = time.time() - within if within is not None else None
+        matches = self.search_index.search(query, since=since, limit=limit,
+                                           owner=self.get_argument('owner', None))
+        sessions = {}
+        for match in matches:
+            key = (match['name'], match['owner'])
+            session = sessions.get(key)
+            if session is None:
+                session = sessions[key] = {'name': match['name'],
+                                           'owner': match['owner'],
+                                           'matches': []}
+            session['matches'].append({'time': match['time'],
+                                       'line': match['line']})
+        self.set_header('Cache-Control', 'no-store')
+        self.write({'sessions': list(sessions.values())})
@@ -0,0 +1,135 @@
+"""A record of what is typed into terminals, and optionally what they print.
+"""
+# Copyright (c) Jupyter Development Team
+# Distributed under the terms of the Simplified BSD License.
+
+from __future__ import absolute_import, print_function
+
+import codecs
+from collections import Counter
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+_UNSAFE_FILENAME = re.compile(r'[^\w.-]')
+
+
+class AuditLog(object):
+    """Writes terminal activity to a file per owner, from a background thread.
+
+    Each line of ``<owner>.jsonl`` in ``directory`` is a JSON object with the
+    ``time`` (seconds since the epoch), the terminal's ``session`` name, the
+    ``direction`` (``"stdin"`` for a command typed, ``"stdout"`` for output)
+    and the ``data``. Terminals without an owner are logged under their name,
+    and those with neither, like :class:`~terminado.UniqueTermManager`'s, in
+    ``unnamed.jsonl``. A file is rotated once it reaches ``max_bytes``,
+    keeping ``backup_count`` old ones as ``<owner>.jsonl.1`` and so on.
+
+    :meth:`record` only puts the record on a queue of up to ``queue_size``
+    records; if the writer falls that far behind, records are dropped and
+    counted in :attr:`stats`. Output is only recorded if ``output`` is true.
+
+    Give it to a terminal manager as ``audit_log``; the manager closes it on
+    shutdown.
+    """
+
+    def __init__(self, directory, output=False, max_bytes=10485760,
+                 backup_count=5, queue_size=10000):
+        self.directory = directory
+        self.output = output
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        #: How many records were ``written`` and ``dropped``.
+        self.stats = Counter()
+        self.log = logging.getLogger(__name__)
+        os.makedirs(directory, exist_ok=True)
+
+        self._queue = queue.Queue(queue_size)
+        self._files = {}
+        # Output is decoded as it is recorded, continuing each terminal's
+        # utf-8 stream across reads; see forget().
+        self._decoders = {}
+        self._thread = threading.Thread(target=self._run,
+                                        name="terminado audit log",
+                                        daemon=True)
+        self._thread.start()
+
+    def record(self, terminal, direction, data):
+        """Queue a record of ``data`` (text, or bytes of output)."""
+        if isinstance(data, bytes):
+            decoder = self._decoders.get(terminal)
+            if decoder is None:
+                decoder = self._decoders[terminal] = \
+                    codecs.getincrementaldecoder('utf-8')(errors='replace')
+            data = decoder.decode(data)
+        session = getattr(terminal, 'term_name', None)
+        try:
+            self._queue.put_nowait((time.time(),
+                                    terminal.owner or session or 'unnamed',
+                                    session, direction, data))
+        except queue.Full:
+            self.stats['dropped'] += 1
+
+    def forget(self, terminal):
+        """Drop what is kept about ``terminal`` once it has closed."""
+        self._decoders.pop(terminal, None)
+
+    def close(self):
+        """Write out what is queued and stop the writer thread."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            # Write whatever else has queued up meanwhile before flushing
+            while item is not None:
+                try:
+                    self._write(*item)
+                except Exception:
+                    self.log.exception("Failed to write audit record")
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            for f in self._files.values():
+                f.flush()
+            if item is None:
+                break
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def _write(self, when, owner, session, direction, data):
+        line = json.dumps({'time': when, 'session': session,
+                           'direction': direction, 'data': data}) + '\n'
+        owner = _UNSAFE_FILENAME.sub('_', str(owner))
+        f = self._files.get(owner)
+        if f is None:
+            f = self._files[owner] = open(self._path(owner), 'a', encoding='utf-8')
+        f.write(line)
+        self.stats['written'] += 1
+        if f.tell() >= self.max_bytes:
+            f.close()
+            del self._files[owner]
+            self._rotate(owner)
+
+    def _path(self, owner, n=0):
+        path = os.path.join(self.directory, owner + '.jsonl')
+        return '%s.%d' % (path, n) if n else path
+
+    def _rotate(self, owner):
+        if not self.backup_count:
+            os.remove(self._path(owner))
+            return
+        for n in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(self._path(owner, n)):
+                os.replace(self._path(owner, n), self._path(owner, n + 1))
+        os.replace(self._path(owner), self._path(owner, 1))
@@ -7,17 +7,20 @@
 from __future__ import absolute_import, print_function
 
 import asyncio
-from collections import deque
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import errno
 import itertools
 import logging
 import os
 import signal
 import codecs
+import time
 import warnings
 import select
 
 try:
-    from ptyprocess import PtyProcessUnicode
+    from ptyprocess import PtyProcess, PtyProcessUnicode
     def preexec_fn():
         signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 except ImportError:
@@ -25,15 +28,89 @@ except ImportError:
         from winpty import PtyProcess as PtyProcessUnicode
     except ImportError:
         PtyProcessUnicode = object
+    # No bytes-level process class; winpty only reads and writes text.
+    PtyProcess = None
     preexec_fn = None
 
 from tornado.ioloop import IOLoop
 
+from .recording import Recorder, recording_name
+from .screen import Screen
+from .scrollback import Scrollback
+
 ENV_PREFIX = "PYXTERM_"         # Environment variable prefix
 
 # TERM is set according to xterm.js capabilities
 DEFAULT_TERM_TYPE = "xterm-256color"
 
+# Stands in for the client in PtyWithClients.paused_by when reading is paused
+# because every client is backlogged.
+FLOW_CONTROL = "flow-control"
+
+# Resets attributes, homes the cursor and clears the screen, for a client
+# that missed more output than it can be resent; see PtyWithClients.resync().
+_CLEAR_SCREEN = b'\x1b[0m\x1b[H\x1b[2J'
+
+
+class PtyOutput(object):
+    """A chunk of terminal output, shared by every client of the terminal.
+
+    :attr:`data` holds the raw bytes read from the pty and :attr:`text` their
+    decoded form, which is None unless some client asked for text. Clients
+    keep their wire encodings of the chunk in :attr:`cache`, keyed by
+    format, so it is serialised once per format rather than once per client.
+    """
+    __slots__ = ('data', 'text', 'cache')
+
+    def __init__(self, data, text=None):
+        self.data = data
+        self.text = text
+        self.cache = {}
+
+
+class OutputRingBuffer(object):
+    """A FIFO of output chunks holding at most ``maxsize`` bytes.
+
+    Appending past the limit discards the oldest bytes (splitting a chunk if
+    needed), and :attr:`dropped_bytes` counts everything discarded so far.
+    With ``maxsize`` None it grows without bound.
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.size = 0
+        self.dropped_bytes = 0
+        self._chunks = deque()
+
+    def append(self, data):
+        if not data:
+            return
+        self._chunks.append(data)
+        self.size += len(data)
+        if self.maxsize is None:
+            return
+        while self.size > self.maxsize:
+            excess = self.size - self.maxsize
+            head = self._chunks[0]
+            if len(head) <= excess:
+                self._chunks.popleft()
+                dropped = len(head)
+            else:
+                self._chunks[0] = head[excess:]
+                dropped = excess
+            self.size -= dropped
+            self.dropped_bytes += dropped
+
+    def clear(self):
+        self._chunks.clear()
+        self.size = 0
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def __len__(self):
+        return len(self._chunks)
+
 
 class PtyWithClients(object):
     def __init__(self, argv, env=[], cwd=None):
@@ -43,17 +120,310 @@ class PtyWithClients(object):
         #  is lost.  Hence the change from 0.8.3.
         # Buffer output until a client connects; then let the client
         #  drain the buffer.
-        # We keep the same read_buffer as before
-        self.read_buffer = deque([], maxlen=10)
-        self.preopen_buffer = deque([])
+        # All output is also kept, within limits, for clients to page
+        # through; see Scrollback.
+        self.scrollback = Scrollback()
+        self.preopen_buffer = OutputRingBuffer()
+        self.ptyproc = self.spawn(argv, env, cwd)
+        # Output is only decoded while someone wants text; after a gap the
+        # decoder's partial state is stale and has to be reset.
+        self._decoder_in_sync = True
+        self.nonblocking = False
+
+        # Output coalescing: with a flush_interval set, output is held back
+        # for up to that many seconds (or until flush_size bytes have
+        # accumulated) and sent to clients as one message.
+        self.flush_interval = 0
+        self.flush_size = 65536
+        self._pending = []
+        self._pending_size = 0
+        self._flush_handle = None
+
+        # Clients that asked for reading to stop until they catch up.
+        self.paused_by = set()
+
+        # Optional model of what the terminal shows; see enable_screen().
+        self.screen = None
+
+        # Seconds terminate() waits for the process to exit after each
+        # signal, by signal number; others wait ptyproc.delayafterterminate.
+        self.grace_periods = {}
+
+        # Called with this terminal whenever it produces output.
+        self.activity_callback = None
+
+        # Input not yet written to the pty; see write(). Once there are
+        # input_buffer_size bytes waiting, writers are asked to wait.
+        self.input_buffer_size = 1048576
+        self._input = deque()
+        self._input_size = 0
+        self._input_scheduled = False
+        self._input_space = []
+        # Whether we are waiting for the pty to take more input, and what
+        # to call with this terminal when that changes.
+        self.waiting_writable = False
+        self.writable_callback = None
+
+        # An AuditLog to record output to, if any.
+        self.audit_log = None
+        # A Recorder of this terminal's session, if any.
+        self.recorder = None
+        # An OutputIndex to feed output to, if any.
+        self.search_index = None
+
+        # For listing terminals; see NamedTermManager.sessions().
+        self.owner = None
+        self.created = self.last_activity = time.time()
+
+    def spawn(self, argv, env, cwd):
+        """Start the program, returning its :class:`PtyProcess`."""
         kwargs = dict(argv=argv, env=env, cwd=cwd)
         if preexec_fn is not None:
             kwargs["preexec_fn"] = preexec_fn
-        self.ptyproc = PtyProcessUnicode.spawn(**kwargs)
+        ptyproc = PtyProcessUnicode.spawn(**kwargs)
         # The output might not be strictly UTF-8 encoded, so
         # we replace the inner decoder of PtyProcessUnicode
         # to allow non-strict decode.
-        self.ptyproc.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        ptyproc.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        # close() would otherwise sleep to give the process time to exit;
+        # see our close().
+        ptyproc.delayafterclose = 0
+        return ptyproc
+
+    def enable_screen(self):
+        """Keep a :class:`~terminado.screen.Screen` of the terminal's contents.
+
+        New clients are then sent a snapshot of the screen instead of the
+        raw output buffered since the terminal started, and nothing more is
+        kept in :attr:`preopen_buffer`.
+        """
+        rows, cols = self.ptyproc.getwinsize()
+        self.screen = Screen(rows, cols)
+        for chunk in self.preopen_buffer:
+            self.screen.feed(self.decode(chunk))
+        self.preopen_buffer.clear()
+
+    def set_nonblocking(self):
+        """Put the pty master fd into non-blocking mode.
+
+        Reads then return whatever is available instead of waiting for more,
+        so the event loop never stalls on a spurious readiness notification.
+        """
+        os.set_blocking(self.ptyproc.fd, False)
+        self.nonblocking = True
+
+    def read_available(self, limit=4096):
+        """Read output until the pty would block, up to ``limit`` bytes.
+
+        Only valid after :meth:`set_nonblocking`. Returns the bytes read
+        (possibly none), and raises :exc:`EOFError` once the pty has closed
+        and there is nothing left to return.
+        """
+        fd = self.ptyproc.fd
+        chunks = []
+        total = 0
+        while total < limit:
+            try:
+                b = os.read(fd, min(65536, limit - total))
+            except BlockingIOError:
+                break
+            except OSError as err:
+                if err.errno != errno.EIO:
+                    raise
+                # Linux-style EOF
+                b = b''
+            if not b:
+                if chunks:
+                    # Hand over what we have; EOF is seen on the next read.
+                    break
+                self.ptyproc.flag_eof = True
+                raise EOFError('End Of File (EOF).')
+            chunks.append(b)
+            total += len(b)
+        return b''.join(chunks)
+
+    def read(self, size=65536):
+        """Read raw output bytes, blocking until some are available."""
+        if PtyProcess is None:
+            return self.ptyproc.read(size).encode('utf-8')
+        # Skip PtyProcessUnicode's decoding; see decode().
+        return PtyProcess.read(self.ptyproc, size)
+
+    def decode(self, data):
+        """Decode output bytes, continuing the pty's utf-8 stream."""
+        if not self._decoder_in_sync:
+            self.ptyproc.decoder.reset()
+            self._decoder_in_sync = True
+        return self.ptyproc.decoder.decode(data, final=False)
+
+    def make_output(self, data, text=True):
+        """Wrap output bytes for clients, decoding them if ``text`` is true."""
+        if not text:
+            self._decoder_in_sync = False
+            return PtyOutput(data)
+        return PtyOutput(data, self.decode(data))
+
+    def write(self, s):
+        """Write text or bytes to the process in the pty.
+
+        In non-blocking mode the input is queued and written on the next
+        turn of the event loop, together with anything else written by
+        then, so a burst of keystrokes becomes one write. What the pty won't
+        take yet is written as it becomes able to, and never blocks the
+        event loop; see :meth:`input_full`.
+        """
+        if isinstance(s, str):
+            data = s.encode('utf-8')
+        else:
+            data = s
+        if not self.nonblocking:
+            if PtyProcess is None:
+                return self.ptyproc.write(data.decode('utf-8', 'replace'))
+            return PtyProcess.write(self.ptyproc, data)
+        return self._queue_input(data)
+
+    def _queue_input(self, data):
+        if data:
+            self._input.append(data)
+            self._input_size += len(data)
+            if not (self._input_scheduled or self.waiting_writable):
+                self._input_scheduled = True
+                IOLoop.current().add_callback(self.write_input)
+        return len(data)
+
+    def input_full(self):
+        """Whether :attr:`input_buffer_size` bytes of input are waiting."""
+        return self._input_size >= self.input_buffer_size
+
+    async def wait_input_space(self):
+        """Wait until :meth:`input_full` is no longer true."""
+        while self.input_full():
+            space = asyncio.get_event_loop().create_future()
+            self._input_space.append(space)
+            await space
+
+    def write_input(self):
+        """Write queued input until the pty won't take any more."""
+        self._input_scheduled = False
+        try:
+            self._input_size -= _write_queued(self.ptyproc.fd, self._input)
+        except OSError:
+            # The pty has closed; nothing will read this.
+            self.discard_input()
+        self._set_waiting_writable(bool(self._input))
+        if not self.input_full():
+            self._wake_writers()
+
+    def discard_input(self):
+        """Drop queued input, letting anyone waiting to write continue."""
+        self._input.clear()
+        self._input_size = 0
+        self._set_waiting_writable(False)
+        self._wake_writers()
+
+    def _set_waiting_writable(self, waiting):
+        if waiting != self.waiting_writable:
+            self.waiting_writable = waiting
+            if self.writable_callback is not None:
+                self.writable_callback(self)
+
+    def _wake_writers(self):
+        spaces, self._input_space = self._input_space, []
+        for space in spaces:
+            if not space.done():
+                space.set_result(None)
+
+    def on_output(self, s):
+        """Handle bytes read from the pty, batching them if configured to."""
+        self.last_activity = time.time()
+        if self.activity_callback is not None:
+            self.activity_callback(self)
+        if self.audit_log is not None:
+            self.audit_log.record(self, 'stdout', s)
+        if self.search_index is not None:
+            self.search_index.feed(self, s)
+        if not self.flush_interval:
+            self.deliver(s)
+            return
+        self._pending.append(s)
+        self._pending_size += len(s)
+        if self._pending_size >= self.flush_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = IOLoop.current().call_later(
+                self.flush_interval, self.flush)
+
+    def flush(self):
+        """Deliver any batched output now."""
+        if self._flush_handle is not None:
+            IOLoop.current().remove_timeout(self._flush_handle)
+            self._flush_handle = None
+        if not self._pending:
+            return
+        s = b''.join(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        self.deliver(s)
+
+    def deliver(self, s):
+        """Send output to all clients, or buffer it if there are none."""
+        self.scrollback.append(s)
+        screen = self.screen
+        if self.recorder is not None:
+            self.recorder.output(s, screen)
+        if not self.clients:
+            if screen is not None:
+                # The screen is all a client attaching later needs.
+                screen.feed(self.decode(s))
+            else:
+                # No one to consume our output: buffer it.
+                self.preopen_buffer.append(s)
+            return
+        wants_text = (screen is not None
+                      or any(not client.binary for client in self.clients))
+        output = self.make_output(s, text=wants_text)
+        if screen is not None:
+            screen.feed(output.text)
+        for client in self.clients:
+            client.on_pty_output(output)
+
+    def resync(self, client, since=None):
+        """Bring a client that had output dropped back up to date.
+
+        With a screen model, the client is sent a snapshot of the screen.
+        Otherwise it is sent the output it missed, from offset ``since`` in
+        :attr:`scrollback`. If that is more than a new client would get
+        from :attr:`preopen_buffer`, or no longer kept, or ``since`` is
+        None, the client's screen is cleared and it gets the newest output
+        that size instead. Either way the other clients see nothing of it.
+        """
+        if self.screen is not None:
+            client.on_pty_output(self.snapshot_output())
+            return
+        start = self.scrollback.start
+        if self.preopen_buffer.maxsize is not None:
+            start = max(start, self.scrollback.end - self.preopen_buffer.maxsize)
+        prefix = b''
+        if since is None or since < start:
+            prefix = _CLEAR_SCREEN
+            since = start
+        data = prefix + self.scrollback.read(since)
+        if not data:
+            return
+        # Decoded apart from the pty's stream, which it would upset
+        text = None if client.binary else data.decode('utf-8', 'replace')
+        client.on_pty_output(PtyOutput(data, text))
+
+    def snapshot_output(self):
+        """A :class:`PtyOutput` that paints the current screen on a client."""
+        snapshot = self.screen.snapshot()
+        return PtyOutput(snapshot.encode('utf-8'), snapshot)
+
+    def redraw(self):
+        """Make the program in the terminal redraw, via two SIGWINCHes."""
+        rows, cols = self.ptyproc.getwinsize()
+        self.ptyproc.setwinsize(rows, cols + 1)
+        self.ptyproc.setwinsize(rows, cols)
 
     def resize_to_smallest(self):
         """Set the terminal size to that of the smallest client dimensions.
@@ -76,6 +446,10 @@ class PtyWithClients(object):
         rows, cols = self.ptyproc.getwinsize()
         if (rows, cols) != (minrows, mincols):
             self.ptyproc.setwinsize(minrows, mincols)
+            if self.screen is not None:
+                self.screen.resize(minrows, mincols)
+            if self.recorder is not None:
+                self.recorder.resize(minrows, mincols)
 
     def kill(self, sig=signal.SIGTERM):
         """Send a signal to the process in the pty"""
@@ -92,43 +466,97 @@ class PtyWithClients(object):
         '''This forces a child process to terminate. It starts nicely with
         SIGHUP and SIGINT. If "force" is True then moves onto SIGKILL. This
         returns True if the child was terminated. This returns False if the
-        child could not be terminated. '''
+        child could not be terminated.
+
+        After each signal it waits for the process to exit for up to that
+        signal's grace period (see :attr:`grace_periods`), returning as
+        soon as it does. '''
         if os.name == 'nt':
             signals = [signal.SIGINT, signal.SIGTERM]
         else:
             signals = [signal.SIGHUP, signal.SIGCONT, signal.SIGINT,
                        signal.SIGTERM]
 
-        loop = IOLoop.current()
-        def sleep(): return asyncio.sleep(self.ptyproc.delayafterterminate)
-
         if not self.ptyproc.isalive():
             return True
         try:
             for sig in signals:
                 self.kill(sig)
-                await sleep()
-                if not self.ptyproc.isalive():
+                if await self.wait_exit(self.grace_period(sig)):
                     return True
             if force:
                 self.kill(signal.SIGKILL)
-                await sleep()
-                if not self.ptyproc.isalive():
-                    return True
-                else:
-                    return False
+                return await self.wait_exit(self.grace_period(signal.SIGKILL))
             return False
         except OSError:
             # I think there are kernel timing issues that sometimes cause
             # this to happen. I think isalive() reports True, but the
             # process is dead to the kernel.
             # Make one last attempt to see if the kernel is up to date.
-            await sleep()
+            await asyncio.sleep(self.ptyproc.delayafterterminate)
             if not self.ptyproc.isalive():
                 return True
             else:
                 return False
 
+    def grace_period(self, sig):
+        """Seconds to wait for the process to exit after sending ``sig``."""
+        return self.grace_periods.get(sig, self.ptyproc.delayafterterminate)
+
+    async def wait_exit(self, timeout):
+        """Wait up to ``timeout`` seconds for the process to exit.
+
+        Returns whether it has exited, reaping it if it is our child. Exit
+        is noticed at once through a pidfd where the platform has them;
+        elsewhere this sleeps for ``timeout`` and then checks.
+        """
+        if not self.ptyproc.isalive():
+            return True
+        if timeout <= 0:
+            return False
+        try:
+            pidfd = os.pidfd_open(self.ptyproc.pid)
+        except (AttributeError, OSError):
+            await asyncio.sleep(timeout)
+            return not self.ptyproc.isalive()
+        loop = IOLoop.current()
+        exited = asyncio.Event()
+        try:
+            # A pidfd polls readable once the process has exited.
+            loop.add_handler(pidfd, lambda fd, events: exited.set(), loop.READ)
+            try:
+                await asyncio.wait_for(exited.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                loop.remove_handler(pidfd)
+        finally:
+            os.close(pidfd)
+        return not self.ptyproc.isalive()
+
+    def close(self):
+        """Close the pty once the process in it has exited.
+
+        A process that is still running, like one that has closed the pty
+        but ignored its hangup, is terminated first, in the background.
+        """
+        self.discard_input()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.audit_log is not None:
+            self.audit_log.forget(self)
+        if self.ptyproc.isalive():
+            IOLoop.current().add_callback(self._close_when_terminated)
+        else:
+            self.ptyproc.close()
+
+    async def _close_when_terminated(self):
+        if await self.terminate(force=True):
+            self.ptyproc.close()
+        else:
+            logging.getLogger(__name__).warning(
+                "Could not terminate process %d", self.ptyproc.pid)
+
 
 def _update_removing(target, changes):
     """Like dict.update(), but remove keys where the value is None.
@@ -140,6 +568,34 @@ def _update_removing(target, changes):
             target[k] = v
 
 
+def _write_queued(fd, queue, max_write=65536):
+    """Write a deque of bytes to a non-blocking fd until it would block.
+
+    Small pieces, like keystrokes, are joined up into one write. What isn't
+    written is left at the front of ``queue``. Returns the number of bytes
+    written; errors other than the fd being full are raised.
+    """
+    written = 0
+    while queue:
+        chunk = queue.popleft()
+        if queue and len(chunk) < max_write:
+            pieces = [chunk]
+            size = len(chunk)
+            while queue and size < max_write:
+                pieces.append(queue.popleft())
+                size += len(pieces[-1])
+            chunk = b''.join(pieces)
+        try:
+            n = os.write(fd, chunk)
+        except BlockingIOError:
+            n = 0
+        written += n
+        if n < len(chunk):
+            queue.appendleft(memoryview(chunk)[n:])
+            break
+    return written
+
+
 def _poll(fd, timeout: float = 0.1):
     """Poll using poll() on posix systems and select() elsewhere (e.g., Windows)
     """
@@ -156,14 +612,105 @@ def _poll(fd, timeout: float = 0.1):
 class TermManagerBase(object):
     """Base class for a terminal manager."""
 
+    #: Upper bound on bytes read from one pty per event loop callback, so a
+    #: single noisy terminal cannot starve the others.
+    max_read_size = 4096
+
     def __init__(self, shell_command, server_url="", term_settings={},
-                 extra_env=None, ioloop=None):
+                 extra_env=None, ioloop=None, nonblocking_read=None,
+                 output_flush_interval=0, output_flush_size=65536,
+                 slow_client_policy=None, client_high_watermark=1048576,
+                 client_low_watermark=262144, flow_control=False,
+                 preopen_buffer_size=262144, screen_model=False,
+                 scrollback_memory=262144, scrollback_dir=None,
+                 websocket_compression=True, compression_level=1,
+                 compression_mem_level=8, compression_window_bits=15,
+                 compression_context_takeover=True, compression_min_size=32,
+                 pool_size=0, terminate_grace_periods=None,
+                 input_buffer_size=1048576, audit_log=None,
+                 recording_dir=None, recording_index_interval=10.0,
+                 search_index=None):
         self.shell_command = shell_command
         self.server_url = server_url
         self.term_settings = term_settings
         self.extra_env = extra_env
         self.log = logging.getLogger(__name__)
 
+        # Batch pty output into one websocket message per interval (seconds)
+        # or per output_flush_size bytes; 0 sends every read at once.
+        self.output_flush_interval = output_flush_interval
+        self.output_flush_size = output_flush_size
+
+        # What to do when a client has more than client_high_watermark bytes
+        # waiting to be sent: 'drop' its output and resync it once it is
+        # back under client_low_watermark (see PtyWithClients.resync()),
+        # 'pause' reading the terminal until then, or 'disconnect' it. None
+        # lets the backlog grow.
+        if slow_client_policy not in (None, 'drop', 'pause', 'disconnect'):
+            raise ValueError("Unknown slow_client_policy %r" % slow_client_policy)
+        self.slow_client_policy = slow_client_policy
+        self.client_high_watermark = client_high_watermark
+        self.client_low_watermark = client_low_watermark
+        # Stop reading a terminal while all of its clients are over the high
+        # watermark, so the program blocks instead of us buffering for it.
+        self.flow_control = flow_control
+        # Bytes of output kept for a terminal nobody is attached to; only
+        # the most recent output is kept. None keeps everything.
+        self.preopen_buffer_size = preopen_buffer_size
+        # Track each terminal's screen contents, so clients attaching to a
+        # running terminal see its current screen straight away.
+        self.screen_model = screen_model
+        # Each terminal's output history keeps its newest scrollback_memory
+        # bytes in memory and the rest in a file in scrollback_dir, or
+        # discards the rest if that is None.
+        self.scrollback_memory = scrollback_memory
+        self.scrollback_dir = scrollback_dir
+        # permessage-deflate for clients that offer it. Terminal output is
+        # repetitive enough that level 1 gets most of the size reduction;
+        # see websocket_compression_options() for why context takeover is
+        # on by default.
+        self.websocket_compression = websocket_compression
+        self.compression_level = compression_level
+        self.compression_mem_level = compression_mem_level
+        self.compression_window_bits = compression_window_bits
+        self.compression_context_takeover = compression_context_takeover
+        self.compression_min_size = compression_min_size
+        # How often each policy has been applied, across all clients.
+        self.backpressure_stats = Counter()
+        # Keep pool_size terminals started ahead of time, so new_terminal()
+        # can hand one out instead of making the user wait for a process
+        # (and its shell startup files) to start. See take_pooled().
+        self.pool_size = pool_size
+        self.pool = deque()
+        # How long PtyWithClients.terminate() gives a process to exit after
+        # each signal, as {signal number: seconds}; see grace_periods there.
+        # Exit is noticed as soon as it happens, so these can be generous.
+        self.terminate_grace_periods = terminate_grace_periods or {}
+        # Bytes of input waiting for a terminal's pty beyond which
+        # TermSocket stops reading its websocket; see PtyWithClients.write().
+        self.input_buffer_size = input_buffer_size
+        # An AuditLog for commands typed into terminals, and their output if
+        # it records output. Closed by shutdown().
+        self.audit_log = audit_log
+        # Record each terminal's session as an asciicast file in
+        # recording_dir, indexed every recording_index_interval seconds;
+        # see recording_path() and terminado.recording.
+        self.recording_dir = recording_dir
+        self.recording_index_interval = recording_index_interval
+        if recording_dir is not None:
+            os.makedirs(recording_dir, exist_ok=True)
+        # An OutputIndex of what terminals print, for searching it.
+        self.search_index = search_index
+        self.pool_stats = Counter()
+        self._pool_pending = 0
+        self._pool_executor = None
+        self._spawn_executor = None
+
+        # Non-blocking reads need a real pty fd, which winpty doesn't give us.
+        if nonblocking_read is None:
+            nonblocking_read = os.name == 'posix'
+        self.nonblocking_read = nonblocking_read
+
         self.ptys_by_fd = {}
 
         if ioloop is not None:
@@ -173,6 +720,42 @@ class TermManagerBase(object):
                 stacklevel=2,
             )
 
+    def websocket_compression_options(self):
+        """Compression options for :class:`~terminado.TermSocket` connections.
+
+        None disables compression.
+
+        With ``compression_context_takeover`` off, each output frame is
+        compressed once and the result sent to every client watching the
+        terminal (see :class:`~terminado.websocket.PreparedMessage`); with
+        it on, as by default, each connection compresses frames itself.
+        Takeover still costs less unless terminals typically have more than
+        two clients, as ``demos/bench_compression.py`` shows at level 1 with
+        15 window bits and a 32 byte ``compression_min_size``:
+
+        ========  ========================  ========================
+        trace     ratio, takeover on / off  CPU s/MB, on / off
+        ========  ========================  ========================
+        compiler  6.80 / 2.66               0.021 / 0.043
+        progress  5.74 / 1.64               0.045 / 0.113
+        htop      3.62 / 3.17               0.018 / 0.019
+        ls        3.94 / 3.26               0.021 / 0.027
+        ========  ========================  ========================
+
+        CPU is per connection with takeover, and per terminal without.
+        Turn it off where many clients watch each terminal, as when a whole
+        class follows the teacher's.
+        """
+        if not self.websocket_compression:
+            return None
+        return {
+            'compression_level': self.compression_level,
+            'mem_level': self.compression_mem_level,
+            'server_max_window_bits': self.compression_window_bits,
+            'server_no_context_takeover': not self.compression_context_takeover,
+            'min_size': self.compression_min_size,
+        }
+
     def make_term_env(self, height=25, width=80, winheight=0, winwidth=0, **kwargs):
         """Build the environment variables for the process in the terminal."""
         env = os.environ.copy()
@@ -196,51 +779,304 @@ class TermManagerBase(object):
 
     def new_terminal(self, **kwargs):
         """Make a new terminal, return a :class:`PtyWithClients` instance."""
+        argv, env, cwd = self._terminal_options(kwargs)
+        term = self.take_pooled(argv, cwd)
+        if term is None:
+            term = self.make_terminal(argv, env, cwd)
+        return term
+
+    async def new_terminal_async(self, **kwargs):
+        """Like :meth:`new_terminal`, without blocking the event loop.
+
+        Forking the process and waiting for it to start happen on a thread
+        (see :meth:`make_terminal_async`), so other terminals' output keeps
+        flowing meanwhile.
+        """
+        argv, env, cwd = self._terminal_options(kwargs)
+        term = await self.take_pooled_async(argv, cwd)
+        if term is None:
+            term = await self.make_terminal_async(argv, env, cwd)
+        return term
+
+    def _terminal_options(self, kwargs):
         options = self.term_settings.copy()
         options['shell_command'] = self.shell_command
         options.update(kwargs)
-        argv = options['shell_command']
         env = self.make_term_env(**options)
-        cwd = options.get('cwd', None)
+        return options['shell_command'], env, options.get('cwd', None)
+
+    def make_terminal(self, argv, env, cwd):
+        """Start a terminal for :meth:`new_terminal`.
+
+        Override this to change how terminals are created.
+        """
         return PtyWithClients(argv, env, cwd)
 
+    def make_terminal_async(self, argv, env, cwd):
+        """Run :meth:`make_terminal` on a thread, returning an awaitable.
+
+        Terminals are started one at a time: every fork holds the GIL, and
+        several threads forking at once starve the event loop of it. Override
+        this if :meth:`make_terminal` must run on the event loop.
+        """
+        if self._spawn_executor is None:
+            self._spawn_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='terminado-spawn')
+        return IOLoop.current().run_in_executor(
+            self._spawn_executor, self.make_terminal, argv, env, cwd)
+
+    def pool_command(self):
+        """The command for the next terminal started for the pool."""
+        return self.shell_command
+
+    def take_pooled(self, argv, cwd):
+        """Return a pooled terminal to run ``argv`` in ``cwd``, or None.
+
+        Only requests for the default :attr:`shell_command` in the default
+        directory can be served from the pool. Override this together with
+        :meth:`pool_command` to serve others, using :meth:`pop_pooled` to
+        take a terminal. The pool is topped up again in the background.
+        """
+        if not self.pool_size or argv != self.shell_command or cwd is not None:
+            return None
+        term = self.pop_pooled()
+        self.fill_pool()
+        return term
+
+    async def take_pooled_async(self, argv, cwd):
+        """Like :meth:`take_pooled`, for :meth:`new_terminal_async`.
+
+        Override this instead when picking a pooled terminal means waiting
+        for something, such as another process, so the wait doesn't block
+        the event loop.
+        """
+        return self.take_pooled(argv, cwd)
+
+    def pop_pooled(self):
+        """Take a live terminal from the pool, or None if it is empty.
+
+        Counts a hit or a miss in :attr:`pool_stats`, and discards pooled
+        terminals that have exited, counting them as ``expired``.
+        """
+        while self.pool:
+            term = self.pool.popleft()
+            if term.ptyproc.isalive():
+                self.pool_stats['hits'] += 1
+                return term
+            self.pool_stats['expired'] += 1
+            self._discard_pooled(term)
+        self.pool_stats['misses'] += 1
+        return None
+
+    def fill_pool(self):
+        """Start terminals in the background until the pool is full.
+
+        This happens as terminals are taken from the pool; call it once at
+        startup to have the pool ready for the first users.
+        """
+        loop = IOLoop.current()
+        while len(self.pool) + self._pool_pending < self.pool_size:
+            self._pool_pending += 1
+            loop.add_future(self.spawn_pooled(), self._on_pooled)
+
+    def spawn_pooled(self):
+        """Start a terminal for the pool, returning a future for it.
+
+        Processes are started one at a time on a background thread, so
+        filling the pool doesn't hold up the event loop.
+        """
+        if self._pool_executor is None:
+            self._pool_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='terminado-pool')
+        env = self.make_term_env(**self.term_settings)
+        return self._pool_executor.submit(
+            self.make_terminal, self.pool_command(), env, None)
+
+    def _on_pooled(self, future):
+        self._pool_pending -= 1
+        try:
+            term = future.result()
+        except Exception:
+            # Not retried until the next terminal is taken from the pool.
+            self.log.exception("Could not start a terminal for the pool")
+            return
+        if len(self.pool) >= self.pool_size:
+            # The pool has been drained meanwhile.
+            self._discard_pooled(term)
+            return
+        self.pool.append(term)
+
+    def discard_pooled(self, term):
+        """Dispose of a pooled terminal that will not be handed out.
+
+        Overrides may be coroutines; they are run in the background.
+        """
+        term.close()
+        term.scrollback.close()
+
+    def _discard_pooled(self, term):
+        # Returns a future if discard_pooled() is asynchronous, else None.
+        result = self.discard_pooled(term)
+        if result is None:
+            return None
+        future = asyncio.ensure_future(result)
+        IOLoop.current().add_future(future, self._on_discarded)
+        return future
+
+    def _on_discarded(self, future):
+        try:
+            future.result()
+        except Exception:
+            self.log.exception("Could not discard a pooled terminal")
+
+    async def drain_pool(self):
+        """Stop pooling terminals, and end those already in the pool."""
+        self.pool_size = 0
+        terms = list(self.pool)
+        self.pool.clear()
+        if terms:
+            await asyncio.gather(*(term.terminate(force=True) for term in terms))
+        discards = [self._discard_pooled(term) for term in terms]
+        discards = [future for future in discards if future is not None]
+        if discards:
+            # Failures are logged by _on_discarded
+            await asyncio.gather(*discards, return_exceptions=True)
+        if self._pool_executor is not None:
+            self._pool_executor.shutdown(wait=False)
+            self._pool_executor = None
+
     def start_reading(self, ptywclients):
         """Connect a terminal to the tornado event loop to read data from it."""
         fd = ptywclients.ptyproc.fd
         self.ptys_by_fd[fd] = ptywclients
+        if self.nonblocking_read:
+            ptywclients.set_nonblocking()
+        self.configure_terminal(ptywclients)
         loop = IOLoop.current()
         loop.add_handler(fd, self.pty_read, loop.READ)
 
+    def configure_terminal(self, ptywclients):
+        """Apply this manager's output settings to a new terminal."""
+        ptywclients.flush_interval = self.output_flush_interval
+        ptywclients.flush_size = self.output_flush_size
+        ptywclients.preopen_buffer.maxsize = self.preopen_buffer_size
+        if self.screen_model:
+            ptywclients.enable_screen()
+        ptywclients.scrollback.memory_limit = self.scrollback_memory
+        ptywclients.scrollback.spill_dir = self.scrollback_dir
+        ptywclients.grace_periods.update(self.terminate_grace_periods)
+        ptywclients.input_buffer_size = self.input_buffer_size
+        ptywclients.writable_callback = self.update_events
+        if self.audit_log is not None and self.audit_log.output:
+            ptywclients.audit_log = self.audit_log
+        ptywclients.search_index = self.search_index
+        if self.recording_dir is not None and ptywclients.recorder is None:
+            rows, cols = ptywclients.ptyproc.getwinsize()
+            ptywclients.recorder = Recorder(self.recording_path(ptywclients),
+                                            rows, cols,
+                                            self.recording_index_interval)
+
+    def recording_path(self, ptywclients):
+        """Where to record a terminal's session, with ``recording_dir`` set.
+
+        Recordings are named after the terminal's owner, or its name, and
+        when it started.
+        """
+        label = (ptywclients.owner or getattr(ptywclients, 'term_name', None)
+                 or 'terminal')
+        return os.path.join(self.recording_dir,
+                            recording_name(label, ptywclients.ptyproc.pid))
+
+    def pause_reading(self, ptywclients, client):
+        """Stop reading a terminal's output on behalf of ``client``.
+
+        ``client`` may be any hashable token identifying who paused it, such
+        as :data:`FLOW_CONTROL`.
+
+        Reading resumes once every client that paused it has called
+        :meth:`resume_reading`. Meanwhile the kernel's pty buffer fills up
+        and the program in the terminal blocks on its writes.
+        """
+        paused = bool(ptywclients.paused_by)
+        ptywclients.paused_by.add(client)
+        if not paused:
+            self.update_events(ptywclients)
+
+    def resume_reading(self, ptywclients, client):
+        """Undo a :meth:`pause_reading` by ``client``."""
+        if client not in ptywclients.paused_by:
+            return
+        ptywclients.paused_by.discard(client)
+        if not ptywclients.paused_by:
+            self.update_events(ptywclients)
+
+    def update_events(self, ptywclients):
+        """Watch a terminal's pty for output, unless reading is paused, and
+        for room for more input while it has some waiting."""
+        fd = ptywclients.ptyproc.fd
+        if fd not in self.ptys_by_fd:
+            return
+        events = 0 if ptywclients.paused_by else IOLoop.READ
+        if ptywclients.waiting_writable:
+            events |= IOLoop.WRITE
+        IOLoop.current().update_handler(fd, events)
+
+    def update_flow_control(self, ptywclients):
+        """Pause or resume reading a terminal as its clients' backlogs change.
+
+        With :attr:`flow_control` on, a terminal is read only while at least
+        one client can take more output (or none is attached, in which case
+        output goes to the preopen buffer).
+        """
+        if not self.flow_control:
+            return
+        clients = ptywclients.clients
+        if clients and all(client.saturated for client in clients):
+            if FLOW_CONTROL not in ptywclients.paused_by:
+                self.backpressure_stats['flow_control'] += 1
+                self.pause_reading(ptywclients, FLOW_CONTROL)
+        else:
+            self.resume_reading(ptywclients, FLOW_CONTROL)
+
     def on_eof(self, ptywclients):
         """Called when the pty has closed.
         """
-        # Stop trying to read from that terminal
+        self.stop_reading(ptywclients)
+
+        # This closes the fd, and should result in the process being reaped.
+        ptywclients.close()
+        ptywclients.scrollback.close()
+
+    def stop_reading(self, ptywclients):
+        """Disconnect a terminal from the event loop."""
         fd = ptywclients.ptyproc.fd
         self.log.info("EOF on FD %d; stopping reading", fd)
         del self.ptys_by_fd[fd]
         IOLoop.current().remove_handler(fd)
 
-        # This closes the fd, and should result in the process being reaped.
-        ptywclients.ptyproc.close()
-
     def pty_read(self, fd, events=None):
-        """Called by the event loop when there is pty data ready to read."""
-        # prevent blocking on fd
-        if not _poll(fd, timeout=0.1):  # 100ms
-            self.log.debug(f"Spurious pty_read() on fd {fd}")
-            return
+        """Called by the event loop when there is pty data ready to read,
+        or room to write input that is waiting."""
         ptywclients = self.ptys_by_fd[fd]
-        try:
-            s = ptywclients.ptyproc.read(65536)
-            client_list = ptywclients.clients
-            ptywclients.read_buffer.append(s)
-            if not client_list:
-                # No one to consume our output: buffer it.
-                ptywclients.preopen_buffer.append(s)
+        if events is not None and events & IOLoop.WRITE:
+            ptywclients.write_input()
+            if not events & IOLoop.READ:
                 return
-            for client in ptywclients.clients:
-                client.on_pty_read(s)
+        try:
+            if ptywclients.nonblocking:
+                s = ptywclients.read_available(self.max_read_size)
+                if not s:
+                    self.log.debug(f"Spurious pty_read() on fd {fd}")
+                    return
+            else:
+                # prevent blocking on fd
+                if not _poll(fd, timeout=0.1):  # 100ms
+                    self.log.debug(f"Spurious pty_read() on fd {fd}")
+                    return
+                s = ptywclients.read(65536)
+            ptywclients.on_output(s)
         except EOFError:
+            ptywclients.flush()
             self.on_eof(ptywclients)
             for client in ptywclients.clients:
                 client.on_pty_died()
@@ -254,21 +1090,41 @@ class TermManagerBase(object):
         """
         raise NotImplementedError
 
+    async def get_terminal_async(self, url_component=None):
+        """What :class:`TermSocket` calls to get its terminal.
+
+        This calls :meth:`get_terminal`. Override it instead to start
+        terminals without blocking the event loop, e.g. with
+        :meth:`new_terminal_async`.
+        """
+        return self.get_terminal(url_component)
+
     def client_disconnected(self, websocket):
         """Override this to e.g. kill terminals on client disconnection.
         """
         pass
 
     async def shutdown(self):
+        await self.drain_pool()
+        if self._spawn_executor is not None:
+            self._spawn_executor.shutdown(wait=False)
+            self._spawn_executor = None
         await self.kill_all()
+        if self.audit_log is not None:
+            self.audit_log.close()
 
     async def kill_all(self):
+        terms = list(self.ptys_by_fd.values())
         futures = []
-        for term in self.ptys_by_fd.values():
+        for term in terms:
             futures.append(term.terminate(force=True))
         # wait for futures to finish
         if futures:
             await asyncio.gather(*futures)
+        # Don't leave their EOFs to an event loop that may be about to close
+        for term in terms:
+            if self.ptys_by_fd.get(term.ptyproc.fd) is term:
+                self.on_eof(term)
 
 
 class SingleTermManager(TermManagerBase):
@@ -329,16 +1185,68 @@ class NamedTermManager(TermManagerBase):
     """Share terminals between websockets connected to the same endpoint.
     """
 
+    #: Seconds over which output is gathered into one ``activity`` event;
+    #: see :meth:`subscribe`.
+    activity_interval = 1.0
+
     def __init__(self, max_terminals=None, **kwargs):
         super(NamedTermManager, self).__init__(**kwargs)
         self.max_terminals = max_terminals
         self.terminals = {}
+        # Names given to terminals still being started by
+        # new_named_terminal_async(), with futures done once they have
+        self._starting = {}
+        self._subscribers = []
+        # Terminals with output since the last activity event
+        self._active = set()
+        self._activity_handle = None
+
+    def subscribe(self, callback):
+        """Call ``callback(event, data)`` as the set of terminals changes.
+
+        Events are ``"add"`` and ``"remove"`` with a terminal name, and
+        ``"activity"`` with a list of the names of terminals that have
+        produced output, sent at most once per :attr:`activity_interval`.
+        Only changes are reported; :attr:`terminals` has the current state.
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+        if not self._subscribers and self._activity_handle is not None:
+            IOLoop.current().remove_timeout(self._activity_handle)
+            self._activity_handle = None
+            self._active.clear()
+
+    def _emit(self, event, data):
+        for callback in list(self._subscribers):
+            callback(event, data)
+
+    def _note_activity(self, ptywclients):
+        if not self._subscribers or ptywclients.term_name in self._active:
+            return
+        self._active.add(ptywclients.term_name)
+        if self._activity_handle is None:
+            self._activity_handle = IOLoop.current().call_later(
+                self.activity_interval, self._send_activity)
+
+    def _send_activity(self):
+        self._activity_handle = None
+        names = sorted(name for name in self._active if name in self.terminals)
+        self._active.clear()
+        if names:
+            self._emit('activity', names)
+
+    def configure_terminal(self, ptywclients):
+        super(NamedTermManager, self).configure_terminal(ptywclients)
+        ptywclients.activity_callback = self._note_activity
 
     def get_terminal(self, term_name):
         assert term_name is not None
 
         if term_name in self.terminals:
             return self.terminals[term_name]
+        self._check_not_starting(term_name)
 
         if self.max_terminals and len(self.terminals) >= self.max_terminals:
             raise MaxTerminalsReached(self.max_terminals)
@@ -346,30 +1254,168 @@ class NamedTermManager(TermManagerBase):
         # Create new terminal
         self.log.info("New terminal with specified name: %s", term_name)
         term = self.new_terminal()
-        term.term_name = term_name
-        self.terminals[term_name] = term
-        self.start_reading(term)
+        self._add_terminal(term_name, term)
         return term
 
+    async def get_terminal_async(self, term_name):
+        # One being started by new_named_terminal_async() will do.
+        while term_name in self._starting:
+            await asyncio.wait([self._starting[term_name]])
+        if term_name in self.terminals:
+            return self.terminals[term_name]
+
+        if self.max_terminals and (len(self.terminals) + len(self._starting)
+                                   >= self.max_terminals):
+            raise MaxTerminalsReached(self.max_terminals)
+
+        self.log.info("New terminal with specified name: %s", term_name)
+        name, term = await self.new_named_terminal_async(name=term_name)
+        return term
+
+    def _check_not_starting(self, name):
+        if name in self._starting:
+            # Starting another would leave two terminals with the name, and
+            # one of them killed with the user's first keystrokes.
+            raise RuntimeError("Terminal %s is still starting; use "
+                               "get_named_terminal_async() to wait for it"
+                               % name)
+
     name_template = "%d"
 
     def _next_available_name(self):
         for n in itertools.count(start=1):
             name = self.name_template % n
-            if name not in self.terminals:
+            if name not in self.terminals and name not in self._starting:
                 return name
 
     def new_named_terminal(self, **kwargs):
+        """Start a terminal, returning ``(name, terminal)``.
+
+        ``name`` is chosen with :attr:`name_template` unless given, and
+        ``owner`` is recorded for :meth:`sessions`; other keyword arguments
+        are passed to :meth:`new_terminal`.
+        """
+        owner = kwargs.pop('owner', None)
         if 'name' in kwargs:
             name = kwargs['name']
         else:
             name = self._next_available_name()
         term = self.new_terminal(**kwargs)
         self.log.info("New terminal with automatic name: %s", name)
+        self._add_terminal(name, term, owner)
+        return name, term
+
+    async def new_named_terminal_async(self, **kwargs):
+        """Like :meth:`new_named_terminal`, without blocking the event loop.
+
+        The terminal is only read from once its process has started.
+        """
+        owner = kwargs.pop('owner', None)
+        if 'name' in kwargs:
+            name = kwargs['name']
+        else:
+            name = self._next_available_name()
+        started = self._starting[name] = asyncio.get_event_loop().create_future()
+        try:
+            term = await self.new_terminal_async(**kwargs)
+        finally:
+            if self._starting.get(name) is started:
+                del self._starting[name]
+            started.set_result(None)
+        self.log.info("New terminal with automatic name: %s", name)
+        self._add_terminal(name, term, owner)
+        return name, term
+
+    def get_named_terminal(self, name, **kwargs):
+        """Return the running terminal called ``name``, starting it if need be.
+
+        Unlike :meth:`new_named_terminal`, asking again for the same name,
+        as on every reload of a page, gives the same terminal for as long as
+        its process runs. Keyword arguments are used to start a new one.
+
+        Raises :exc:`RuntimeError` if :meth:`get_named_terminal_async` is
+        still starting a terminal of that name.
+        """
+        term = self._running_terminal(name)
+        if term is None:
+            self._check_not_starting(name)
+            name, term = self.new_named_terminal(name=name, **kwargs)
+        return term
+
+    async def get_named_terminal_async(self, name, **kwargs):
+        """Like :meth:`get_named_terminal`, without blocking the event loop.
+
+        Concurrent calls for a name that isn't running yet start only one
+        terminal between them.
+        """
+        while name in self._starting:
+            await asyncio.wait([self._starting[name]])
+        term = self._running_terminal(name)
+        if term is None:
+            name, term = await self.new_named_terminal_async(name=name, **kwargs)
+        return term
+
+    def _running_terminal(self, name):
+        term = self.terminals.get(name)
+        if term is not None and not term.ptyproc.isalive():
+            # Exited, but we haven't read to the end of its output yet
+            self._reap(term)
+            term = None
+        return term
+
+    def _reap(self, term):
+        """Stop reading a terminal and close it, as if its pty had ended."""
+        term.flush()
+        self.on_eof(term)
+        for client in term.clients:
+            client.on_pty_died()
+
+    def _add_terminal(self, name, term, owner=None):
+        old = self.terminals.get(name)
+        if old is not None and old is not term:
+            # Replaced by name; nothing could reach it any more
+            self.log.info("Closing terminal %s replaced by a new one", name)
+            self._reap(old)
         term.term_name = name
+        term.owner = owner
+        # A pooled terminal was started before anyone asked for it
+        term.created = time.time()
         self.terminals[name] = term
         self.start_reading(term)
-        return name, term
+        self._emit('add', name)
+
+    def session_info(self, name):
+        """Describe a terminal for listings, as a JSON-serialisable dict.
+
+        Times are seconds since the epoch.
+        """
+        term = self.terminals[name]
+        return {
+            'name': name,
+            'owner': term.owner,
+            'created': term.created,
+            'last_activity': term.last_activity,
+            'clients': len(term.clients),
+        }
+
+    def sessions(self, owner=None, search=None, offset=0, limit=None):
+        """List terminals by name, a page at a time.
+
+        Only terminals belonging to ``owner``, or whose name or owner
+        contains ``search``, are included, if those are given. Returns the
+        number of terminals that match and the :meth:`session_info` of those
+        from ``offset`` up to ``limit`` of them.
+        """
+        names = []
+        for name, term in self.terminals.items():
+            if owner is not None and term.owner != owner:
+                continue
+            if search and search not in name and search not in (term.owner or ''):
+                continue
+            names.append(name)
+        names.sort()
+        end = None if limit is None else offset + limit
+        return len(names), [self.session_info(name) for name in names[offset:end]]
 
     def kill(self, name, sig=signal.SIGTERM):
         term = self.terminals[name]
@@ -383,8 +1429,13 @@ class NamedTermManager(TermManagerBase):
         super(NamedTermManager, self).on_eof(ptywclients)
         name = ptywclients.term_name
         self.log.info("Terminal %s closed", name)
-        self.terminals.pop(name, None)
+        # The name may have been given to another terminal since
+        if self.terminals.get(name) is ptywclients:
+            del self.terminals[name]
+            self._emit('remove', name)
 
     async def kill_all(self):
         await super().kill_all()
+        for name in self.terminals:
+            self._emit('remove', name)
         self.terminals = {}
@@ -0,0 +1,527 @@
+"""A small VT100/xterm screen model, for snapshotting what a terminal shows.
+
+It understands the subset of xterm control sequences that shells, tmux and
+curses programs commonly emit: cursor movement, erasing, scroll regions,
+insert/delete, SGR attributes, the alternate screen and a handful of
+private modes. Anything else is parsed and ignored. Characters are assumed
+to be one cell wide.
+"""
+# Copyright (c) Jupyter Development Team
+# Distributed under the terms of the Simplified BSD License.
+
+from __future__ import absolute_import, print_function
+
+import itertools
+import re
+
+_TOKEN = re.compile(r"""
+      (?P<text>[^\x00-\x1f\x7f]+)
+    | \x1b\[(?P<csi_params>[\x30-\x3f]*)(?P<csi_inter>[\x20-\x2f]*)(?P<csi_final>[\x40-\x7e])
+    | \x1b\](?P<osc>[^\x07\x1b]*)(?:\x07|\x1b\\)
+    | \x1b[PX^_][^\x1b]*\x1b\\
+    | \x1b(?P<esc_inter>[\x20-\x2f]*)(?P<esc_final>[0-9:;<=>?@A-OQ-WYZ\\`a-z{|}~])
+    | (?P<ctrl>[\x00-\x1a\x1c-\x1f\x7f])
+""", re.VERBOSE)
+
+# What the tail of a chunk looks like when an escape sequence is split
+# across reads.
+_INCOMPLETE = re.compile(r"""
+    \x1b(?: \[[\x30-\x3f]*[\x20-\x2f]*
+          | \][^\x07\x1b]*\x1b?
+          | [PX^_][^\x1b]*\x1b?
+          | [\x20-\x2f]*
+        )?\Z
+""", re.VERBOSE)
+
+# Longest partial sequence kept between feeds; longer ones are garbage.
+_MAX_PENDING = 4096
+
+# DEC special graphics (ESC ( 0), used for line drawing.
+_DEC_GRAPHICS = str.maketrans(
+    "`abcdefghijklmnopqrstuvwxyz{|}~",
+    "◆▒␉␌␍␊°±␤␋┘"
+    "┐┌└┼⎺⎻─⎼⎽├┤"
+    "┴┬│≤≥π≠£·")
+
+# Private modes a freshly attached client has to be told about.
+_REPLAYED_MODES = (1, 7, 25, 1000, 1002, 1003, 1005, 1006, 1015, 2004)
+_ALT_SCREEN_MODES = (47, 1047, 1049)
+
+_DEFAULT_PEN = ((), None, None)
+
+# Shared by all screens, so a version number is never reused, even by a
+# new screen under the same terminal name.
+_versions = itertools.count(1)
+
+
+def _sgr_sequence(pen):
+    """The SGR sequence that selects ``pen`` from any previous state."""
+    flags, fg, bg = pen
+    parts = ['0']
+    parts.extend(flags)
+    if fg:
+        parts.append(fg)
+    if bg:
+        parts.append(bg)
+    return '\x1b[%sm' % ';'.join(parts)
+
+
+class Screen(object):
+    """The visible state of a terminal, fed with the text written to it.
+
+    :attr:`version` goes up every time :meth:`feed` or :meth:`resize` is
+    called, so callers can cheaply tell whether anything may have changed.
+    Version numbers are unique across all screens.
+    """
+
+    def __init__(self, rows=24, cols=80):
+        self.rows = rows
+        self.cols = cols
+        self.version = next(_versions)
+        self.title = None
+        self._pending = ''
+        self.reset()
+
+    def reset(self):
+        """Return to the power-on state (RIS)."""
+        self.chars = [[' '] * self.cols for _ in range(self.rows)]
+        self.attrs = [[_DEFAULT_PEN] * self.cols for _ in range(self.rows)]
+        self.x = self.y = 0
+        self.pen = _DEFAULT_PEN
+        self.wrap_pending = False
+        self.top = 0
+        self.bottom = self.rows - 1
+        self.modes = {7: True, 25: True}
+        self.keypad_application = False
+        self.charsets = ['B', 'B']
+        self.shift_out = False
+        self.saved_cursor = None
+        self._main = None         # the normal screen while on the alternate
+
+    # -- Feeding -----------------------------------------------------------
+
+    def feed(self, text):
+        """Apply text written by the program to the screen."""
+        self.version = next(_versions)
+        if self._pending:
+            text = self._pending + text
+            self._pending = ''
+        pos = 0
+        end = len(text)
+        match = _TOKEN.match
+        while pos < end:
+            m = match(text, pos)
+            if m is None:
+                # A lone ESC that doesn't start a sequence we know.
+                if _INCOMPLETE.match(text, pos):
+                    if end - pos <= _MAX_PENDING:
+                        self._pending = text[pos:]
+                    return
+                pos += 1
+                continue
+            pos = m.end()
+            kind = m.lastgroup
+            if kind == 'text':
+                self._print(m.group('text'))
+            elif kind == 'ctrl':
+                self._control(m.group('ctrl'))
+            elif kind == 'csi_final':
+                self._csi(m.group('csi_params'), m.group('csi_inter'),
+                          m.group('csi_final'))
+            elif kind == 'esc_final':
+                self._esc(m.group('esc_inter'), m.group('esc_final'))
+            elif m.group('osc') is not None:
+                self._osc(m.group('osc'))
+            # DCS and friends are dropped.
+
+    def _print(self, text):
+        charset = self.charsets[1 if self.shift_out else 0]
+        if charset == '0':
+            text = text.translate(_DEC_GRAPHICS)
+        cols = self.cols
+        while text:
+            if self.wrap_pending:
+                self.wrap_pending = False
+                if self.modes.get(7):
+                    self.x = 0
+                    self._index()
+            n = min(cols - self.x, len(text))
+            x, y = self.x, self.y
+            self.chars[y][x:x + n] = text[:n]
+            self.attrs[y][x:x + n] = [self.pen] * n
+            text = text[n:]
+            if x + n >= cols:
+                self.x = cols - 1
+                self.wrap_pending = True
+                if not self.modes.get(7) and text:
+                    # No autowrap: the rest overwrites the last column.
+                    self.chars[y][cols - 1] = text[-1]
+                    text = ''
+            else:
+                self.x = x + n
+
+    def _control(self, char):
+        if char == '\r':
+            self.x = 0
+            self.wrap_pending = False
+        elif char in '\n\x0b\x0c':
+            self._index()
+        elif char == '\x08':
+            if self.x > 0:
+                self.x -= 1
+            self.wrap_pending = False
+        elif char == '\t':
+            self.x = min(self.cols - 1, (self.x // 8 + 1) * 8)
+        elif char == '\x0e':
+            self.shift_out = True
+        elif char == '\x0f':
+            self.shift_out = False
+
+    def _esc(self, inter, final):
+        if inter in ('(', ')'):
+            self.charsets[0 if inter == '(' else 1] = final
+        elif inter:
+            pass
+        elif final == '7':
+            self._save_cursor()
+        elif final == '8':
+            self._restore_cursor()
+        elif final == 'D':
+            self._index()
+        elif final == 'E':
+            self.x = 0
+            self._index()
+        elif final == 'M':
+            self._reverse_index()
+        elif final == 'c':
+            self.reset()
+        elif final == '=':
+            self.keypad_application = True
+        elif final == '>':
+            self.keypad_application = False
+
+    def _osc(self, data):
+        code, _, value = data.partition(';')
+        if code in ('0', '2'):
+            self.title = value
+
+    def _csi(self, params, inter, final):
+        private = params[:1] in ('?', '>', '=', '<')
+        if private:
+            marker, params = params[0], params[1:]
+        else:
+            marker = ''
+        if inter:
+            return
+        args = [int(p) if p.isdigit() else 0
+                for p in params.split(';')] if params else []
+
+        def arg(i=0, default=1):
+            if i < len(args) and args[i]:
+                return args[i]
+            return default
+
+        if marker:
+            if marker == '?' and final in 'hl':
+                for mode in args:
+                    self._set_private_mode(mode, final == 'h')
+            return
+
+        self.wrap_pending = False
+        if final == 'm':
+            self._sgr(args)
+        elif final in 'Hf':
+            self._move_to(arg(0) - 1, arg(1) - 1)
+        elif final == 'A':
+            self.y = max(self.top if self.y >= self.top else 0, self.y - arg())
+        elif final == 'B':
+            self.y = min(self.bottom if self.y <= self.bottom else self.rows - 1,
+                         self.y + arg())
+        elif final in 'Ca':
+            self.x = min(self.cols - 1, self.x + arg())
+        elif final == 'D':
+            self.x = max(0, self.x - arg())
+        elif final == 'E':
+            self.x = 0
+            self.y = min(self.rows - 1, self.y + arg())
+        elif final == 'F':
+            self.x = 0
+            self.y = max(0, self.y - arg())
+        elif final in 'G`':
+            self.x = min(self.cols - 1, arg() - 1)
+        elif final == 'd':
+            self.y = min(self.rows - 1, arg() - 1)
+        elif final == 'J':
+            self._erase_display(arg(0, 0))
+        elif final == 'K':
+            self._erase_line(arg(0, 0))
+        elif final == 'X':
+            n = min(arg(), self.cols - self.x)
+            self._blank(self.y, self.x, self.x + n)
+        elif final == 'P':
+            self._delete_chars(arg())
+        elif final == '@':
+            self._insert_chars(arg())
+        elif final == 'L':
+            self._insert_lines(arg())
+        elif final == 'M':
+            self._delete_lines(arg())
+        elif final == 'S':
+            self._scroll_up(self.top, self.bottom, arg())
+        elif final == 'T':
+            self._scroll_down(self.top, self.bottom, arg())
+        elif final == 'b':
+            # REP: repeat the preceding character
+            x = self.x - 1 if self.x > 0 else 0
+            self._print(self.chars[self.y][x] * arg())
+        elif final == 'r':
+            top, bottom = arg(0) - 1, arg(1, self.rows) - 1
+            if 0 <= top < bottom < self.rows:
+                self.top, self.bottom = top, bottom
+                self._move_to(0, 0)
+        elif final == 's':
+            self._save_cursor()
+        elif final == 'u':
+            self._restore_cursor()
+
+    def _set_private_mode(self, mode, on):
+        if mode in _ALT_SCREEN_MODES:
+            if on and self._main is None:
+                if mode == 1049:
+                    self._save_cursor()
+                self._main = (self.chars, self.attrs)
+                self.chars = [[' '] * self.cols for _ in range(self.rows)]
+                self.attrs = [[_DEFAULT_PEN] * self.cols
+                              for _ in range(self.rows)]
+            elif not on and self._main is not None:
+                self.chars, self.attrs = self._main
+                self._main = None
+                if mode == 1049:
+                    self._restore_cursor()
+        else:
+            self.modes[mode] = on
+
+    def _sgr(self, args):
+        flags, fg, bg = self.pen
+        flags = set(flags)
+        if not args:
+            args = [0]
+        i = 0
+        while i < len(args):
+            a = args[i]
+            if a == 0:
+                flags, fg, bg = set(), None, None
+            elif a in (1, 2, 3, 4, 5, 7, 8, 9):
+                flags.add(str(a))
+            elif a == 22:
+                flags -= {'1', '2'}
+            elif a in (23, 24, 25, 27, 28, 29):
+                flags.discard(str(a - 20))
+            elif 30 <= a <= 37 or 90 <= a <= 97:
+                fg = str(a)
+            elif 40 <= a <= 47 or 100 <= a <= 107:
+                bg = str(a)
+            elif a == 39:
+                fg = None
+            elif a == 49:
+                bg = None
+            elif a in (38, 48):
+                # Extended colour: 38;5;n or 38;2;r;g;b
+                if i + 1 < len(args) and args[i + 1] == 5:
+                    color = ';'.join(map(str, args[i:i + 3]))
+                    i += 2
+                elif i + 1 < len(args) and args[i + 1] == 2:
+                    color = ';'.join(map(str, args[i:i + 5]))
+                    i += 4
+                else:
+                    color = None
+                if a == 38:
+                    fg = color
+                else:
+                    bg = color
+            i += 1
+        self.pen = (tuple(sorted(flags)), fg, bg)
+
+    # -- Cursor and scrolling ----------------------------------------------
+
+    def _move_to(self, y, x):
+        self.y = max(0, min(self.rows - 1, y))
+        self.x = max(0, min(self.cols - 1, x))
+        self.wrap_pending = False
+
+    def _save_cursor(self):
+        self.saved_cursor = (self.x, self.y, self.pen, self.wrap_pending,
+                             list(self.charsets), self.shift_out)
+
+    def _restore_cursor(self):
+        if self.saved_cursor is None:
+            self._move_to(0, 0)
+            self.pen = _DEFAULT_PEN
+            return
+        x, y, self.pen, self.wrap_pending, charsets, self.shift_out = \
+            self.saved_cursor
+        self.charsets = list(charsets)
+        self._move_to(y, x)
+
+    def _index(self):
+        if self.y == self.bottom:
+            self._scroll_up(self.top, self.bottom, 1)
+        elif self.y < self.rows - 1:
+            self.y += 1
+
+    def _reverse_index(self):
+        if self.y == self.top:
+            self._scroll_down(self.top, self.bottom, 1)
+        elif self.y > 0:
+            self.y -= 1
+
+    def _blank_pen(self):
+        # Erased cells keep the background colour (xterm's bce).
+        return ((), None, self.pen[2]) if self.pen[2] else _DEFAULT_PEN
+
+    def _blank_row(self):
+        return [' '] * self.cols, [self._blank_pen()] * self.cols
+
+    def _scroll_up(self, top, bottom, n):
+        n = min(n, bottom - top + 1)
+        for _ in range(n):
+            del self.chars[top]
+            del self.attrs[top]
+            chars, attrs = self._blank_row()
+            self.chars.insert(bottom, chars)
+            self.attrs.insert(bottom, attrs)
+
+    def _scroll_down(self, top, bottom, n):
+        n = min(n, bottom - top + 1)
+        for _ in range(n):
+            del self.chars[bottom]
+            del self.attrs[bottom]
+            chars, attrs = self._blank_row()
+            self.chars.insert(top, chars)
+            self.attrs.insert(top, attrs)
+
+    def _insert_lines(self, n):
+        if self.top <= self.y <= self.bottom:
+            self._scroll_down(self.y, self.bottom, n)
+            self.x = 0
+
+    def _delete_lines(self, n):
+        if self.top <= self.y <= self.bottom:
+            self._scroll_up(self.y, self.bottom, n)
+            self.x = 0
+
+    # -- Erasing -------------------------------------------------------------
+
+    def _blank(self, y, start, end):
+        n = end - start
+        if n > 0:
+            self.chars[y][start:end] = ' ' * n
+            self.attrs[y][start:end] = [self._blank_pen()] * n
+
+    def _erase_line(self, how):
+        if how == 0:
+            self._blank(self.y, self.x, self.cols)
+        elif how == 1:
+            self._blank(self.y, 0, self.x + 1)
+        elif how == 2:
+            self._blank(self.y, 0, self.cols)
+
+    def _erase_display(self, how):
+        if how == 0:
+            self._erase_line(0)
+            rows = range(self.y + 1, self.rows)
+        elif how == 1:
+            self._erase_line(1)
+            rows = range(0, self.y)
+        elif how == 2:
+            rows = range(self.rows)
+        else:
+            return
+        for y in rows:
+            self._blank(y, 0, self.cols)
+
+    def _delete_chars(self, n):
+        row, attrs = self.chars[self.y], self.attrs[self.y]
+        n = min(n, self.cols - self.x)
+        del row[self.x:self.x + n]
+        del attrs[self.x:self.x + n]
+        row.extend(' ' * n)
+        attrs.extend([self._blank_pen()] * n)
+
+    def _insert_chars(self, n):
+        row, attrs = self.chars[self.y], self.attrs[self.y]
+        n = min(n, self.cols - self.x)
+        row[self.x:self.x] = ' ' * n
+        attrs[self.x:self.x] = [self._blank_pen()] * n
+        del row[self.cols:]
+        del attrs[self.cols:]
+
+    # -- Size ----------------------------------------------------------------
+
+    def resize(self, rows, cols):
+        """Change the screen size, keeping the top left of the contents."""
+        if (rows, cols) == (self.rows, self.cols):
+            return
+        self.version = next(_versions)
+        screens = [(self.chars, self.attrs)]
+        if self._main is not None:
+            screens.append(self._main)
+        for chars, attrs in screens:
+            del chars[rows:]
+            del attrs[rows:]
+            for row, row_attrs in zip(chars, attrs):
+                del row[cols:]
+                del row_attrs[cols:]
+                row.extend(' ' * (cols - len(row)))
+                row_attrs.extend([_DEFAULT_PEN] * (cols - len(row_attrs)))
+            while len(chars) < rows:
+                chars.append([' '] * cols)
+                attrs.append([_DEFAULT_PEN] * cols)
+        self.rows, self.cols = rows, cols
+        self.top, self.bottom = 0, rows - 1
+        self._move_to(self.y, self.x)
+
+    # -- Output --------------------------------------------------------------
+
+    def display(self):
+        """The screen's text, one string per row, trailing spaces removed."""
+        return [''.join(row).rstrip() for row in self.chars]
+
+    def snapshot(self):
+        """Escape sequences that paint this screen on a blank terminal.
+
+        The result is proportional to the screen size, not to how much
+        output produced it.
+        """
+        out = []
+        if self.title is not None:
+            out.append('\x1b]0;%s\x07' % self.title)
+        if self._main is not None:
+            out.append('\x1b[?1049h')
+        out.append('\x1b[0m\x1b[H\x1b[2J')
+        pen = _DEFAULT_PEN
+        for y in range(self.rows):
+            chars, attrs = self.chars[y], self.attrs[y]
+            # Skip the trailing run of default blanks.
+            end = self.cols
+            while end and chars[end - 1] == ' ' and attrs[end - 1] == _DEFAULT_PEN:
+                end -= 1
+            if not end:
+                continue
+            out.append('\x1b[%d;1H' % (y + 1))
+            for x in range(end):
+                if attrs[x] != pen:
+                    pen = attrs[x]
+                    out.append(_sgr_sequence(pen))
+                out.append(chars[x])
+        if (self.top, self.bottom) != (0, self.rows - 1):
+            out.append('\x1b[%d;%dr' % (self.top + 1, self.bottom + 1))
+        out.append(_sgr_sequence(self.pen))
+        for mode in _REPLAYED_MODES:
+            on = self.modes.get(mode, False)
+            if on != (mode in (7, 25)):
+                out.append('\x1b[?%d%s' % (mode, 'h' if on else 'l'))
+        if self.keypad_application:
+            out.append('\x1b=')
+        out.append('\x1b[%d;%dH' % (self.y + 1, self.x + 1))
+        return ''.join(out)
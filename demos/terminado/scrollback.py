@@ -0,0 +1,125 @@
+"""Terminal output history, kept in memory up to a budget and then on disk.
+"""
+# Copyright (c) Jupyter Development Team
+# Distributed under the terms of the Simplified BSD License.
+
+from __future__ import absolute_import, print_function
+
+from collections import deque
+import mmap
+import os
+import tempfile
+
+
+class Scrollback(object):
+    """Everything a terminal has output, addressed by byte offset.
+
+    The most recent ``memory_limit`` bytes are held in memory. Older output
+    is appended to a file in ``spill_dir``, created when first needed and
+    read back through a memory map; with ``spill_dir`` None it is discarded
+    instead. Offsets count from the terminal's first byte of output, so
+    they stay valid as output moves to disk.
+    """
+
+    def __init__(self, memory_limit=262144, spill_dir=None):
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        #: Offset of the oldest byte still available.
+        self.start = 0
+        #: Offset just past the newest byte, i.e. total bytes appended.
+        self.end = 0
+        self.spill_path = None
+
+        self._chunks = deque()
+        self._memory_start = 0
+        self._memory_size = 0
+        self._file = None
+        self._file_start = 0
+        self._spilled = 0
+        self._map = None
+
+    @property
+    def memory_size(self):
+        """Bytes of history currently held in memory."""
+        return self._memory_size
+
+    def append(self, data):
+        if not data:
+            return
+        self._chunks.append(data)
+        self._memory_size += len(data)
+        self.end += len(data)
+        while self._memory_size > self.memory_limit:
+            excess = self._memory_size - self.memory_limit
+            head = self._chunks[0]
+            if len(head) <= excess:
+                self._chunks.popleft()
+                evicted = head
+            else:
+                self._chunks[0] = head[excess:]
+                evicted = head[:excess]
+            self._memory_size -= len(evicted)
+            self._memory_start += len(evicted)
+            self._evict(evicted)
+
+    def _evict(self, data):
+        if self.spill_dir is None:
+            self.start += len(data)
+            return
+        if self._file is None:
+            fd, self.spill_path = tempfile.mkstemp(
+                prefix='terminado-', suffix='.scrollback', dir=self.spill_dir)
+            self._file = os.fdopen(fd, 'ab+', buffering=0)
+            self._file_start = self.start
+        self._file.write(data)
+        self._spilled += len(data)
+
+    def _spill_view(self):
+        if self._map is None or len(self._map) < self._spilled:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        return self._map
+
+    def read(self, start, end=None):
+        """Return the output between offsets ``start`` and ``end``.
+
+        The range is clipped to what is still available (see :attr:`start`
+        and :attr:`end`).
+        """
+        start = max(start, self.start)
+        end = self.end if end is None else min(end, self.end)
+        if start >= end:
+            return b''
+        parts = []
+        if start < self._memory_start:
+            view = self._spill_view()
+            parts.append(view[start - self._file_start:
+                              min(end, self._memory_start) - self._file_start])
+        pos = self._memory_start
+        if end > pos:
+            for chunk in self._chunks:
+                chunk_end = pos + len(chunk)
+                if chunk_end > start:
+                    parts.append(chunk[max(0, start - pos):end - pos])
+                if chunk_end >= end:
+                    break
+                pos = chunk_end
+        return b''.join(parts)
+
+    def close(self):
+        """Release memory and delete the spill file."""
+        self._chunks.clear()
+        self._memory_size = 0
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            try:
+                os.unlink(self.spill_path)
+            except OSError:
+                pass
+        self.start = self._memory_start = self.end
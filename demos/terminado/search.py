@@ -0,0 +1,197 @@
+"""Searching what terminals have printed recently, by the words in it.
+"""
+# Copyright (c) Jupyter Development Team
+# Distributed under the terms of the Simplified BSD License.
+
+from __future__ import absolute_import, print_function
+
+from collections import Counter, deque
+import re
+import time
+import weakref
+
+# Escape sequences that move the cursor to another line end a line of
+# text, one that moves it right stands for spaces, and the rest, along with
+# control characters other than the line endings, are dropped.
+_ESCAPES = re.compile(rb"""
+      (?P<newline>\x1b\[[\x30-\x3f]*[\x20-\x2f]*[ABEFHdf] | [\r\x0b\x0c])
+    | (?P<space>\x1b\[[\x30-\x3f]*[\x20-\x2f]*C | \t)
+    | \x1b\[[\x30-\x3f]*[\x20-\x2f]*[\x40-\x7e]
+    | \x1b\][^\x07\x1b]*(?:\x07|\x1b\\)
+    | \x1b[PX^_][^\x1b]*\x1b\\
+    | \x1b[\x20-\x2f]*[\x30-\x7e]
+    | [\x00-\x08\x0e-\x1f\x7f]
+""", re.VERBOSE)
+
+# What the tail of a chunk looks like when an escape sequence is split
+# across reads.
+_INCOMPLETE = re.compile(rb"""
+    \x1b(?: \[[\x30-\x3f]*[\x20-\x2f]*
+          | \][^\x07\x1b]*\x1b?
+          | [PX^_][^\x1b]*\x1b?
+          | [\x20-\x2f]*
+        )?\Z
+""", re.VERBOSE)
+
+# Longest partial sequence kept between reads; longer ones are garbage.
+_MAX_PENDING = 4096
+
+_WORD = re.compile(r'\w+')
+
+
+def _replace_escape(match):
+    if match.group('newline'):
+        return b'\n'
+    if match.group('space'):
+        return b' '
+    return b''
+
+
+def words(text):
+    """The lowercased words in ``text``, as the index sees them."""
+    return _WORD.findall(text.lower())
+
+
+class _Bucket(object):
+    """The lines printed in one period of time, with a word index."""
+
+    def __init__(self, start):
+        self.start = start
+        # (time, name, owner, text), in the order printed
+        self.lines = []
+        # word -> positions in self.lines, ascending
+        self.postings = {}
+        # Lines from each terminal by id(), for the per-terminal limit
+        self.counts = Counter()
+
+    def add(self, when, name, owner, text):
+        n = len(self.lines)
+        self.lines.append((when, name, owner, text))
+        for word in set(words(text)):
+            self.postings.setdefault(word, []).append(n)
+
+
+class OutputIndex(object):
+    """An index of the lines terminals print, for finding who printed what.
+
+    Output has escape sequences stripped and is split into lines, which go
+    into a bucket per ``bucket_interval`` seconds with an inverted index of
+    their words. :meth:`search` looks words up in the buckets of the period
+    asked about, so it takes time in proportion to the matches, not to how
+    much output there was.
+
+    Memory is bounded: lines are cut to ``max_line_length`` characters,
+    a terminal gets at most ``terminal_bucket_lines`` lines in each bucket
+    (so one printing in a loop can't push everyone else out), and whole
+    buckets are dropped, oldest first, once they are more than ``max_age``
+    seconds old or there are more than ``max_lines`` lines in all. Lines
+    not indexed because of these limits are counted in :attr:`stats`.
+
+    Give it to a terminal manager as ``search_index``, and serve it with
+    :class:`~terminado.TermSearchHandler`.
+    """
+
+    def __init__(self, bucket_interval=60, max_age=3600, max_lines=200000,
+                 terminal_bucket_lines=2000, max_line_length=500):
+        self.bucket_interval = bucket_interval
+        self.max_age = max_age
+        self.max_lines = max_lines
+        self.terminal_bucket_lines = terminal_bucket_lines
+        self.max_line_length = max_line_length
+        #: How many lines were ``indexed``, ``skipped`` over the per-terminal
+        #: limit and ``evicted`` with old buckets.
+        self.stats = Counter()
+        self.line_count = 0
+        self._buckets = deque()
+        # Each terminal's partial last line, and a partial escape sequence
+        self._partial = weakref.WeakKeyDictionary()
+
+    def feed(self, terminal, data):
+        """Index the complete lines in output bytes from ``terminal``."""
+        line, pending = self._partial.get(terminal, (b'', b''))
+        data = pending + data
+        match = _INCOMPLETE.search(data)
+        pending = b''
+        if match is not None:
+            data, pending = data[:match.start()], data[match.start():]
+            if len(pending) > _MAX_PENDING:
+                pending = b''
+        lines = (line + _ESCAPES.sub(_replace_escape, data)).split(b'\n')
+        # Lines are cut short on the way in, so a long line held across
+        # reads takes no more memory than a short one.
+        line = lines.pop()[:self.max_line_length * 4]
+        self._partial[terminal] = (line, pending)
+        if lines:
+            self._add_lines(terminal, lines)
+
+    def _add_lines(self, terminal, lines):
+        now = time.time()
+        name = getattr(terminal, 'term_name', None)
+        key = id(terminal)
+        bucket = self._bucket(now)
+        for line in lines:
+            # utf-8 never has a newline or escape byte within a character,
+            # so a whole line decodes on its own.
+            text = line.decode('utf-8', 'replace').strip()
+            if not text:
+                continue
+            if bucket.counts[key] >= self.terminal_bucket_lines:
+                self.stats['skipped'] += 1
+                continue
+            bucket.counts[key] += 1
+            bucket.add(now, name, terminal.owner, text[:self.max_line_length])
+            self.line_count += 1
+            self.stats['indexed'] += 1
+        self._evict(now)
+
+    def _bucket(self, now):
+        start = now - now % self.bucket_interval
+        if not self._buckets or self._buckets[-1].start != start:
+            self._buckets.append(_Bucket(start))
+        return self._buckets[-1]
+
+    def _evict(self, now):
+        buckets = self._buckets
+        # The newest bucket, being added to, stays
+        while len(buckets) > 1 and (self.line_count > self.max_lines
+                           or buckets[0].start + self.bucket_interval
+                           < now - self.max_age):
+            bucket = buckets.popleft()
+            self.line_count -= len(bucket.lines)
+            self.stats['evicted'] += len(bucket.lines)
+
+    def search(self, query, since=None, owner=None, limit=100):
+        """Lines containing all the words in ``query``, newest first.
+
+        Returns up to ``limit`` dicts with the ``time`` a line was printed
+        (seconds since the epoch), the ``name`` and ``owner`` of the
+        terminal that printed it, and its ``line``. Case is ignored, and
+        only whole words match. ``since`` leaves out lines printed before
+        then, and ``owner`` lines from other users' terminals.
+        """
+        wanted = set(words(query))
+        results = []
+        if not wanted or limit <= 0:
+            return results
+        for bucket in reversed(self._buckets):
+            if since is not None and bucket.start + self.bucket_interval < since:
+                break
+            postings = [bucket.postings.get(word) for word in wanted]
+            if not all(postings):
+                continue
+            # Go through the lines with the rarest word, checking them for
+            # the others.
+            postings.sort(key=len)
+            for n in reversed(postings[0]):
+                when, name, line_owner, text = bucket.lines[n]
+                if since is not None and when < since:
+                    break
+                if owner is not None and line_owner != owner:
+                    continue
+                if len(wanted) > 1 and not wanted.issubset(words(text)):
+                    continue
+                results.append({'time': when, 'name': name,
+                                'owner': line_owner, 'line': text})
+                if len(results) >= limit:
+                    return results
+        return results
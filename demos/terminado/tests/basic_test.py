@@ -8,6 +8,9 @@ from __future__ import absolute_import, print_function
 
 import unittest
 from terminado import *
+import terminado.recording
+import terminado.tmux
+import terminado.websocket
 import tornado
 import tornado.httpserver
 from tornado.httpclient import HTTPError
@@ -18,7 +21,13 @@ import logging
 import json
 import os
 import re
+import shutil
 import signal
+import subprocess
+import tempfile
+import time
+import zlib
+from unittest import mock
 import pytest
 from sys import platform
 
@@ -52,7 +61,8 @@ class TestTermClient(object):
 
         response = await self.pending_read
         self.pending_read = None
-        if response:
+        if isinstance(response, str):
+            # Binary frames (bytes) are passed through as they are
             response = json.loads(response)
         return response
 
@@ -162,6 +172,8 @@ class TermTestCase(tornado.testing.AsyncHTTPTestCase):
         return tornado.web.Application([
                     (r"/new",         NewTerminalHandler),
                     (r"/named/(\w+)", TermSocket, {'term_manager': self.named_tm}),
+                    (r"/events",      TermEventSocket, {'term_manager': self.named_tm}),
+                    (r"/mux",         TermMuxSocket, {'term_manager': self.named_tm}),
                     (r"/single",      TermSocket, {'term_manager': self.single_tm}),
                     (r"/unique",      TermSocket, {'term_manager': self.unique_tm})
                 ], debug=True)
@@ -206,6 +218,77 @@ class NamedTermTests(TermTestCase):
         name = url.split('/')[2]
         self.assertIn(name, self.named_tm.terminals)
 
+    @tornado.testing.gen_test
+    async def test_new_async(self):
+        started = await asyncio.gather(
+            *(self.named_tm.new_named_terminal_async() for i in range(3)))
+        names = [name for name, term in started]
+        self.assertEqual(sorted(names), ['1', '2', '3'])
+        tms = await self.get_term_clients(['/named/' + name for name in names])
+        pids = await self.get_pids(tms)
+        self.assertEqual(pids, [term.ptyproc.pid for name, term in started])
+
+    @tornado.testing.gen_test
+    @pytest.mark.skipif('linux' not in platform, reason='It only works on Linux')
+    async def test_get_named_reuses(self):
+        def counts():
+            children = subprocess.run(['pgrep', '-P', str(os.getpid())],
+                                      stdout=subprocess.PIPE).stdout.split()
+            return len(os.listdir('/proc/self/fd')), len(children)
+
+        concurrent = await asyncio.gather(
+            *(self.named_tm.get_named_terminal_async('stu', owner='stu')
+              for i in range(5)))
+        term = concurrent[0]
+        self.assertEqual(set(concurrent), {term})
+        before = counts()
+        # Like a student holding down F5
+        for i in range(100):
+            again = await self.named_tm.get_named_terminal_async('stu', owner='stu')
+            self.assertIs(again, term)
+        self.assertEqual(counts(), before)
+        self.assertEqual(list(self.named_tm.ptys_by_fd.values()), [term])
+
+    @tornado.testing.gen_test
+    async def test_get_named_replaces_dead(self):
+        term = self.named_tm.get_named_terminal('stu')
+        term.kill(signal.SIGKILL)
+        await term.wait_exit(5)
+        # Whether or not its EOF has been read by now
+        new = self.named_tm.get_named_terminal('stu')
+        self.assertIsNot(new, term)
+        self.assertTrue(new.ptyproc.isalive())
+        self.assertEqual(list(self.named_tm.ptys_by_fd.values()), [new])
+
+    @tornado.testing.gen_test
+    async def test_socket_waits_for_starting_terminal(self):
+        release = asyncio.Event()
+        make_terminal_async = self.named_tm.make_terminal_async
+        async def slow_start(*args):
+            await release.wait()
+            return await make_terminal_async(*args)
+
+        with mock.patch.object(self.named_tm, 'make_terminal_async', slow_start):
+            starting = asyncio.ensure_future(
+                self.named_tm.get_named_terminal_async('stu'))
+            connecting = asyncio.ensure_future(self.get_term_client('/named/stu'))
+            await asyncio.sleep(0.2)
+            self.assertEqual(list(self.named_tm._starting), ['stu'])
+            with self.assertRaises(RuntimeError):
+                self.named_tm.get_named_terminal('stu')
+            release.set()
+            term = await starting
+            tm = await connecting
+        self.assertEqual(await tm.read_msg(), ['setup', {}])
+        self.assertEqual(list(self.named_tm.ptys_by_fd.values()), [term])
+        self.assertEqual(len(term.clients), 1)
+
+    def test_new_named_closes_replaced(self):
+        name, old = self.named_tm.new_named_terminal(name='stu')
+        name, new = self.named_tm.new_named_terminal(name='stu')
+        self.assertEqual(list(self.named_tm.ptys_by_fd.values()), [new])
+        self.assertIs(self.named_tm.terminals['stu'], new)
+
     @tornado.testing.gen_test
     async def test_namespace(self):
         names = ["/named/1"]*2 + ["/named/2"]*2
@@ -227,6 +310,87 @@ class NamedTermTests(TermTestCase):
         tm = await self.get_term_client(urls[MAX_TERMS])
         msg = await tm.read_msg()
         self.assertEqual(msg, None)             # Connection closed
+        self.assertEqual(tm.ws.close_code, 1013)
+
+class TermEventTests(TermTestCase):
+    @tornado.testing.gen_test
+    async def test_add_activity_remove(self):
+        self.named_tm.activity_interval = 0.05
+        self.named_tm.new_named_terminal(name='before')
+        events = await self.get_term_client('/events')
+        self.assertEqual(await events.read_msg(), ['terminals', ['before']])
+
+        name, term = self.named_tm.new_named_terminal(shell_command=['cat'])
+        self.assertEqual(await events.read_msg(), ['add', name])
+        term.write('hello\n')
+        msg = await events.read_msg()
+        while name not in msg[1]:
+            msg = await events.read_msg()
+        self.assertEqual(msg[0], 'activity')
+
+        self.named_tm.kill(name)
+        self.assertEqual(await events.read_msg(), ['remove', name])
+        events.close()
+        for i in range(20):
+            if not self.named_tm._subscribers:
+                break
+            await asyncio.sleep(0.05)
+        self.assertEqual(self.named_tm._subscribers, [])
+
+class TermMuxTests(TermTestCase):
+    async def read_until(self, client, predicate):
+        while True:
+            msg = await client.read_msg()
+            if predicate(msg):
+                return msg
+
+    @tornado.testing.gen_test
+    async def test_full_and_thumbnail_streams(self):
+        full_name, full = self.named_tm.new_named_terminal(shell_command=['cat'])
+        thumb_name, thumb = self.named_tm.new_named_terminal(shell_command=['cat'])
+        mux = await self.get_term_client('/mux')
+        with mock.patch.object(TermMuxSocket, 'thumbnail_interval', 0.1):
+            await mux.write_msg(['subscribe', full_name, 'full'])
+            await mux.write_msg(['subscribe', thumb_name, 'thumbnail'])
+            await asyncio.sleep(0.1)
+            full.write('to full\n')
+            thumb.write('to thumbnail\n')
+            msg = await self.read_until(mux, lambda m: m[0] == 'stdout')
+            self.assertEqual(msg[1], full_name)
+            self.assertIn('to full', msg[2])
+            msg = await self.read_until(
+                mux, lambda m: m[0] == 'thumbnail' and 'to thumbnail' in m[2])
+            self.assertEqual(msg[1], thumb_name)
+            self.assertEqual(msg[2][:2], ['to thumbnail', 'to thumbnail'])
+        # Watching doesn't size the terminals
+        self.assertEqual(full.ptyproc.getwinsize(), (24, 80))
+
+    @tornado.testing.gen_test
+    async def test_output_is_batched(self):
+        name, term = self.named_tm.new_named_terminal(shell_command=['cat'])
+        mux = await self.get_term_client('/mux')
+        await mux.write_msg(['subscribe', name, 'full'])
+        await asyncio.sleep(0.1)
+        for i in range(50):
+            term.write('line %d\n' % i)
+            await asyncio.sleep(0.002)
+        msgs = await mux.read_all_msg()
+        text = ''.join(m[2] for m in msgs)
+        self.assertIn('line 49', text)
+        self.assertLess(len(msgs), 25)
+
+    @tornado.testing.gen_test
+    async def test_unsubscribe_and_unknown(self):
+        name, term = self.named_tm.new_named_terminal(shell_command=['cat'])
+        mux = await self.get_term_client('/mux')
+        await mux.write_msg(['subscribe', 'nosuch', 'full'])
+        self.assertEqual(await mux.read_msg(), ['disconnect', 'nosuch'])
+        await mux.write_msg(['subscribe', name, 'thumbnail'])
+        await asyncio.sleep(0.1)
+        self.assertEqual(len(term.clients), 1)
+        await mux.write_msg(['unsubscribe', name])
+        await asyncio.sleep(0.1)
+        self.assertEqual(term.clients, [])
 
 class SingleTermTests(TermTestCase):
     @tornado.testing.gen_test
@@ -258,11 +422,1215 @@ class UniqueTermTests(TermTestCase):
         tms[0].close()
         msg = await tms[0].read_msg()           # Closed
         self.assertEqual(msg, None)
+        # Its shell exits on the hangup, which can take a moment
+        for i in range(50):
+            if len(self.unique_tm.ptys_by_fd) < MAX_TERMS:
+                break
+            await asyncio.sleep(0.1)
 
         # Should be able to open back up to MAX_TERMS
         tm = await self.get_term_client("/unique")
         msg = await tm.read_msg()
         self.assertEqual(msg[0], 'setup')
 
+class PtyReaderTests(TermTestCase):
+    @pytest.mark.skipif(os.name != 'posix', reason='Needs a posix pty')
+    def test_nonblocking_fd(self):
+        name, term = self.named_tm.new_named_terminal()
+        self.assertTrue(term.nonblocking)
+        self.assertFalse(os.get_blocking(term.ptyproc.fd))
+
+    @tornado.testing.gen_test
+    @pytest.mark.skipif(os.name != 'posix', reason='Needs a posix pty')
+    async def test_spurious_read_does_not_block(self):
+        tm = await self.get_term_client('/named/term1')
+        await tm.read_all_msg()                 # Drain the prompt
+        fd = self.named_tm.terminals['term1'].ptyproc.fd
+
+        start = time.monotonic()
+        self.named_tm.pty_read(fd)
+        self.assertLess(time.monotonic() - start, 0.05)
+
+    @tornado.testing.gen_test
+    @pytest.mark.skipif(os.name != 'posix', reason='Needs a posix pty')
+    async def test_large_paste(self):
+        tm = await self.get_term_client('/named/term1')
+        await tm.read_all_msg()
+        await tm.write_stdin("stty -echo; wc -c\r")
+        await tm.read_all_msg()
+        await tm.write_stdin(("x" * 99 + "\r") * 200 + "\x04")
+        (stdout, other) = await tm.read_stdout()
+        self.assertIn("20000", stdout)
+
+class PtyWriterTests(TermTestCase):
+    async def wait_for_output(self, term, text):
+        for i in range(100):
+            if text in b''.join(term.preopen_buffer):
+                return
+            await asyncio.sleep(0.1)
+        self.fail("%r not in output" % text)
+
+    @tornado.testing.gen_test
+    @pytest.mark.skipif(os.name != 'posix', reason='Needs a posix pty')
+    async def test_queued_writes_coalesce(self):
+        name, term = self.named_tm.new_named_terminal(
+            shell_command=['sh', '-c', 'stty -echo; head -c 300000 | wc -c'])
+        fd = term.ptyproc.fd
+        real_write = os.write
+        writes = []
+        def write(to, data):
+            n = real_write(to, data)
+            if to == fd:
+                writes.append(n)
+            return n
+
+        with mock.patch('os.write', write):
+            start = time.monotonic()
+            for i in range(3000):
+                term.write(b'x' * 99 + b'\n')
+            # More than the pty takes at once, without waiting for it
+            self.assertLess(time.monotonic() - start, 0.5)
+            await self.wait_for_output(term, b'300000')
+        self.assertEqual(sum(writes), 300000)
+        self.assertLess(len(writes), 300)
+
+    @tornado.testing.gen_test
+    @pytest.mark.skipif(os.name != 'posix', reason='Needs a posix pty')
+    async def test_full_input_waits(self):
+        # Nothing reads this terminal's input, and without echo the pty
+        # won't take more than a few kilobytes of it
+        name, term = self.named_tm.new_named_terminal(
+            shell_command=['sh', '-c', 'stty raw -echo; echo ready; sleep 30'])
+        await self.wait_for_output(term, b'ready')
+        term.input_buffer_size = 100000
+        term.write(b'x' * 1000000)
+        await asyncio.sleep(0.2)
+        self.assertTrue(term.waiting_writable)
+        self.assertTrue(term.input_full())
+        waiter = asyncio.ensure_future(term.wait_input_space())
+        await asyncio.sleep(0.2)
+        self.assertFalse(waiter.done())
+
+        await term.terminate(force=True)
+        await asyncio.wait_for(waiter, 5)
+        self.assertFalse(term.waiting_writable)
+
+class AuditLogTests(TermTestCase):
+    def setUp(self):
+        super().setUp()
+        self.audit_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.audit_dir)
+
+    def read_records(self, name):
+        with open(os.path.join(self.audit_dir, name)) as f:
+            return [json.loads(line) for line in f]
+
+    @tornado.testing.gen_test
+    async def test_commands_and_output(self):
+        self.named_tm.audit_log = AuditLog(self.audit_dir, output=True)
+        self.named_tm.new_named_terminal(name='term1', owner='stu')
+        tm = await self.get_term_client('/named/term1')
+        await tm.read_all_msg()
+        await tm.write_stdin("echo ")
+        await tm.write_stdin("one\recho two\r")
+        await tm.read_all_msg()
+        await self.named_tm.shutdown()
+        # Closed terminals' decoders aren't kept
+        self.assertEqual(self.named_tm.audit_log._decoders, {})
+
+        records = self.read_records('stu.jsonl')
+        self.assertEqual(
+            [r['data'] for r in records if r['direction'] == 'stdin'],
+            ['echo one', 'echo two'])
+        self.assertEqual({r['session'] for r in records}, {'term1'})
+        output = ''.join(r['data'] for r in records if r['direction'] == 'stdout')
+        self.assertIn('one\r\n', output)
+        self.assertIn('two\r\n', output)
+
+    def test_rotation(self):
+        class Terminal(object):
+            term_name = 'term1'
+            owner = '../stu'
+        audit_log = AuditLog(self.audit_dir, max_bytes=1000, backup_count=2)
+        for i in range(50):
+            audit_log.record(Terminal, 'stdin', 'x' * 100)
+        audit_log.close()
+        self.assertEqual(audit_log.stats['written'], 50)
+        self.assertEqual(sorted(os.listdir(self.audit_dir)),
+                         ['.._stu.jsonl', '.._stu.jsonl.1', '.._stu.jsonl.2'])
+        for name in os.listdir(self.audit_dir):
+            self.assertLess(os.path.getsize(os.path.join(self.audit_dir, name)), 1200)
+
+    def test_full_queue_drops(self):
+        class Terminal(object):
+            term_name = 'term1'
+            owner = None
+        audit_log = AuditLog(self.audit_dir, queue_size=10)
+        with mock.patch.object(audit_log, '_write', side_effect=lambda *a: time.sleep(0.01)):
+            for i in range(100):
+                audit_log.record(Terminal, 'stdin', 'ls')
+            audit_log.close()
+        self.assertGreater(audit_log.stats['dropped'], 0)
+
+    def test_unnamed_terminals_decoded_apart(self):
+        class Terminal(object):
+            term_name = None
+            owner = None
+        one, two = Terminal(), Terminal()
+        audit_log = AuditLog(self.audit_dir, output=True)
+        # Each splits a character across reads, interleaved with the other
+        audit_log.record(one, 'stdout', '\u00e9'.encode('utf-8')[:1])
+        audit_log.record(two, 'stdout', '\u00fc'.encode('utf-8')[:1])
+        audit_log.record(one, 'stdout', '\u00e9'.encode('utf-8')[1:])
+        audit_log.record(two, 'stdout', '\u00fc'.encode('utf-8')[1:])
+        audit_log.close()
+        records = self.read_records('unnamed.jsonl')
+        self.assertEqual(''.join(r['data'] for r in records), '\u00e9\u00fc')
+        audit_log.forget(one)
+        self.assertEqual(list(audit_log._decoders), [two])
+
+class RecordingClient(object):
+    """Stands in for a TermSocket, remembering what it was sent"""
+    size = (None, None)
+    binary = False
+    saturated = False
+
+    def __init__(self):
+        self.received = []
+
+    def on_pty_output(self, output):
+        self.received.append(output.text)
+
+    def on_pty_died(self):
+        pass
+
+class OutputCoalescingTests(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        # cat prints nothing of its own, so only our test output arrives
+        self.tm = NamedTermManager(shell_command=['cat'],
+                                   output_flush_interval=0.05,
+                                   output_flush_size=1000)
+
+    def tearDown(self):
+        IOLoop.current().run_sync(self.tm.kill_all)
+        super().tearDown()
+
+    def attach(self):
+        name, term = self.tm.new_named_terminal()
+        client = RecordingClient()
+        term.clients.append(client)
+        return term, client
+
+    @tornado.testing.gen_test
+    async def test_batches_within_interval(self):
+        term, client = self.attach()
+        for i in range(100):
+            term.on_output(b'x')
+        self.assertEqual(client.received, [])
+        await asyncio.sleep(0.1)
+        self.assertEqual(client.received, ['x' * 100])
+
+    @tornado.testing.gen_test
+    async def test_flushes_at_size_threshold(self):
+        term, client = self.attach()
+        term.on_output(b'a' * 600)
+        term.on_output(b'b' * 600)
+        self.assertEqual(client.received, ['a' * 600 + 'b' * 600])
+
+class SharedEncodingTests(TermTestCase):
+    @tornado.testing.gen_test
+    async def test_stdout_encoded_once(self):
+        tms = await self.get_term_clients(['/named/shared'] * 3)
+        for tm in tms:
+            await tm.read_all_msg()
+        term = self.named_tm.terminals['shared']
+
+        with mock.patch.object(terminado.websocket.json, 'dumps',
+                               wraps=json.dumps) as dumps:
+            term.deliver(b'hello')
+        self.assertEqual(dumps.call_count, 1)
+        for tm in tms:
+            self.assertEqual(await tm.read_msg(), ['stdout', 'hello'])
+
+    @tornado.testing.gen_test
+    async def test_without_tornado_internals(self):
+        tm = await self.get_term_client('/named/shared')
+        await tm.read_all_msg()
+        term = self.named_tm.terminals['shared']
+        # As on a tornado whose websocket protocol lacks what we use
+        with mock.patch.object(terminado.websocket, '_FRAME_ATTRIBUTES',
+                               ('_write_frame', '_no_such_attribute')):
+            term.deliver(b'hello')
+        self.assertEqual(await tm.read_msg(), ['stdout', 'hello'])
+
+        class Compressor(object):
+            _compressor = None
+            def compress(self, data):
+                return data[::-1]
+        message = terminado.websocket.PreparedMessage('abc')
+        self.assertEqual(message.compress(Compressor()), b'cba')
+
+    def test_compressed_once_without_context_takeover(self):
+        from tornado.websocket import _PerMessageDeflateCompressor
+        message = terminado.websocket.PreparedMessage('["stdout", "hi"]')
+        compressors = [_PerMessageDeflateCompressor(False, zlib.MAX_WBITS)
+                       for _ in range(2)]
+        first, second = [message.compress(c) for c in compressors]
+        self.assertIs(first, second)
+        inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.assertEqual(inflate.decompress(first + b'\x00\x00\xff\xff'),
+                         message.data)
+
+class CompressionTests(TermTestCase):
+    async def get_compressed_client(self, path):
+        port = self.get_http_port()
+        request = tornado.httpclient.HTTPRequest(
+            'ws://127.0.0.1:%d%s' % (port, path),
+            headers={'Origin': 'http://127.0.0.1:%d' % port})
+        ws = await tornado.websocket.websocket_connect(
+            request, compression_options={})
+        return TestTermClient(ws)
+
+    @tornado.testing.gen_test
+    async def test_negotiates_manager_settings(self):
+        tm = self.named_tm
+        tm.compression_window_bits = 10
+        tm.compression_context_takeover = False
+        client = await self.get_compressed_client('/named/deflate')
+        extensions = client.ws.headers['Sec-WebSocket-Extensions']
+        self.assertIn('server_max_window_bits=10', extensions)
+        self.assertIn('server_no_context_takeover', extensions)
+        await client.read_all_msg()
+
+        term = tm.terminals['deflate']
+        conn = term.clients[0].ws_connection
+        self.assertEqual(conn._compressor._max_wbits, 10)
+        with mock.patch.object(conn._compressor, 'compress',
+                               wraps=conn._compressor.compress) as compress:
+            term.deliver(b'x')
+            self.assertEqual(await client.read_msg(), ['stdout', 'x'])
+            self.assertEqual(compress.call_count, 0)    # Below min size
+            term.deliver(b'\x1b[32mok\x1b[0m ' * 20)
+            self.assertEqual(await client.read_msg(),
+                             ['stdout', '\x1b[32mok\x1b[0m ' * 20])
+            self.assertEqual(compress.call_count, 1)
+        client.close()
+
+    @tornado.testing.gen_test
+    async def test_disabled(self):
+        self.named_tm.websocket_compression = False
+        client = await self.get_compressed_client('/named/plain')
+        self.assertNotIn('Sec-WebSocket-Extensions', client.ws.headers)
+        client.close()
+
+class BinaryProtocolTests(TermTestCase):
+    async def get_binary_ws(self, path):
+        port = self.get_http_port()
+        request = tornado.httpclient.HTTPRequest(
+            'ws://127.0.0.1:%d%s' % (port, path),
+            headers={'Origin': 'http://127.0.0.1:%d' % port})
+        ws = await tornado.websocket.websocket_connect(
+            request, subprotocols=[terminado.websocket.BINARY_SUBPROTOCOL])
+        return TestTermClient(ws)
+
+    async def read_binary_stdout(self, tm):
+        data = b''
+        for msg in await tm.read_all_msg():
+            self.assertIsInstance(msg, bytes)
+            self.assertEqual(msg[0], terminado.websocket.BINARY_STDOUT)
+            data += msg[1:]
+        return data
+
+    @tornado.testing.gen_test
+    async def test_binary_round_trip(self):
+        ws = await self.get_binary_ws('/named/bin')
+        self.assertEqual(ws.ws.selected_subprotocol,
+                         terminado.websocket.BINARY_SUBPROTOCOL)
+        self.assertEqual(await ws.read_msg(), ['setup', {}])
+        await self.read_binary_stdout(ws)
+
+        stdin = bytes((terminado.websocket.BINARY_STDIN,))
+        await ws.ws.write_message(
+            stdin + 'echo \u00e9t\u00e9\r'.encode('utf-8'), binary=True)
+        stdout = await self.read_binary_stdout(ws)
+        self.assertIn('\u00e9t\u00e9'.encode('utf-8'), stdout)
+        ws.close()
+
+    @tornado.testing.gen_test
+    async def test_mixed_clients(self):
+        ws = await self.get_binary_ws('/named/mixed')
+        tm = await self.get_term_client('/named/mixed')
+        await ws.read_all_msg()
+        await tm.read_all_msg()
+
+        self.named_tm.terminals['mixed'].deliver(b'caf\xc3\xa9')
+        text, binary = await asyncio.gather(tm.read_msg(), ws.read_msg())
+        self.assertEqual(text, ['stdout', 'caf\u00e9'])
+        self.assertEqual(binary, b'\x01caf\xc3\xa9')
+        ws.close()
+
+class BackpressureTests(TermTestCase):
+    async def saturate(self, policy):
+        tm = self.named_tm
+        tm.slow_client_policy = policy
+        tm.client_high_watermark = 4000
+        tm.client_low_watermark = 0
+        client = await self.get_term_client('/named/slow')
+        await client.read_all_msg()
+        term = tm.terminals['slow']
+        sock, = term.clients
+        # Nothing gets flushed while we hold the event loop
+        for i in range(10):
+            term.deliver(b'x' * 1000)
+        return client, term, sock
+
+    @tornado.testing.gen_test
+    async def test_drop_and_resync(self):
+        resyncs = []
+        client, term, sock = await self.saturate('drop')
+        term.resync = lambda client, since: resyncs.append(client)
+        self.assertTrue(sock.saturated)
+        dropped = sock.backpressure_stats['dropped_bytes']
+        self.assertGreater(dropped, 0)
+
+        stdout, other = await client.read_stdout()
+        self.assertEqual(len(stdout) + dropped, 10000)
+        self.assertFalse(sock.saturated)
+        self.assertEqual(resyncs, [sock])
+        self.assertEqual(self.named_tm.backpressure_stats['drop'], 1)
+
+    @tornado.testing.gen_test
+    async def test_resync_resends_dropped(self):
+        client, term, sock = await self.saturate('drop')
+        self.assertGreater(sock.backpressure_stats['dropped_bytes'], 0)
+        with mock.patch.object(term, 'redraw') as redraw:
+            stdout, other = await client.read_stdout()
+        # Only what was dropped is sent again, and no one else is disturbed
+        self.assertEqual(stdout, 'x' * 10000)
+        redraw.assert_not_called()
+
+    def test_resync_after_too_much_dropped(self):
+        name, term = self.named_tm.new_named_terminal()
+        term.scrollback = terminado.scrollback.Scrollback()
+        term.preopen_buffer.maxsize = 100
+        client = RecordingClient()
+        term.scrollback.append(b'a' * 1000)
+        term.resync(client, 500)
+        self.assertEqual(client.received, ['\x1b[0m\x1b[H\x1b[2J' + 'a' * 100])
+
+    @tornado.testing.gen_test
+    async def test_pause(self):
+        client, term, sock = await self.saturate('pause')
+        self.assertEqual(term.paused_by, {sock})
+        stdout, other = await client.read_stdout()
+        self.assertEqual(len(stdout), 10000)
+        self.assertEqual(term.paused_by, set())
+
+    @tornado.testing.gen_test
+    async def test_disconnect(self):
+        client, term, sock = await self.saturate('disconnect')
+        msgs = await client.read_all_msg()
+        self.assertEqual(msgs[-1], None)            # Connection closed
+        self.assertEqual(self.named_tm.backpressure_stats['disconnect'], 1)
+
+class FlowControlTests(TermTestCase):
+    @tornado.testing.gen_test
+    async def test_pause_only_when_all_clients_saturated(self):
+        tm = self.named_tm
+        tm.flow_control = True
+        tm.client_high_watermark = 4000
+        tm.client_low_watermark = 0
+        clients = await self.get_term_clients(['/named/flow'] * 2)
+        for client in clients:
+            await client.read_all_msg()
+        term = tm.terminals['flow']
+        first, second = term.clients
+
+        # Only one client backlogged: keep reading for the other one
+        first.queued_bytes = 5000
+        first._on_saturated()
+        self.assertEqual(term.paused_by, set())
+
+        # Nothing gets flushed while we hold the event loop
+        for i in range(10):
+            term.deliver(b'x' * 1000)
+        self.assertTrue(second.saturated)
+        self.assertEqual(term.paused_by, {FLOW_CONTROL})
+        self.assertEqual(tm.backpressure_stats['flow_control'], 1)
+
+        first.queued_bytes = 0
+        first._on_drained()
+        self.assertEqual(term.paused_by, set())
+
+    @tornado.testing.gen_test
+    async def test_resume_when_drained(self):
+        tm = self.named_tm
+        tm.flow_control = True
+        tm.client_high_watermark = 4000
+        tm.client_low_watermark = 0
+        client = await self.get_term_client('/named/flow')
+        await client.read_all_msg()
+        term = tm.terminals['flow']
+        for i in range(10):
+            term.deliver(b'x' * 1000)
+        self.assertEqual(term.paused_by, {FLOW_CONTROL})
+
+        stdout, other = await client.read_stdout()
+        self.assertEqual(len(stdout), 10000)        # Nothing dropped
+        self.assertEqual(term.paused_by, set())
+
+class PreopenBufferTests(unittest.TestCase):
+    def test_keeps_most_recent_bytes(self):
+        buf = OutputRingBuffer(maxsize=10)
+        buf.append(b'abcdef')
+        buf.append(b'ghijkl')
+        self.assertEqual(b''.join(buf), b'cdefghijkl')
+        self.assertEqual(buf.size, 10)
+        self.assertEqual(buf.dropped_bytes, 2)
+
+        buf.append(b'0123456789XY')
+        self.assertEqual(b''.join(buf), b'23456789XY')
+        self.assertEqual(buf.dropped_bytes, 14)
+
+    def test_unbounded(self):
+        buf = OutputRingBuffer()
+        for i in range(100):
+            buf.append(b'x' * 100)
+        self.assertEqual(buf.size, 10000)
+        self.assertEqual(buf.dropped_bytes, 0)
+
+class PreopenBufferMemoryTests(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    async def test_constant_memory_without_clients(self):
+        tm = NamedTermManager(shell_command=['yes', 'x' * 80],
+                              preopen_buffer_size=65536)
+        name, term = tm.new_named_terminal()
+        try:
+            sizes = []
+            for i in range(5):
+                await asyncio.sleep(0.2)
+                sizes.append(term.preopen_buffer.size)
+        finally:
+            await tm.kill_all()
+        self.assertEqual(sizes, [65536] * 5)
+        self.assertGreater(term.preopen_buffer.dropped_bytes, 10 * 65536)
+
+class TerminateTests(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    @pytest.mark.skipif(not hasattr(os, 'pidfd_open'), reason='Needs pidfds')
+    async def test_returns_when_process_exits(self):
+        tm = NamedTermManager(shell_command=['sh'],
+                              terminate_grace_periods={signal.SIGHUP: 10})
+        name, term = tm.new_named_terminal()
+        start = time.monotonic()
+        self.assertTrue(await term.terminate())
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertFalse(term.ptyproc.isalive())
+
+    @tornado.testing.gen_test
+    @pytest.mark.skipif(os.name != 'posix', reason='Needs posix signals')
+    async def test_grace_periods(self):
+        tm = NamedTermManager(
+            shell_command=['sh', '-c', 'trap "" HUP INT TERM; echo ready; '
+                                       'while :; do sleep 1; done'],
+            terminate_grace_periods={signal.SIGHUP: 0.05, signal.SIGCONT: 0,
+                                     signal.SIGINT: 0.05, signal.SIGTERM: 0.05})
+        name, term = tm.new_named_terminal()
+        client = RecordingClient()
+        term.clients.append(client)
+        for i in range(50):
+            if 'ready' in ''.join(client.received):
+                break
+            await asyncio.sleep(0.1)
+        start = time.monotonic()
+        self.assertFalse(await term.terminate())
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertTrue(await term.terminate(force=True))
+        await tm.kill_all()
+
+class TerminalPoolTests(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tm = NamedTermManager(shell_command=['cat'], pool_size=2)
+
+    def tearDown(self):
+        IOLoop.current().run_sync(self.tm.shutdown)
+        super().tearDown()
+
+    async def wait_for_pool(self, size):
+        for i in range(50):
+            if len(self.tm.pool) == size:
+                return
+            await asyncio.sleep(0.1)
+        self.fail("Pool has %d terminals, not %d" % (len(self.tm.pool), size))
+
+    @tornado.testing.gen_test
+    async def test_hands_out_pooled_terminals(self):
+        self.tm.fill_pool()
+        await self.wait_for_pool(2)
+        pooled = list(self.tm.pool)
+        name, term = self.tm.new_named_terminal()
+        self.assertIs(term, pooled[0])
+        self.assertEqual(self.tm.pool_stats['hits'], 1)
+        client = RecordingClient()
+        term.clients.append(client)
+        term.write('pooled\n')
+        for i in range(50):
+            if 'pooled' in ''.join(client.received):
+                break
+            await asyncio.sleep(0.1)
+        self.assertIn('pooled', ''.join(client.received))
+        # Taking one starts a replacement
+        await self.wait_for_pool(2)
+
+    @tornado.testing.gen_test
+    async def test_miss_and_bypass(self):
+        name, term = self.tm.new_named_terminal()
+        self.assertEqual(self.tm.pool_stats['misses'], 1)
+        self.assertNotIn(term, self.tm.pool)
+        await self.wait_for_pool(2)
+        self.tm.new_named_terminal(shell_command=['sh'])
+        self.assertEqual(len(self.tm.pool), 2)
+        self.assertEqual(self.tm.pool_stats['hits'], 0)
+
+    @tornado.testing.gen_test
+    async def test_shutdown_ends_pooled(self):
+        self.tm.fill_pool()
+        await self.wait_for_pool(2)
+        procs = [term.ptyproc for term in self.tm.pool]
+        await self.tm.shutdown()
+        self.assertEqual(len(self.tm.pool), 0)
+        self.assertFalse(any(proc.isalive() for proc in procs))
+
+    @tornado.testing.gen_test
+    async def test_async_pool_hooks(self):
+        discarded = []
+        async def take_pooled_async(argv, cwd):
+            await asyncio.sleep(0)
+            return self.tm.pop_pooled()
+        async def discard_pooled(term):
+            NamedTermManager.discard_pooled(self.tm, term)
+            await asyncio.sleep(0)
+            discarded.append(term)
+        self.tm.take_pooled_async = take_pooled_async
+        self.tm.discard_pooled = discard_pooled
+        self.tm.fill_pool()
+        await self.wait_for_pool(2)
+        pooled = list(self.tm.pool)
+        name, term = await self.tm.new_named_terminal_async()
+        self.assertIs(term, pooled[0])
+        await self.tm.shutdown()
+        self.assertEqual(discarded, pooled[1:])
+
+class ScreenTests(unittest.TestCase):
+    def test_cursor_and_erase(self):
+        screen = Screen(5, 10)
+        screen.feed('hello\r\nworld\x1b[3;4HX\x1b[2;2H\x1b[K')
+        self.assertEqual(screen.display(), ['hello', 'w', '   X', '', ''])
+        self.assertEqual((screen.y, screen.x), (1, 1))
+
+    def test_wrap_and_scroll(self):
+        screen = Screen(3, 5)
+        screen.feed('abcdefg\r\n1\r\n2')
+        self.assertEqual(screen.display(), ['fg', '1', '2'])
+
+    def test_split_escape_sequence(self):
+        screen = Screen(3, 5)
+        screen.feed('ab\x1b[')
+        screen.feed('2')
+        screen.feed('Jc')
+        self.assertEqual(screen.display(), ['  c', '', ''])
+
+    def test_alternate_screen(self):
+        screen = Screen(3, 5)
+        screen.feed('main\x1b[?1049h\x1b[Halt')
+        self.assertEqual(screen.display(), ['alt', '', ''])
+        screen.feed('\x1b[?1049l')
+        self.assertEqual(screen.display(), ['main', '', ''])
+        self.assertEqual((screen.y, screen.x), (0, 4))
+
+    def test_snapshot_round_trip(self):
+        screen = Screen(5, 20)
+        screen.feed('\x1b]0;student\x07$ ls\r\n\x1b[1;34mdir\x1b[0m  '
+                    '\x1b[48;5;22mfile\x1b[0m\r\n\x1b(0lqk\x1b(B'
+                    '\x1b[2;4r\x1b[?2004h\x1b[5;3H\x1b[4m')
+        copy = Screen(5, 20)
+        copy.feed(screen.snapshot())
+        self.assertEqual(copy.display(), screen.display())
+        self.assertEqual(copy.attrs, screen.attrs)
+        self.assertEqual((copy.y, copy.x), (screen.y, screen.x))
+        self.assertEqual(copy.pen, screen.pen)
+        self.assertEqual((copy.top, copy.bottom), (1, 3))
+        self.assertEqual(copy.title, 'student')
+        self.assertTrue(copy.modes[2004])
+
+    def test_snapshot_size_independent_of_history(self):
+        screen = Screen(24, 80)
+        screen.feed('x' * 80 * 24)
+        size = len(screen.snapshot())
+        screen.feed('y' * 80 * 10000)
+        self.assertEqual(len(screen.snapshot()), size)
+
+class ScreenModelTests(TermTestCase):
+    @tornado.testing.gen_test
+    async def test_attach_gets_snapshot(self):
+        tm = self.named_tm
+        tm.screen_model = True
+        tm.shell_command = ['sh', '-c', r'printf "\033[2J\033[3;5Hhello"; exec cat']
+        name, term = tm.new_named_terminal()
+        for i in range(50):
+            if term.screen.display()[2] == '    hello':
+                break
+            await asyncio.sleep(0.1)
+        self.assertEqual(term.preopen_buffer.size, 0)
+
+        client = await self.get_term_client('/named/' + name)
+        setup, stdout = await client.read_msg(), await client.read_msg()
+        self.assertEqual(setup, ['setup', {}])
+        self.assertEqual(stdout, ['stdout', term.screen.snapshot()])
+        self.assertIn('\x1b[3;1H    hello', stdout[1])
+        client.close()
+
+class TermScreensHandlerTests(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        self.tm = NamedTermManager(shell_command=['cat'], screen_model=True)
+        return tornado.web.Application([
+            (r"/screens", TermScreensHandler, {'term_manager': self.tm}),
+        ])
+
+    def tearDown(self):
+        IOLoop.current().run_sync(self.tm.kill_all)
+        super().tearDown()
+
+    async def fetch_screens(self, *terminals):
+        query = '&'.join('terminal=' + t for t in terminals)
+        response = await self.http_client.fetch(self.get_url('/screens?' + query))
+        return json.loads(response.body)
+
+    async def wait_for_screen(self, term, text):
+        for i in range(50):
+            if any(text in line for line in term.screen.display()):
+                return
+            await asyncio.sleep(0.1)
+        self.fail("%r not on screen" % text)
+
+    @tornado.testing.gen_test
+    async def test_only_changed_screens(self):
+        alice = self.tm.new_named_terminal(name='alice')[1]
+        bob = self.tm.new_named_terminal(name='bob')[1]
+        alice.write('hi alice\n')
+        await self.wait_for_screen(alice, 'hi alice')
+
+        reply = await self.fetch_screens()
+        self.assertEqual(sorted(reply['screens']), ['alice', 'bob'])
+        screen = reply['screens']['alice']
+        self.assertEqual(screen['lines'], ['hi alice', 'hi alice'])
+        self.assertEqual(screen['cursor'], [2, 0])
+        self.assertEqual((screen['rows'], screen['cols']), (24, 80))
+        self.assertEqual(reply['screens']['bob']['lines'], [])
+
+        versions = {name: s['version'] for name, s in reply['screens'].items()}
+        bob.write('hi bob\n')
+        await self.wait_for_screen(bob, 'hi bob')
+        reply = await self.fetch_screens(
+            'alice:%d' % versions['alice'], 'bob:%d' % versions['bob'], 'carol')
+        self.assertEqual(list(reply['screens']), ['bob'])
+        self.assertEqual(reply['unchanged'], ['alice'])
+        self.assertEqual(reply['missing'], ['carol'])
+
+class TermSessionsHandlerTests(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        self.tm = NamedTermManager(shell_command=['cat'])
+        return tornado.web.Application([
+            (r"/sessions", TermSessionsHandler, {'term_manager': self.tm}),
+        ])
+
+    def tearDown(self):
+        IOLoop.current().run_sync(self.tm.kill_all)
+        super().tearDown()
+
+    async def fetch_sessions(self, query=''):
+        response = await self.http_client.fetch(self.get_url('/sessions?' + query))
+        return json.loads(response.body)
+
+    @tornado.testing.gen_test
+    async def test_pages_and_filters(self):
+        for owner in ['alice', 'bob', 'carol']:
+            for n in range(2):
+                self.tm.new_named_terminal(name='%s%d' % (owner, n), owner=owner)
+
+        reply = await self.fetch_sessions('limit=4')
+        self.assertEqual(reply['total'], 6)
+        self.assertEqual([s['name'] for s in reply['sessions']],
+                         ['alice0', 'alice1', 'bob0', 'bob1'])
+        reply = await self.fetch_sessions('offset=4&limit=4')
+        self.assertEqual([s['name'] for s in reply['sessions']],
+                         ['carol0', 'carol1'])
+
+        reply = await self.fetch_sessions('owner=bob')
+        self.assertEqual(reply['total'], 2)
+        session = reply['sessions'][0]
+        self.assertEqual((session['name'], session['owner'], session['clients']),
+                         ('bob0', 'bob', 0))
+        self.assertLessEqual(session['created'], time.time())
+        self.assertEqual([s['name'] for s in (await self.fetch_sessions('q=1'))['sessions']],
+                         ['alice1', 'bob1', 'carol1'])
+
+        with self.assertRaises(HTTPError) as cm:
+            await self.fetch_sessions('limit=lots')
+        self.assertEqual(cm.exception.code, 400)
+
+class TermRecordingHandlerTests(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        self.recording_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.recording_dir)
+        self.tm = NamedTermManager(shell_command=['cat'],
+                                   recording_dir=self.recording_dir)
+        return tornado.web.Application([
+            (r"/recordings/(.*)", TermRecordingHandler,
+             {'recording_dir': self.recording_dir}),
+        ])
+
+    def tearDown(self):
+        IOLoop.current().run_sync(self.tm.kill_all)
+        super().tearDown()
+
+    async def fetch(self, path, **kwargs):
+        return await self.http_client.fetch(self.get_url('/recordings/' + path),
+                                            **kwargs)
+
+    @tornado.testing.gen_test
+    async def test_list_and_replay(self):
+        term = self.tm.new_named_terminal(name='term1', owner='stu')[1]
+        term.write('hello\n')
+        for i in range(50):
+            if b'hello\r\nhello' in term.scrollback.read(0):
+                break
+            await asyncio.sleep(0.1)
+        term.recorder.flush()
+
+        reply = json.loads((await self.fetch('')).body)
+        [recording] = reply['recordings']
+        self.assertTrue(recording['name'].startswith('stu-'))
+        self.assertEqual(recording['name'], os.path.basename(term.recorder.path))
+
+        response = await self.fetch(recording['name'])
+        self.assertEqual(response.headers['Content-Type'], 'application/x-asciicast')
+        lines = [json.loads(line) for line in response.body.splitlines()]
+        self.assertEqual(lines[0]['version'], 2)
+        self.assertEqual(''.join(e[2] for e in lines[1:] if e[1] == 'o'),
+                         'hello\r\nhello\r\n')
+
+    @tornado.testing.gen_test
+    async def test_bad_requests(self):
+        for path in ['missing.cast', '..%2Fx.cast', 'term1.cast.idx']:
+            with self.assertRaises(HTTPError) as cm:
+                await self.fetch(path)
+            self.assertEqual(cm.exception.code, 404)
+        term = self.tm.new_named_terminal(name='term1')[1]
+        name = os.path.basename(term.recorder.path)
+        with self.assertRaises(HTTPError) as cm:
+            await self.fetch(name + '?start=soon')
+        self.assertEqual(cm.exception.code, 400)
+
+class RecorderTests(unittest.TestCase):
+    def setUp(self):
+        self.recording_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.recording_dir)
+        self.path = os.path.join(self.recording_dir, 'term.cast')
+        self.now = 1000.0
+        patcher = mock.patch('time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def record(self):
+        """Record a line a second for a minute, with a screen model"""
+        recorder = Recorder(self.path, 5, 20, index_interval=10)
+        screen = Screen(5, 20)
+        for i in range(60):
+            self.now = 1000.0 + i
+            if i == 30:
+                recorder.resize(6, 20)
+                screen.resize(6, 20)
+            data = b'line %d\r\n' % i
+            recorder.output(data, screen)
+            screen.feed(data.decode())
+        recorder.close()
+
+    def replay(self, start=0, end=None):
+        return [json.loads(line) for line in
+                terminado.recording.replay(self.path, start, end)]
+
+    def test_index(self):
+        self.record()
+        with open(self.path + '.idx') as f:
+            index = [json.loads(line) for line in f]
+        self.assertEqual([e[0] for e in index], [0, 10, 20, 30, 40, 50])
+        self.assertEqual([e[3] for e in index], [5, 5, 5, 6, 6, 6])
+        # The screen as it was before the output at that time
+        screen = Screen(5, 20)
+        screen.feed(index[2][4])
+        self.assertEqual(screen.display(), ['line 16', 'line 17', 'line 18',
+                                            'line 19', ''])
+        with open(self.path, 'rb') as f:
+            f.seek(index[2][1])
+            self.assertEqual(json.loads(f.readline()), [20, 'o', 'line 20\r\n'])
+
+    def test_replay_from(self):
+        self.record()
+        events = self.replay()
+        self.assertEqual(events[0]['height'], 5)
+        self.assertEqual(len(events), 62)
+
+        events = self.replay(start=45.5, end=49.9)
+        self.assertEqual((events[0]['width'], events[0]['height']), (20, 6))
+        # Paint the screen as at 40s, then catch up to 45.5s at once
+        self.assertEqual(events[1][:2], [0.0, 'o'])
+        self.assertEqual([e[:1] + e[2:] for e in events[2:]],
+                         [[0.0, 'line %d\r\n' % i] for i in range(40, 46)]
+                         + [[0.5, 'line 46\r\n'], [1.5, 'line 47\r\n'],
+                            [2.5, 'line 48\r\n'], [3.5, 'line 49\r\n']])
+        screen = Screen(6, 20)
+        for event in events[1:]:
+            screen.feed(event[2])
+        self.assertEqual(screen.display()[:5],
+                         ['line 45', 'line 46', 'line 47', 'line 48', 'line 49'])
+
+    def test_replay_while_recording(self):
+        recorder = Recorder(self.path, 5, 20, index_interval=10)
+        recorder.output(b'one\r\n')
+        recorder.output(b'two\r\n')
+        # Held in memory until flushed
+        self.assertEqual(self.replay()[1:], [])
+        recorder.flush()
+        # Half a line, as if caught in the middle of being written
+        with open(self.path, 'ab') as f:
+            f.write(b'[1.0, "o", "tw')
+        events = self.replay()
+        self.assertEqual([e[2] for e in events[1:]], ['one\r\n', 'two\r\n'])
+        recorder.close()
+
+    def test_flush_size(self):
+        recorder = Recorder(self.path, 5, 20, flush_size=40)
+        recorder.output(b'one\r\n')
+        self.assertEqual(self.replay()[1:], [])
+        recorder.output(b'two\r\n')
+        self.assertEqual([e[2] for e in self.replay()[1:]], ['one\r\n', 'two\r\n'])
+        recorder.close()
+
+class OutputIndexTests(unittest.TestCase):
+    class Terminal(object):
+        def __init__(self, name, owner=None):
+            self.term_name = name
+            self.owner = owner
+
+    def setUp(self):
+        self.now = 1000000.0
+        patcher = mock.patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def lines(self, index, query, **kwargs):
+        return [r['line'] for r in index.search(query, **kwargs)]
+
+    def test_lines_without_escapes(self):
+        index = OutputIndex()
+        term = self.Terminal('term1', 'stu')
+        index.feed(term, b'$ ./a.out\r\n\x1b[1;3')
+        self.assertEqual(self.lines(index, 'a out'), ['$ ./a.out'])
+        index.feed(term, b'1mSegmentation\x1b[0m fault (core dumped)')
+        # Not a whole line yet
+        self.assertEqual(self.lines(index, 'segmentation'), [])
+        index.feed(term, b'\r\n\x1b]0;title\x07ab\x1b[3Ccd\x1b[5;1Hef\n')
+        self.assertEqual(index.search('SEGMENTATION fault'), [{
+            'time': self.now, 'name': 'term1', 'owner': 'stu',
+            'line': 'Segmentation fault (core dumped)'}])
+        self.assertEqual(self.lines(index, 'cd'), ['ab cd'])
+        self.assertEqual(self.lines(index, 'ef'), ['ef'])
+        # Whole words only, all of them
+        self.assertEqual(self.lines(index, 'segment'), [])
+        self.assertEqual(self.lines(index, 'segmentation error'), [])
+        self.assertEqual(self.lines(index, '...'), [])
+
+    def test_recent_lines(self):
+        index = OutputIndex(bucket_interval=60)
+        alice, bob = self.Terminal('a', 'alice'), self.Terminal('b', 'bob')
+        for minute in range(30):
+            self.now = 1000000.0 + minute * 60
+            index.feed(alice, b'error %d\n' % minute)
+            index.feed(bob, b'error %d\n' % minute)
+        self.assertEqual(len(self.lines(index, 'error')), 60)
+        self.assertEqual(self.lines(index, 'error', since=self.now - 150),
+                         ['error 29', 'error 29', 'error 28', 'error 28',
+                          'error 27', 'error 27'])
+        self.assertEqual(self.lines(index, 'error', owner='bob', limit=2),
+                         ['error 29', 'error 28'])
+
+    def test_bounded(self):
+        index = OutputIndex(bucket_interval=60, max_age=600, max_lines=50,
+                            terminal_bucket_lines=10, max_line_length=20)
+        loop, quiet = self.Terminal('loop'), self.Terminal('quiet')
+        index.feed(quiet, b'hello\n')
+        index.feed(loop, b'spam\n' * 100)
+        self.assertEqual(index.stats['skipped'], 90)
+        self.assertEqual(self.lines(index, 'hello'), ['hello'])
+        index.feed(quiet, b'x' * 1000)
+        index.feed(quiet, b'x' * 1000 + b'\n')
+        self.assertEqual(len(index.search('x' * 20)), 1)
+
+        for minute in range(1, 20):
+            self.now += 60
+            index.feed(loop, b'spam\n' * 10)
+        self.assertLessEqual(index.line_count, 60)
+        self.assertEqual(self.lines(index, 'hello'), [])
+        self.assertEqual(index.stats['indexed'],
+                         index.line_count + index.stats['evicted'])
+
+class TermSearchHandlerTests(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        self.tm = NamedTermManager(shell_command=['cat'],
+                                   search_index=OutputIndex())
+        return tornado.web.Application([
+            (r"/search", TermSearchHandler,
+             {'search_index': self.tm.search_index}),
+        ])
+
+    def tearDown(self):
+        IOLoop.current().run_sync(self.tm.kill_all)
+        super().tearDown()
+
+    async def search(self, query):
+        response = await self.http_client.fetch(self.get_url('/search?' + query))
+        return json.loads(response.body)
+
+    @tornado.testing.gen_test
+    async def test_search(self):
+        alice = self.tm.new_named_terminal(name='alice0', owner='alice')[1]
+        bob = self.tm.new_named_terminal(name='bob0', owner='bob')[1]
+        alice.write('Segmentation fault\n')
+        bob.write('all good\n')
+        for i in range(50):
+            if self.tm.search_index.stats['indexed'] == 4:
+                break
+            await asyncio.sleep(0.1)
+
+        reply = await self.search('q=segmentation+FAULT&within=600')
+        [session] = reply['sessions']
+        self.assertEqual((session['name'], session['owner']), ('alice0', 'alice'))
+        # Echoed by the pty, then printed by cat
+        self.assertEqual([m['line'] for m in session['matches']],
+                         ['Segmentation fault'] * 2)
+        reply = await self.search('q=good&owner=alice')
+        self.assertEqual(reply['sessions'], [])
+
+        with self.assertRaises(HTTPError) as cm:
+            await self.search('q=+')
+        self.assertEqual(cm.exception.code, 400)
+
+class ScrollbackTests(unittest.TestCase):
+    output = b''.join(b'%04d' % i * 25 for i in range(100))
+
+    def fill(self, scrollback):
+        for i in range(0, len(self.output), 100):
+            scrollback.append(self.output[i:i + 100])
+
+    def test_spills_to_disk(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            scrollback = Scrollback(memory_limit=1000, spill_dir=spill_dir)
+            self.fill(scrollback)
+            self.assertEqual(scrollback.memory_size, 1000)
+            self.assertEqual((scrollback.start, scrollback.end), (0, 10000))
+            self.assertEqual(os.path.getsize(scrollback.spill_path), 9000)
+
+            self.assertEqual(scrollback.read(0, 8), b'00000000')
+            # Across the boundary between disk and memory
+            self.assertEqual(scrollback.read(8950, 9050), self.output[8950:9050])
+            self.assertEqual(scrollback.read(9990), self.output[9990:])
+            self.fill(scrollback)
+            self.assertEqual(scrollback.read(0, 20000), self.output * 2)
+
+            scrollback.close()
+            self.assertFalse(os.path.exists(scrollback.spill_path))
+
+    def test_discards_without_spill_dir(self):
+        scrollback = Scrollback(memory_limit=1000)
+        self.fill(scrollback)
+        self.assertIsNone(scrollback.spill_path)
+        self.assertEqual(scrollback.start, 9000)
+        self.assertEqual(scrollback.read(0, 9004), b'0090')
+
+class HistoryTests(TermTestCase):
+    @tornado.testing.gen_test
+    async def test_history_request(self):
+        client = await self.get_term_client('/named/hist')
+        await client.read_all_msg()
+        term = self.named_tm.terminals['hist']
+        term.scrollback.append(b'0123456789' * 10)
+        total = term.scrollback.end
+
+        await client.write_msg(['history', -20, total - 10])
+        self.assertEqual(await client.read_msg(), [
+            'history', {'start': total - 20, 'end': total - 10, 'total': total},
+            '0123456789'])
+
+        await client.write_msg(['history', 0])
+        msg = await client.read_msg()
+        self.assertEqual(msg[1], {'start': 0, 'end': total, 'total': total})
+        self.assertTrue(msg[2].endswith('0123456789' * 10))
+        client.close()
+
+def tmux_usable():
+    if shutil.which('tmux') is None:
+        return False
+    return terminado.tmux.tmux_version() >= terminado.tmux.MIN_TMUX_VERSION
+
+@unittest.skipUnless(tmux_usable(), "needs tmux >= 3.2")
+class TmuxControlTests(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.controls = []
+
+    def tearDown(self):
+        # Before the IOLoop closes their fds
+        for control in self.controls:
+            control.close()
+        super().tearDown()
+
+    def start_control(self, script):
+        """A control client for a stand-in for tmux running ``script``"""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'tmux')
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n' + script + '\n')
+        os.chmod(path, 0o755)
+        control = terminado.tmux.TmuxControl('test', tmux=path)
+        control.start()
+        self.controls.append(control)
+        return control
+
+    @tornado.testing.gen_test
+    async def test_send_does_not_block(self):
+        control = self.start_control('sleep 0.5; exec cat >/dev/null')
+        start = time.monotonic()
+        for i in range(2000):
+            control.send('send-keys -t %%0 -H ' + '78 ' * 200)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertTrue(control.send_full())
+
+        drained = asyncio.get_event_loop().create_future()
+        control.when_drained(lambda: drained.set_result(None))
+        await asyncio.wait_for(drained, 10)
+        self.assertFalse(control.send_full())
+
+class TmuxTermManagerTests(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tm = terminado.tmux.TmuxTermManager(
+            socket_name='terminado-test-%d' % os.getpid(),
+            shell_command=['sh'])
+
+    def tearDown(self):
+        self.io_loop.run_sync(self.tm.shutdown)
+        super().tearDown()
+
+    async def wait_for(self, client, text):
+        for i in range(50):
+            if text in ''.join(client.received):
+                return
+            await asyncio.sleep(0.1)
+        self.fail("%r not in %r" % (text, ''.join(client.received)))
+
+    @tornado.testing.gen_test
+    async def test_terminals_share_one_control_client(self):
+        clients = {}
+        for name in ('alice', 'bob'):
+            term = await self.tm.get_terminal_async(name)
+            clients[name] = RecordingClient()
+            term.clients.append(clients[name])
+            term.write('echo "hello $0-%s" \u00e9\r' % name)
+        for name, client in clients.items():
+            await self.wait_for(client, 'hello sh-%s \u00e9' % name)
+        self.assertNotIn('bob', ''.join(clients['alice'].received))
+        self.assertEqual(len(self.tm.panes), 2)
+
+    @tornado.testing.gen_test
+    async def test_resize_and_exit(self):
+        term = await self.tm.get_terminal_async('carol')
+        client = RecordingClient()
+        client.size = (30, 100)
+        term.clients.append(client)
+        term.resize_to_smallest()
+        term.write('stty size; exit\r')
+        await self.wait_for(client, '30 100')
+        for i in range(50):
+            if 'carol' not in self.tm.terminals:
+                break
+            await asyncio.sleep(0.1)
+        self.assertEqual(self.tm.terminals, {})
+        self.assertEqual(self.tm.panes, {})
+
+    @tornado.testing.gen_test
+    async def test_kill_all_closes_terminals(self):
+        term = await self.tm.get_terminal_async('dave')
+        # As if tmux's notice of the window closing never came
+        self.tm.control.on_window_close = None
+        with mock.patch.object(term.scrollback, 'close',
+                               wraps=term.scrollback.close) as close:
+            await self.tm.kill_all()
+        close.assert_called_once_with()
+        self.assertEqual(self.tm.panes, {})
+        self.assertEqual(self.tm.terminals, {})
+
+    @tornado.testing.gen_test
+    async def test_input_waits_for_control_client(self):
+        term = await self.tm.get_terminal_async('erin')
+        term.input_buffer_size = 1000
+        client = RecordingClient()
+        term.clients.append(client)
+        with mock.patch.object(self.tm.control, 'send_full',
+                               return_value=True):
+            term.write('wc -c\r')
+            term.write('a' * 2000)
+            self.assertTrue(term.input_full())
+            await asyncio.sleep(0.1)
+            # Held back while tmux is behind
+            self.assertTrue(term.waiting_writable)
+            self.assertTrue(term.input_full())
+        await asyncio.wait_for(term.wait_input_space(), 5)
+        term.write('\r\x04')
+        await self.wait_for(client, '2001')
+        self.assertFalse(term.waiting_writable)
+
+    @tornado.testing.gen_test
+    async def test_pooled_pane_keeps_output(self):
+        self.tm.pool_size = 1
+        self.tm.shell_command = ['sh', '-c', 'echo ready; exec sh']
+        self.tm.fill_pool()
+        await asyncio.sleep(0.5)
+        self.assertEqual(len(self.tm.pool), 1)
+        name, term = await self.tm.new_named_terminal_async()
+        self.assertEqual(self.tm.pool_stats['hits'], 1)
+        self.assertIn(b'ready', b''.join(term.preopen_buffer))
+
+    @tornado.testing.gen_test
+    async def test_async_spawn_keeps_output(self):
+        self.tm.shell_command = ['sh', '-c', 'echo ready; exec sh']
+        term = await self.tm.get_terminal_async('frank')
+        self.assertIs(self.tm.terminals['frank'], term)
+        await asyncio.sleep(0.5)
+        self.assertIn(b'ready', b''.join(term.preopen_buffer))
+
+    @tornado.testing.gen_test
+    async def test_async_spawn_timeout(self):
+        self.tm.spawn_timeout = 0.2
+        self.tm.control.start()
+        with mock.patch.object(
+                self.tm.control, 'command',
+                lambda line, on_reply: asyncio.get_event_loop().create_future()):
+            with self.assertRaises(terminado.tmux.TmuxError):
+                await self.tm.make_terminal_async(['sh'], {}, None)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,577 @@
+"""Terminals served from one tmux server over a single control mode client.
+
+Instead of a pty and a tmux client per terminal, :class:`TmuxTermManager`
+runs each terminal's program in a window of one tmux session, and talks to
+tmux through one ``tmux -C`` process: pane output arrives as ``%output``
+notifications on its stdout, and input, resizes and flow control are sent
+as tmux commands on its stdin.
+
+This needs tmux 3.2 or newer.
+"""
+# Copyright (c) Jupyter Development Team
+# Distributed under the terms of the Simplified BSD License.
+
+from __future__ import absolute_import, print_function
+
+import asyncio
+import codecs
+from collections import deque
+import logging
+import os
+import re
+import subprocess
+
+from tornado.ioloop import IOLoop
+
+from .management import NamedTermManager, PtyWithClients, _write_queued
+
+#: Oldest tmux with everything used here (send-keys -H, refresh-client -A).
+MIN_TMUX_VERSION = (3, 2)
+
+_OCTAL_ESCAPE = re.compile(rb'\\([0-7]{3})')
+_QUOTED_CHARS = re.compile(r'([\\"$])')
+
+# Bytes of input sent per send-keys command
+_SEND_KEYS_CHUNK = 512
+
+
+class TmuxError(Exception):
+    """A tmux command failed."""
+
+
+def tmux_version(tmux='tmux'):
+    """The version of tmux as a tuple of ints, e.g. (3, 3)."""
+    out = subprocess.run([tmux, '-V'], stdout=subprocess.PIPE,
+                         check=True).stdout.decode('ascii', 'replace')
+    match = re.search(r'(\d+)\.(\d+)', out)
+    if match is None:
+        # e.g. "tmux next-3.4" or "tmux master"; assume it's recent.
+        return (99, 0)
+    return int(match.group(1)), int(match.group(2))
+
+
+def quote(arg):
+    """Quote a word for the tmux command parser."""
+    return '"%s"' % _QUOTED_CHARS.sub(r'\\\1', arg)
+
+
+def _unescape(data):
+    return _OCTAL_ESCAPE.sub(lambda m: bytes((int(m.group(1), 8),)), data)
+
+
+def _take(queue, size):
+    """Up to ``size`` bytes from the front of a deque of bytes."""
+    pieces = []
+    while queue and size > 0:
+        chunk = queue.popleft()
+        if len(chunk) > size:
+            chunk = memoryview(chunk)
+            queue.appendleft(chunk[size:])
+            chunk = chunk[:size]
+        pieces.append(chunk)
+        size -= len(chunk)
+    return b''.join(pieces)
+
+
+class _Reply(object):
+    __slots__ = ('lines', 'error', 'future', 'on_reply')
+
+    def __init__(self, future=None, on_reply=None):
+        self.lines = None
+        self.error = False
+        self.future = future
+        self.on_reply = on_reply
+
+
+class TmuxControl(object):
+    """A ``tmux -C`` client attached to ``session``.
+
+    Every pane in a window of that session reports its output to
+    ``on_output(pane_id, data)``. ``on_window_close(window_id)`` is called
+    when a window goes away, and ``on_exit()`` when the control client does.
+
+    Commands are queued and written to tmux as fast as it reads them, so
+    sending never blocks the event loop; see :meth:`send_full`. Replies
+    and notifications are only handled as tmux's output is read by the
+    event loop.
+    """
+
+    #: Bytes of commands queued for tmux before :meth:`send_full` is true.
+    send_buffer_size = 65536
+
+    def __init__(self, session, socket_name=None, tmux='tmux',
+                 on_output=None, on_window_close=None, on_exit=None):
+        self.session = session
+        self.socket_name = socket_name
+        self.tmux = tmux
+        self.on_output = on_output
+        self.on_window_close = on_window_close
+        self.on_exit = on_exit
+        self.log = logging.getLogger(__name__)
+        self.proc = None
+        self._replies = deque()
+        self._block = None
+        self._partial = b''
+        self._lines = deque()
+        # Commands not yet written to tmux's stdin
+        self._out = deque()
+        self._out_size = 0
+        self._writing = False
+        self._drain_callbacks = []
+
+    def start(self):
+        argv = [self.tmux]
+        if self.socket_name:
+            argv += ['-L', self.socket_name]
+        # The session's first window only keeps it alive.
+        argv += ['-C', 'new-session', '-A', '-s', self.session, 'cat']
+        self.proc = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL)
+        os.set_blocking(self.proc.stdout.fileno(), False)
+        os.set_blocking(self.proc.stdin.fileno(), False)
+        # tmux replies to the new-session command like any other.
+        self._replies.append(_Reply())
+        loop = IOLoop.current()
+        loop.add_handler(self.proc.stdout.fileno(), self._on_readable,
+                         loop.READ)
+
+    def command(self, line, on_reply=None):
+        """Send a command; returns a Future for its output lines.
+
+        The Future fails with :exc:`TmuxError` if tmux reports an error.
+        ``on_reply(lines)``, if given, is called as soon as a successful
+        reply is read, before any notifications after it are handled, and
+        even if the Future has been cancelled; the Future gets what it
+        returns instead of the lines.
+        """
+        reply = _Reply(asyncio.get_event_loop().create_future(), on_reply)
+        self._send(line, reply)
+        return reply.future
+
+    def _send(self, line, reply):
+        if self.proc is None:
+            # Closed, like a pane closing in the background after shutdown
+            reply.lines = ["tmux control client closed"]
+            reply.error = True
+            self._finish(reply)
+            return
+        self._replies.append(reply)
+        data = line.encode('utf-8') + b'\n'
+        self._out.append(data)
+        self._out_size += len(data)
+        if not self._writing:
+            self._write()
+
+    def send_full(self):
+        """Whether :attr:`send_buffer_size` bytes of commands are waiting."""
+        return self._out_size >= self.send_buffer_size
+
+    def when_drained(self, callback):
+        """Call ``callback()`` once every queued command has been written.
+
+        Also called if the control client closes first.
+        """
+        if not self._out:
+            IOLoop.current().add_callback(callback)
+        else:
+            self._drain_callbacks.append(callback)
+
+    def _write(self, fd=None, events=None):
+        """Write queued commands until tmux's stdin would block."""
+        try:
+            self._out_size -= _write_queued(self.proc.stdin.fileno(), self._out)
+        except OSError:
+            # Gone; _on_readable will see the EOF.
+            self._out.clear()
+            self._out_size = 0
+        writing = bool(self._out)
+        if writing != self._writing:
+            loop = IOLoop.current()
+            if writing:
+                loop.add_handler(self.proc.stdin.fileno(), self._write,
+                                 loop.WRITE)
+            else:
+                loop.remove_handler(self.proc.stdin.fileno())
+            self._writing = writing
+        if not writing:
+            self._drained()
+
+    def _drained(self):
+        callbacks, self._drain_callbacks = self._drain_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def _read(self):
+        try:
+            data = os.read(self.proc.stdout.fileno(), 65536)
+        except BlockingIOError:
+            return True
+        if not data:
+            return False
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        self._lines.extend(lines)
+        return True
+
+    def _on_readable(self, fd, events):
+        if not self._read():
+            self.close()
+            if self.on_exit is not None:
+                self.on_exit()
+            return
+        self._process()
+
+    def _process(self):
+        """Handle buffered lines."""
+        lines = self._lines
+        while lines:
+            self._handle_line(lines.popleft())
+
+    def _handle_line(self, line):
+        if self._block is not None:
+            if line.startswith((b'%end ', b'%error ')):
+                reply = self._replies.popleft()
+                reply.lines = [l.decode('utf-8', 'replace')
+                               for l in self._block]
+                reply.error = line.startswith(b'%error')
+                self._block = None
+                self._finish(reply)
+            else:
+                self._block.append(line)
+        elif line.startswith(b'%output '):
+            pane_id, _, data = line[8:].partition(b' ')
+            self.on_output(pane_id.decode('ascii'), _unescape(data))
+        elif line.startswith(b'%begin '):
+            self._block = []
+        elif line.startswith((b'%window-close ', b'%unlinked-window-close ')):
+            if self.on_window_close is not None:
+                self.on_window_close(line.split()[1].decode('ascii'))
+        elif line.startswith(b'%exit'):
+            self.log.info("tmux control client exiting: %r", line)
+
+    def _finish(self, reply):
+        result = reply.lines
+        if reply.on_reply is not None and not reply.error:
+            try:
+                result = reply.on_reply(reply.lines)
+            except Exception as e:
+                if reply.future is None or reply.future.done():
+                    self.log.exception("Failed to handle tmux reply")
+                else:
+                    reply.future.set_exception(e)
+                return
+        if reply.future is None or reply.future.done():
+            if reply.error and reply.future is None and reply.lines:
+                self.log.debug("tmux: %s", ' '.join(reply.lines))
+            return
+        if reply.error:
+            reply.future.set_exception(TmuxError('\n'.join(reply.lines)))
+        else:
+            reply.future.set_result(result)
+
+    def send(self, line):
+        """Send a command without waiting for its result."""
+        self._send(line, _Reply())
+
+    def close(self):
+        if self.proc is None:
+            return
+        loop = IOLoop.current()
+        loop.remove_handler(self.proc.stdout.fileno())
+        stdin = self.proc.stdin.fileno()
+        if self._writing:
+            loop.remove_handler(stdin)
+            self._writing = False
+        if self._out:
+            # Let tmux have the last commands, like a kill-session.
+            os.set_blocking(stdin, True)
+            try:
+                while self._out:
+                    _write_queued(stdin, self._out)
+            except OSError:
+                pass
+            self._out.clear()
+            self._out_size = 0
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.proc.wait()
+        self.proc.stdout.close()
+        self.proc = None
+        self._drained()
+
+
+class TmuxPaneProcess(object):
+    """Stands in for a PtyProcess: the program in a tmux pane."""
+
+    delayafterterminate = 0.1
+    fd = None
+
+    def __init__(self, control, window_id, pane_id, pid, rows=24, cols=80):
+        self.control = control
+        self.window_id = window_id
+        self.pane_id = pane_id
+        self.pid = pid
+        self.rows = rows
+        self.cols = cols
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.flag_eof = False
+
+    def getwinsize(self):
+        return self.rows, self.cols
+
+    def setwinsize(self, rows, cols):
+        self.rows, self.cols = rows, cols
+        self.control.send('resize-window -t %s -x %d -y %d'
+                          % (self.window_id, cols, rows))
+
+    def isalive(self):
+        if self.flag_eof:
+            return False
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def kill(self, sig):
+        os.kill(self.pid, sig)
+
+    def close(self, force=True):
+        if not self.flag_eof:
+            self.flag_eof = True
+            self.control.send('kill-window -t %s' % self.window_id)
+
+
+def _new_window_command(session, argv, env, cwd):
+    """The tmux command starting ``argv`` in a new window of ``session``.
+
+    Its reply is the window id, pane id and pid of the program.
+    """
+    args = ['new-window', '-d', '-t', quote(session + ':'),
+            '-P', '-F', quote('#{window_id} #{pane_id} #{pane_pid}')]
+    if cwd:
+        args += ['-c', quote(cwd)]
+    # The tmux server shares our environment; pass on what differs.
+    for key, value in sorted(env.items()):
+        if os.environ.get(key) != value:
+            args += ['-e', quote('%s=%s' % (key, value))]
+    args += [quote(arg) for arg in argv]
+    return ' '.join(args)
+
+
+class TmuxPane(PtyWithClients):
+    """A terminal whose program runs in a tmux window of ``control``'s session.
+
+    Made for a window tmux has already started, given its
+    :class:`TmuxPaneProcess`; see :meth:`TmuxTermManager.make_terminal_async`.
+    """
+
+    def __init__(self, control, ptyproc):
+        self.control = control
+        self._started = ptyproc
+        super(TmuxPane, self).__init__(None, {}, None)
+
+    def spawn(self, argv, env, cwd):
+        ptyproc = self._started
+        # Windows not shown by any tmux client keep the size we give them.
+        ptyproc.setwinsize(ptyproc.rows, ptyproc.cols)
+        return ptyproc
+
+    def write(self, s):
+        """Send text or bytes to the pane as keystrokes.
+
+        Input is queued as for a pty, and sent while the control client
+        keeps up with the commands; see :meth:`input_full`.
+        """
+        if isinstance(s, str):
+            s = s.encode('utf-8')
+        return self._queue_input(s)
+
+    def write_input(self):
+        """Send queued input until the control client is backed up."""
+        self._input_scheduled = False
+        control = self.control
+        if control.proc is None or self.ptyproc.flag_eof:
+            # Nothing will read this.
+            self.discard_input()
+            return
+        pane_id = self.ptyproc.pane_id
+        while self._input and not control.send_full():
+            chunk = _take(self._input, _SEND_KEYS_CHUNK)
+            self._input_size -= len(chunk)
+            control.send('send-keys -t %s -H %s' % (
+                pane_id, ' '.join('%02x' % b for b in chunk)))
+        self._set_waiting_writable(bool(self._input))
+        if self._input:
+            control.when_drained(self.write_input)
+        if not self.input_full():
+            self._wake_writers()
+
+
+class TmuxTermManager(NamedTermManager):
+    """Named terminals as windows of one tmux session.
+
+    All of them share a single tmux server (on ``socket_name``, see
+    ``tmux -L``) and a single control mode client attached to ``session``,
+    so there is one pipe to read instead of a pty per terminal.
+
+    Pausing a terminal (see :meth:`pause_reading`) uses tmux's per-pane
+    pause: tmux drops the pane's output rather than blocking the program,
+    and the program is asked to redraw when reading resumes.
+
+    Starting a terminal means waiting for tmux, so it is only done by the
+    asynchronous methods, like :meth:`get_terminal_async` and
+    :meth:`new_named_terminal_async`; the others can only hand out pooled
+    terminals and running ones.
+    """
+
+    #: Seconds :meth:`make_terminal_async` waits for tmux to start a window.
+    spawn_timeout = 10
+
+    def __init__(self, socket_name='terminado', session='terminado',
+                 tmux_command='tmux', **kwargs):
+        super(TmuxTermManager, self).__init__(**kwargs)
+        version = tmux_version(tmux_command)
+        if version < MIN_TMUX_VERSION:
+            raise RuntimeError("tmux %d.%d or newer is needed, found %d.%d"
+                               % (MIN_TMUX_VERSION + version))
+        self.control = TmuxControl(session, socket_name, tmux_command,
+                                   on_output=self.on_pane_output,
+                                   on_window_close=self.on_window_close,
+                                   on_exit=self.on_control_exit)
+        self.panes = {}
+        self._panes_by_window = {}
+
+    def make_terminal(self, argv, env, cwd):
+        # Waiting here for tmux to start the window would hold up every
+        # other terminal.
+        raise NotImplementedError("tmux terminals are started with "
+                                  "get_terminal_async(), "
+                                  "new_named_terminal_async() and the like")
+
+    async def make_terminal_async(self, argv, env, cwd):
+        """Have tmux start ``argv`` in a new window, without blocking.
+
+        Raises :exc:`TmuxError` if tmux fails to, or hasn't replied within
+        :attr:`spawn_timeout` seconds.
+        """
+        if self.control.proc is None:
+            self.control.start()
+
+        def on_reply(lines):
+            if started.cancelled():
+                # Given up on; don't leave the program running unseen.
+                self.control.send('kill-window -t %s' % lines[0].split()[0])
+                return None
+            return self._pane_started(lines)
+
+        started = self.control.command(
+            _new_window_command(self.control.session, argv, env, cwd),
+            on_reply)
+        try:
+            return await asyncio.wait_for(started, self.spawn_timeout)
+        except asyncio.TimeoutError:
+            raise TmuxError("tmux didn't start a window in %s seconds"
+                            % self.spawn_timeout)
+
+    def _pane_started(self, lines):
+        window_id, pane_id, pid = lines[0].split()
+        term = TmuxPane(self.control, TmuxPaneProcess(
+            self.control, window_id, pane_id, int(pid)))
+        # Unlike a pty, tmux doesn't hold on to output nobody reads, so
+        # keep the pane's output (its prompt, say) until it's read from.
+        self.panes[pane_id] = term
+        return term
+
+    def spawn_pooled(self):
+        # The control client isn't thread safe, and there's no fork to wait
+        # for; starting the window is just a command to await.
+        return asyncio.ensure_future(self.make_terminal_async(
+            self.pool_command(), self.make_term_env(**self.term_settings),
+            None))
+
+    def discard_pooled(self, term):
+        self.panes.pop(term.ptyproc.pane_id, None)
+        super(TmuxTermManager, self).discard_pooled(term)
+
+    def start_reading(self, ptywclients):
+        ptyproc = ptywclients.ptyproc
+        self.panes[ptyproc.pane_id] = ptywclients
+        self._panes_by_window[ptyproc.window_id] = ptywclients
+        self.configure_terminal(ptywclients)
+
+    def update_events(self, ptywclients):
+        # Panes have no fd to watch; TmuxPane.write_input() waits for the
+        # control client itself.
+        pass
+
+    def stop_reading(self, ptywclients):
+        ptyproc = ptywclients.ptyproc
+        self.log.info("tmux pane %s closed", ptyproc.pane_id)
+        self.panes.pop(ptyproc.pane_id, None)
+        self._panes_by_window.pop(ptyproc.window_id, None)
+
+    def pause_reading(self, ptywclients, client):
+        if not ptywclients.paused_by:
+            self.control.send('refresh-client -A %s'
+                              % quote(ptywclients.ptyproc.pane_id + ':pause'))
+        ptywclients.paused_by.add(client)
+
+    def resume_reading(self, ptywclients, client):
+        if client not in ptywclients.paused_by:
+            return
+        ptywclients.paused_by.discard(client)
+        if not ptywclients.paused_by and ptywclients.ptyproc.isalive():
+            self.control.send('refresh-client -A %s'
+                              % quote(ptywclients.ptyproc.pane_id + ':continue'))
+            # Output was dropped while paused.
+            ptywclients.redraw()
+
+    def on_pane_output(self, pane_id, data):
+        pane = self.panes.get(pane_id)
+        if pane is not None:
+            pane.on_output(data)
+
+    def on_window_close(self, window_id):
+        pane = self._panes_by_window.get(window_id)
+        if pane is not None:
+            self.pane_died(pane)
+
+    def on_control_exit(self):
+        for pane in list(self.panes.values()):
+            self.pane_died(pane)
+
+    def pane_died(self, pane):
+        pane.ptyproc.flag_eof = True
+        pane.flush()
+        self.on_eof(pane)
+        for client in pane.clients:
+            client.on_pty_died()
+
+    async def kill_all(self):
+        terms = list(self.terminals.values())
+        futures = [term.terminate(force=True) for term in terms]
+        if futures:
+            await asyncio.gather(*futures)
+        # Don't wait for %window-close notifications, which shutdown()
+        # closes the control client before seeing.
+        for term in terms:
+            if self.panes.get(term.ptyproc.pane_id) is term:
+                self.pane_died(term)
+        for name in self.terminals:
+            self._emit('remove', name)
+        self.terminals = {}
+
+    async def shutdown(self):
+        await self.drain_pool()
+        await self.kill_all()
+        if self.control.proc is not None:
+            self.control.send('kill-session -t %s' % quote(self.control.session))
+            self.control.close()
+        if self.audit_log is not None:
+            self.audit_log.close()
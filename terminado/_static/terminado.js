@@ -2,8 +2,18 @@
 // Copyright (c) 2014, Ramalingam Saravanan <sarava@sarava.net>
 // Distributed under the terms of the Simplified BSD License.
 
+// Binary subprotocol (see terminado/websocket.py): stdout and stdin are raw
+// bytes behind a one-byte opcode. It is always offered; servers that don't
+// select it get the JSON protocol.
+var BINARY_SUBPROTOCOL = "terminado.binary";
+var BINARY_STDOUT = 0x01;
+var BINARY_STDIN = 0x02;
+
 function make_terminal(element, size, ws_url) {
-    var ws = new WebSocket(ws_url);
+    var ws = new WebSocket(ws_url, [BINARY_SUBPROTOCOL]);
+    ws.binaryType = "arraybuffer";
+    var decoder = new TextDecoder("utf-8");
+    var encoder = new TextEncoder();
     var term = new Terminal({
       cols: size.cols,
       rows: size.rows,
@@ -11,10 +21,19 @@ function make_terminal(element, size, ws_url) {
       useStyle: true
     });
     ws.onopen = function(event) {
+        var binary = (ws.protocol === BINARY_SUBPROTOCOL);
         ws.send(JSON.stringify(["set_size", size.rows, size.cols,
                                     window.innerHeight, window.innerWidth]));
         term.on('data', function(data) {
-            ws.send(JSON.stringify(['stdin', data]));
+            if (binary) {
+                var bytes = encoder.encode(data);
+                var frame = new Uint8Array(bytes.length + 1);
+                frame[0] = BINARY_STDIN;
+                frame.set(bytes, 1);
+                ws.send(frame);
+            } else {
+                ws.send(JSON.stringify(['stdin', data]));
+            }
         });
 
         term.on('title', function(title) {
@@ -24,6 +43,13 @@ function make_terminal(element, size, ws_url) {
         term.open(element);
 
         ws.onmessage = function(event) {
+            if (typeof event.data !== "string") {
+                var frame = new Uint8Array(event.data);
+                if (frame[0] === BINARY_STDOUT) {
+                    term.write(decoder.decode(frame.subarray(1), {stream: true}));
+                }
+                return;
+            }
             json_msg = JSON.parse(event.data);
             switch(json_msg[0]) {
                 case "stdout":
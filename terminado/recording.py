@@ -0,0 +1,167 @@
+"""Recording terminal sessions as asciicast files that can be replayed from any point.
+"""
+# Copyright (c) Jupyter Development Team
+# Distributed under the terms of the Simplified BSD License.
+
+from __future__ import absolute_import, print_function
+
+import codecs
+import json
+import re
+import time
+
+from tornado.ioloop import IOLoop
+
+_UNSAFE_FILENAME = re.compile(r'[^\w.-]')
+
+
+class Recorder(object):
+    """Writes a terminal's output to ``path`` in asciicast v2 format.
+
+    The file is a JSON header line, then a line per event: ``[seconds, "o",
+    text]`` for output and ``[seconds, "r", "COLSxROWS"]`` for a resize, as
+    played by asciinema. Alongside it, ``path + ".idx"`` gets a line every
+    ``index_interval`` seconds of output, ``[seconds, offset, cols, rows,
+    screen]``, giving the byte offset of the next event in the recording
+    and, if the terminal has a :class:`~terminado.Screen`, escape sequences
+    that paint the screen as it was at that point; see :func:`replay`.
+
+    Events are held in memory and written together, at most
+    ``flush_interval`` seconds or ``flush_size`` bytes later, and before each
+    index entry, so a busy terminal doesn't cost a write per read. A
+    recording being made can be replayed up to the last :meth:`flush`.
+    """
+
+    def __init__(self, path, rows, cols, index_interval=10.0,
+                 flush_interval=1.0, flush_size=65536):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.index_interval = index_interval
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.size = (rows, cols)
+        self.started = time.monotonic()
+        self._file = open(path, 'wb', buffering=0)
+        self._pending = []
+        self._pending_size = 0
+        self._flush_handle = None
+        self._index = open(self.index_path, 'w', encoding='utf-8')
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._next_index = 0.0
+        header = {'version': 2, 'width': cols, 'height': rows,
+                  'timestamp': int(time.time())}
+        self._file.write(json.dumps(header).encode('utf-8') + b'\n')
+        self.offset = self._file.tell()
+
+    def output(self, data, screen=None):
+        """Record output bytes; ``screen`` is the terminal's screen before them."""
+        now = time.monotonic() - self.started
+        if now >= self._next_index:
+            self._add_index(now, screen)
+        text = self._decoder.decode(data)
+        if text:
+            self._event(now, 'o', text)
+
+    def resize(self, rows, cols):
+        self.size = (rows, cols)
+        self._event(time.monotonic() - self.started, 'r', '%dx%d' % (cols, rows))
+
+    def _event(self, when, code, data):
+        line = json.dumps([round(when, 6), code, data]).encode('utf-8') + b'\n'
+        self._pending.append(line)
+        self._pending_size += len(line)
+        self.offset += len(line)
+        if self._pending_size >= self.flush_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = IOLoop.current().call_later(
+                self.flush_interval, self.flush)
+
+    def flush(self):
+        """Write out the events held in memory."""
+        if self._flush_handle is not None:
+            IOLoop.current().remove_timeout(self._flush_handle)
+            self._flush_handle = None
+        if not self._pending:
+            return
+        data = b''.join(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        self._file.write(data)
+
+    def _add_index(self, when, screen):
+        # The offset in the entry must be in the file before the entry is.
+        self.flush()
+        rows, cols = self.size
+        snapshot = screen.snapshot() if screen is not None else None
+        self._index.write(json.dumps([round(when, 6), self.offset, cols, rows,
+                                      snapshot]) + '\n')
+        self._index.flush()
+        self._next_index = when + self.index_interval
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+        self._index.close()
+
+
+def recording_name(label, pid):
+    """A file name for a recording of ``label``'s session starting now."""
+    return '%s-%s-%d.cast' % (_UNSAFE_FILENAME.sub('_', label),
+                              time.strftime('%Y%m%d-%H%M%S'), pid)
+
+
+def _time_of(line):
+    """The time at the start of an event or index line, without parsing it."""
+    return float(line[1:line.index(b',')])
+
+
+def find_index(index_path, start):
+    """The last index entry of a recording at or before ``start`` seconds.
+
+    Only the time at the start of each line is looked at, until the one
+    wanted is found. Returns None if there is none.
+    """
+    found = None
+    try:
+        with open(index_path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n') or _time_of(line) > start:
+                    break
+                found = line
+    except FileNotFoundError:
+        return None
+    return json.loads(found) if found is not None else None
+
+
+def replay(path, start=0, end=None):
+    """Yield the lines of a recording from ``start`` seconds on.
+
+    The result is itself an asciicast v2 recording, with times counted from
+    ``start``. Rather than reading the file from the beginning, this jumps
+    to the last index point before ``start``, paints the screen as it was
+    there if the index has it, and plays the output since then at once.
+    Events after ``end`` seconds, if given, are left out.
+    """
+    with open(path, 'rb') as f:
+        header = json.loads(f.readline())
+        entry = find_index(path + '.idx', start) if start > 0 else None
+        if entry is not None:
+            when, offset, cols, rows, snapshot = entry
+            header['width'], header['height'] = cols, rows
+            f.seek(offset)
+        yield json.dumps(header) + '\n'
+        if entry is not None and snapshot is not None:
+            yield json.dumps([0.0, 'o', snapshot]) + '\n'
+        for line in f:
+            if not line.endswith(b'\n'):
+                # Still being written
+                break
+            comma = line.index(b',')
+            when = float(line[1:comma])
+            if end is not None and when > end:
+                break
+            yield '[%s%s' % (round(max(when - start, 0.0), 6),
+                             line[comma:].decode('utf-8'))
@@ -14,12 +14,40 @@ try:
 except ImportError:
     from urlparse import urlparse
 
+import asyncio
+from collections import Counter
 import json
 import logging
 import re
+import struct
+import zlib
 
+import tornado.escape
 import tornado.web
 import tornado.websocket
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+
+from .management import MaxTerminalsReached, PtyOutput
+from .screen import Screen
+
+_LOGGABLE_OUTPUT = re.compile(r'^(\w|\d)+')
+# Log terminal input and output at debug level; see log_terminal_output().
+_LOG_TERMINAL_OUTPUT = os.getenv("LOG_TERMINAL_OUTPUT", "false").lower() == "true"
+
+# Opt-in binary subprotocol: stdout and stdin travel as binary frames of raw
+# terminal bytes behind a one-byte opcode; other messages stay JSON text.
+BINARY_SUBPROTOCOL = 'terminado.binary'
+BINARY_STDOUT = 0x01    # server -> client
+BINARY_STDIN = 0x02     # client -> server
+BINARY_HISTORY = 0x03   # server -> client: start offset, total, then bytes
+_HISTORY_HEADER = struct.Struct('>QQ')
+
+# PreparedMessage and TermWebSocketProtocol reach into private parts of
+# tornado's websocket implementation, as of tornado 6.1 (see setup.cfg).
+# Where those aren't there, messages are sent with write_message() instead.
+_FRAME_ATTRIBUTES = ('_write_frame', '_compressor', '_message_bytes_out', 'RSV1')
+_COMPRESSOR_ATTRIBUTES = ('_max_wbits', '_compression_level', '_mem_level')
 
 
 def _cast_unicode(s):
@@ -28,9 +56,87 @@ def _cast_unicode(s):
     return s
 
 
+class PreparedMessage(object):
+    """A websocket message serialised once and sent to many connections.
+
+    Deflate without context takeover compresses a message the same way on
+    every connection with the same settings, so compressed payloads are
+    cached per compressor configuration too. Context takeover is on by
+    default, though; see
+    :meth:`~terminado.management.TermManagerBase.websocket_compression_options`.
+    """
+
+    def __init__(self, message, binary=False):
+        self.data = tornado.escape.utf8(message)
+        self.binary = binary
+        self._compressed = {}
+
+    def compress(self, compressor):
+        """Return the payload compressed by a tornado deflate compressor."""
+        if (getattr(compressor, '_compressor', True) is not None
+                or not all(hasattr(compressor, name)
+                           for name in _COMPRESSOR_ATTRIBUTES)):
+            # Context takeover: the compressor state is per connection.
+            # (Or a tornado we can't tell with; don't share its output.)
+            return compressor.compress(self.data)
+        key = tuple(getattr(compressor, name) for name in _COMPRESSOR_ATTRIBUTES)
+        data = self._compressed.get(key)
+        if data is None:
+            data = self._compressed[key] = compressor.compress(self.data)
+        return data
+
+
+class TermWebSocketProtocol(tornado.websocket.WebSocketProtocol13):
+    """The websocket protocol with permessage-deflate tuned for terminals.
+
+    Besides tornado's ``compression_level`` and ``mem_level``, the
+    compression options may hold ``server_max_window_bits`` and
+    ``server_no_context_takeover``, which the server imposes on its own
+    side of the negotiation, and ``min_size``: messages shorter than that
+    many bytes are sent uncompressed.
+    """
+
+    @property
+    def min_compress_size(self):
+        return (self._compression_options or {}).get('min_size', 0)
+
+    def _create_compressors(self, side, agreed_parameters,
+                            compression_options=None):
+        if side == 'server' and compression_options:
+            # The parameters are echoed in the handshake response, so the
+            # client learns what we chose.
+            wbits = compression_options.get('server_max_window_bits')
+            if wbits:
+                offered = agreed_parameters.get('server_max_window_bits')
+                agreed_parameters['server_max_window_bits'] = str(
+                    min(int(offered or zlib.MAX_WBITS), wbits))
+            if compression_options.get('server_no_context_takeover'):
+                agreed_parameters['server_no_context_takeover'] = None
+        super(TermWebSocketProtocol, self)._create_compressors(
+            side, agreed_parameters, compression_options)
+
+    def write_message(self, message, binary=False):
+        compressor = getattr(self, '_compressor', None)
+        if compressor is None or len(message) >= self.min_compress_size:
+            return super(TermWebSocketProtocol, self).write_message(
+                message, binary)
+        self._compressor = None
+        try:
+            return super(TermWebSocketProtocol, self).write_message(
+                message, binary)
+        finally:
+            self._compressor = compressor
+
+
 class TermSocket(tornado.websocket.WebSocketHandler):
     """Handler for a terminal websocket"""
 
+    #: True once the client has negotiated :data:`BINARY_SUBPROTOCOL`.
+    binary = False
+
+    #: Most bytes of scrollback sent in reply to one history request.
+    max_history_read = 1048576
+
     def initialize(self, term_manager):
         self.term_manager = term_manager
         self.term_name = ""
@@ -38,17 +144,44 @@ class TermSocket(tornado.websocket.WebSocketHandler):
         self.terminal = None
 
         self._logger = logging.getLogger(__name__)
-        self._user_command = ''
+        # Pieces of the command being typed, for logging once it's entered
+        self._user_command = []
+
+        # Bytes handed to the websocket but not yet flushed to the socket.
+        self.queued_bytes = 0
+        # True while over the manager's high watermark, until drained to
+        # its low watermark.
+        self.saturated = False
+        # Scrollback offset of the first output dropped while saturated
+        self._dropped_from = None
+        self.backpressure_stats = Counter()
 
     def origin_check(self, origin=None):
         """Deprecated: backward-compat for terminado <= 0.5."""
         return self.check_origin(origin or self.request.headers.get('Origin'))
 
-    def open(self, url_component=None):
+    def select_subprotocol(self, subprotocols):
+        """Accept the binary subprotocol if the client offers it."""
+        if BINARY_SUBPROTOCOL in subprotocols:
+            return BINARY_SUBPROTOCOL
+        return None
+
+    def get_compression_options(self):
+        return self.term_manager.websocket_compression_options()
+
+    def get_websocket_protocol(self):
+        protocol = super(TermSocket, self).get_websocket_protocol()
+        if (type(protocol) is tornado.websocket.WebSocketProtocol13
+                and hasattr(protocol, '_create_compressors')):
+            protocol = TermWebSocketProtocol(self, False, protocol.params)
+        return protocol
+
+    async def open(self, url_component=None):
         """Websocket connection opened.
 
         Call our terminal manager to get a terminal, and connect to it as a
-        client.
+        client. Messages from the client wait until it is connected, while
+        the terminal may be starting.
         """
         # Jupyter has a mixin to ping websockets and keep connections through
         # proxies alive. Call super() to allow that to set up:
@@ -58,32 +191,159 @@ class TermSocket(tornado.websocket.WebSocketHandler):
 
         url_component = _cast_unicode(url_component)
         self.term_name = url_component or 'tty'
-        self.terminal = self.term_manager.get_terminal(url_component)
+        self.binary = self.selected_subprotocol == BINARY_SUBPROTOCOL
+        try:
+            self.terminal = await self.term_manager.get_terminal_async(url_component)
+        except MaxTerminalsReached as e:
+            # Expected under load; tell the client rather than log a traceback
+            self._logger.warning("TermSocket.open: %s", e)
+            self.close(1013, str(e))    # Try Again Later
+            return
+        if self.ws_connection is None:
+            # Closed while the terminal was starting; on_close has run.
+            self.term_manager.client_disconnected(self)
+            self.terminal = None
+            return
         self.terminal.clients.append(self)
+        self.term_manager.update_flow_control(self.terminal)
         self.send_json_message(["setup", {}])
         self._logger.info("TermSocket.open: Opened %s", self.term_name)
+        if self.terminal.screen is not None:
+            # Paint the current screen rather than replaying output.
+            self.on_pty_output(self.terminal.snapshot_output())
+            return
         # Now drain the preopen buffer, if it exists.
-        buffered = ""
-        while True:
-            if not self.terminal.preopen_buffer:
-                break
-            s = self.terminal.preopen_buffer.popleft()
-            buffered += s
+        preopen_buffer = self.terminal.preopen_buffer
+        buffered = b''.join(preopen_buffer)
+        preopen_buffer.clear()
         if buffered:
-            self.on_pty_read(buffered)
+            self.on_pty_output(
+                self.terminal.make_output(buffered, text=not self.binary))
 
     def on_pty_read(self, text):
         """Data read from pty; send to frontend"""
-        self.send_json_message(['stdout', text])
+        self.on_pty_output(PtyOutput(text.encode('utf-8'), text))
+
+    def on_pty_output(self, output):
+        """Output shared with the terminal's other clients; send to frontend
+
+        Each frame is built by the first client to need it and reused by the
+        rest.
+        """
+        if (self.saturated
+                and self.term_manager.slow_client_policy in ('drop', 'disconnect')):
+            # Dropping until drained, or waiting for our disconnect to finish
+            self.backpressure_stats['dropped_bytes'] += len(output.data)
+            return
+        if self.binary:
+            message = output.cache.get('binary')
+            if message is None:
+                message = PreparedMessage(
+                    bytes((BINARY_STDOUT,)) + output.data, binary=True)
+                output.cache['binary'] = message
+            self.write_prepared(message)
+            return
+        message = output.cache.get('json')
+        if message is None:
+            message = PreparedMessage(json.dumps(['stdout', output.text]))
+            output.cache['json'] = message
+        if _LOG_TERMINAL_OUTPUT and _LOGGABLE_OUTPUT.search(output.text):
+            self.log_terminal_output(f'STDOUT: {output.text}')
+        self.write_prepared(message)
+
+    def write_prepared(self, message):
+        """Send a :class:`PreparedMessage` without re-encoding it.
+
+        Like :meth:`write_message`, returns a Future for flow control and
+        raises :exc:`~tornado.websocket.WebSocketClosedError` if the
+        connection is closed.
+        """
+        conn = self.ws_connection
+        if conn is None or conn.is_closing():
+            raise tornado.websocket.WebSocketClosedError()
+        if not all(hasattr(conn, name) for name in _FRAME_ATTRIBUTES):
+            # Not a protocol we know how to write raw frames to.
+            fut = self.write_message(message.data, binary=message.binary)
+            self._track_write(fut, len(message.data))
+            return fut
+        data = message.data
+        conn._message_bytes_out += len(data)
+        flags = 0
+        if (conn._compressor is not None
+                and len(data) >= getattr(conn, 'min_compress_size', 0)):
+            data = message.compress(conn._compressor)
+            flags |= conn.RSV1
+        opcode = 0x2 if message.binary else 0x1
+        try:
+            fut = conn._write_frame(True, opcode, data, flags=flags)
+        except StreamClosedError:
+            raise tornado.websocket.WebSocketClosedError()
+        self._track_write(fut, len(data))
+
+        async def wrapper():
+            try:
+                await fut
+            except StreamClosedError:
+                raise tornado.websocket.WebSocketClosedError()
+
+        return asyncio.ensure_future(wrapper())
+
+    def _track_write(self, fut, size):
+        """Account for bytes queued on the websocket until they're flushed."""
+        self.queued_bytes += size
+        fut.add_done_callback(lambda f: self._on_write_done(size))
+        manager = self.term_manager
+        if (not self.saturated
+                and (manager.slow_client_policy or manager.flow_control)
+                and self.queued_bytes > manager.client_high_watermark):
+            self._on_saturated()
+
+    def _on_write_done(self, size):
+        self.queued_bytes -= size
+        if (self.saturated
+                and self.term_manager.slow_client_policy != 'disconnect'
+                and self.queued_bytes <= self.term_manager.client_low_watermark):
+            self._on_drained()
+
+    def _on_saturated(self):
+        """Too much output is waiting to be sent: apply the manager's policy."""
+        policy = self.term_manager.slow_client_policy
+        self.saturated = True
+        if policy:
+            self.backpressure_stats[policy] += 1
+            self.term_manager.backpressure_stats[policy] += 1
+            self._logger.info("TermSocket %s: slow client, applying %r",
+                              self.term_name, policy)
+        if policy == 'pause':
+            self.term_manager.pause_reading(self.terminal, self)
+        elif policy == 'disconnect':
+            self.close(1013, "Client too slow")
+        elif policy == 'drop':
+            # Everything delivered so far has been queued for sending
+            self._dropped_from = self.terminal.scrollback.end
+        # 'drop' discards output in on_pty_output until we drain.
+        self.term_manager.update_flow_control(self.terminal)
+
+    def _on_drained(self):
+        self.saturated = False
+        if self.terminal is None or self.ws_connection is None:
+            return
+        policy = self.term_manager.slow_client_policy
+        if policy == 'pause':
+            self.term_manager.resume_reading(self.terminal, self)
+        elif policy == 'drop':
+            self.backpressure_stats['resync'] += 1
+            self.term_manager.backpressure_stats['resync'] += 1
+            # Resending may saturate us again, setting _dropped_from anew
+            since, self._dropped_from = self._dropped_from, None
+            self.terminal.resync(self, since)
+        self.term_manager.update_flow_control(self.terminal)
 
     def send_json_message(self, content):
         json_msg = json.dumps(content)
-        pattern = re.compile(r'^(\w|\d)+')
-        try:
-            if pattern.search(content[1]):
-                self.log_terminal_output(f'STDOUT: {content[1]}')
-        except TypeError as e:
-            self._logger.error(f'not able to serialize: {e}')
+        if (_LOG_TERMINAL_OUTPUT and isinstance(content[1], str)
+                and _LOGGABLE_OUTPUT.search(content[1])):
+            self.log_terminal_output(f'STDOUT: {content[1]}')
         self.write_message(json_msg)
 
     def on_message(self, message):
@@ -91,21 +351,79 @@ class TermSocket(tornado.websocket.WebSocketHandler):
 
         We send JSON arrays, where the first element is a string indicating
         what kind of message this is. Data associated with the message follows.
+        Clients using the binary subprotocol send stdin as binary frames.
+
+        While the terminal has a full buffer of input it hasn't taken yet,
+        as after a large paste, this returns an awaitable, and the next
+        message isn't read from the websocket until it is done.
         """
         ##logging.info("TermSocket.on_message: %s - (%s) %s", self.term_name, type(message), len(message) if isinstance(message, bytes) else message[:250])
+        if isinstance(message, bytes):
+            # Binary subprotocol frame: opcode byte, then raw terminal bytes.
+            if message[:1] == bytes((BINARY_STDIN,)):
+                self.terminal.write(message[1:])
+                self._log_stdin(message[1:])
+                if self.terminal.input_full():
+                    return self.terminal.wait_input_space()
+            return
+
         command = json.loads(message)
         msg_type = command[0]
 
         if msg_type == "stdin":
-            self.terminal.ptyproc.write(command[1])
-            if command[1] == '\r':
-                self.log_terminal_output(f'STDIN: {self._user_command}')
-                self._user_command = ''
-            else:
-                self._user_command += command[1]
+            self.terminal.write(command[1])
+            self._log_stdin(command[1])
+            if self.terminal.input_full():
+                return self.terminal.wait_input_space()
         elif msg_type == "set_size":
             self.size = command[1:3]
             self.terminal.resize_to_smallest()
+        elif msg_type == "history":
+            self.send_history(*command[1:3])
+
+    def send_history(self, start, end=None):
+        """Send the terminal's output between two byte offsets.
+
+        A negative ``start`` counts back from the newest output. The reply
+        says which range was actually sent, since old output may have been
+        discarded and at most :attr:`max_history_read` bytes go at once,
+        and how much output there has been in total.
+        """
+        scrollback = self.terminal.scrollback
+        if start < 0:
+            start += scrollback.end
+        start = max(start, scrollback.start)
+        if end is None:
+            end = scrollback.end
+        data = scrollback.read(start, min(end, start + self.max_history_read))
+        if self.binary:
+            message = PreparedMessage(
+                bytes((BINARY_HISTORY,))
+                + _HISTORY_HEADER.pack(start, scrollback.end) + data,
+                binary=True)
+        else:
+            message = PreparedMessage(json.dumps([
+                'history',
+                {'start': start, 'end': start + len(data),
+                 'total': scrollback.end},
+                data.decode('utf-8', 'replace')]))
+        self.write_prepared(message)
+
+    def _log_stdin(self, data):
+        """Collect typed input into commands for the audit and terminal logs."""
+        audit_log = self.term_manager.audit_log
+        if audit_log is None and not _LOG_TERMINAL_OUTPUT:
+            return
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        lines = data.split('\r')
+        self._user_command.append(lines[0])
+        for line in lines[1:]:
+            command = ''.join(self._user_command)
+            self._user_command = [line]
+            if audit_log is not None:
+                audit_log.record(self.terminal, 'stdin', command)
+            self.log_terminal_output(f'STDIN: {command}')
 
     def on_close(self):
         """Handle websocket closing.
@@ -116,21 +434,245 @@ class TermSocket(tornado.websocket.WebSocketHandler):
         self._logger.info("Websocket closed")
         if self.terminal:
             self.terminal.clients.remove(self)
+            self.term_manager.resume_reading(self.terminal, self)
+            self.term_manager.update_flow_control(self.terminal)
             self.terminal.resize_to_smallest()
         self.term_manager.client_disconnected(self)
 
     def on_pty_died(self):
         """Terminal closed: tell the frontend, and close the socket.
         """
-        self.send_json_message(['disconnect', 1])
+        try:
+            self.send_json_message(['disconnect', 1])
+        except tornado.websocket.WebSocketClosedError:
+            pass    # Already on its way out, e.g. disconnected as too slow
         self.close()
         self.terminal = None
 
     def log_terminal_output(self, log: str = ''):
         """
-        Logs the terminal input/output if the environment variable LOG_TERMINAL_OUTPUT is "true"
+        Logs the terminal input/output if the environment variable LOG_TERMINAL_OUTPUT
+        was "true" when terminado was imported
         :param log: log line to write
         :return:
         """
-        if str.lower(os.getenv("LOG_TERMINAL_OUTPUT", "false")) == "true":
+        if _LOG_TERMINAL_OUTPUT:
             self._logger.debug(log)
+
+
+class TermEventSocket(tornado.websocket.WebSocketHandler):
+    """Handler for a websocket following a :class:`NamedTermManager`'s terminals.
+
+    The client is sent ``["terminals", [names]]`` on connecting, and after
+    that only changes, as the manager reports them: ``["add", name]``,
+    ``["remove", name]`` and ``["activity", [names]]`` (see
+    :meth:`NamedTermManager.subscribe`).
+    """
+
+    def initialize(self, term_manager):
+        self.term_manager = term_manager
+
+    def open(self):
+        self.write_message(json.dumps(
+            ["terminals", sorted(self.term_manager.terminals)]))
+        self.term_manager.subscribe(self.on_terminal_event)
+
+    def on_terminal_event(self, event, data):
+        try:
+            self.write_message(json.dumps([event, data]))
+        except tornado.websocket.WebSocketClosedError:
+            pass    # on_close will unsubscribe us
+
+    def on_close(self):
+        self.term_manager.unsubscribe(self.on_terminal_event)
+
+
+class _MuxStream(object):
+    """A terminal watched over a :class:`TermMuxSocket`.
+
+    It is one of the terminal's clients, like a :class:`TermSocket`, but
+    never resizes the terminal or holds up its output.
+    """
+
+    size = (None, None)
+    saturated = False
+
+    def __init__(self, socket, name, terminal, thumbnail):
+        self.socket = socket
+        self.name = name
+        self.terminal = terminal
+        self.thumbnail = thumbnail
+        self.screen = None
+        self.sent_version = None
+        self._pending = []
+        self._pending_size = 0
+        self._handle = None
+        self._start()
+
+    @property
+    def binary(self):
+        # Decoded text is only wanted to send output, or to keep a screen
+        # of our own for a terminal that has none.
+        return self.thumbnail and self.screen is None
+
+    def _start(self):
+        if self.thumbnail:
+            if self.terminal.screen is None:
+                rows, cols = self.terminal.ptyproc.getwinsize()
+                self.screen = Screen(rows, cols)
+            self.sent_version = None
+            self._schedule(0)
+        elif self.terminal.screen is not None:
+            self._pending = [self.terminal.screen.snapshot()]
+            self._schedule(0)
+
+    def set_mode(self, thumbnail):
+        if thumbnail == self.thumbnail:
+            return
+        self._cancel()
+        self.thumbnail = thumbnail
+        self.screen = None
+        self._pending = []
+        self._pending_size = 0
+        self._start()
+
+    def on_pty_output(self, output):
+        if self.thumbnail:
+            if self.screen is not None:
+                self.screen.feed(output.text)
+            self._schedule(self.socket.thumbnail_interval)
+            return
+        self._pending.append(output.text)
+        self._pending_size += len(output.data)
+        if self._pending_size > self.socket.max_stream_backlog:
+            # Output is arriving faster than we pass it on: skip to the
+            # current screen, or failing that to the latest output.
+            self.socket.mux_stats['dropped'] += 1
+            if self.terminal.screen is not None:
+                self._pending = [self.terminal.screen.snapshot()]
+            else:
+                self._pending = [output.text]
+            self._pending_size = len(self._pending[0])
+        self._schedule(self.socket.stream_interval)
+
+    def _schedule(self, delay):
+        if self._handle is None:
+            self._handle = IOLoop.current().call_later(delay, self.flush)
+
+    def _cancel(self):
+        if self._handle is not None:
+            IOLoop.current().remove_timeout(self._handle)
+            self._handle = None
+
+    def flush(self):
+        self._handle = None
+        if self.thumbnail:
+            screen = self.screen or self.terminal.screen
+            if self.screen is not None:
+                # Follow the terminal's size, which we don't get told about
+                self.screen.resize(*self.terminal.ptyproc.getwinsize())
+            if screen.version != self.sent_version:
+                self.sent_version = screen.version
+                self.socket.send_mux_message(
+                    ["thumbnail", self.name, screen.display()])
+        elif self._pending:
+            text = ''.join(self._pending)
+            self._pending = []
+            self._pending_size = 0
+            self.socket.send_mux_message(["stdout", self.name, text])
+
+    def close(self):
+        self._cancel()
+        if self in self.terminal.clients:
+            self.terminal.clients.remove(self)
+
+    def on_pty_died(self):
+        # The terminal is iterating over its clients; leave them alone.
+        self._cancel()
+        if not self.thumbnail:
+            # Pass on its last words; the pty is already closed, so a
+            # thumbnail can't be brought up to date.
+            self.flush()
+        self.socket.stream_died(self)
+
+
+class TermMuxSocket(tornado.websocket.WebSocketHandler):
+    """Handler for a websocket watching many of a :class:`NamedTermManager`'s
+    terminals at once.
+
+    The client sends ``["subscribe", name, mode]``, where ``mode`` is
+    ``"full"`` or ``"thumbnail"`` (sending it again switches modes), and
+    ``["unsubscribe", name]``. For full streams it is sent
+    ``["stdout", name, text]``, batched to at most one message per
+    :attr:`stream_interval`; for thumbnails ``["thumbnail", name, lines]``
+    with the text of the terminal's screen, at most once per
+    :attr:`thumbnail_interval` and only when it has changed. ``["disconnect",
+    name]`` means the terminal has gone, or never existed.
+
+    Watching is read only, and never resizes the terminals.
+    """
+
+    #: Seconds between messages of a full stream.
+    stream_interval = 0.05
+    #: Seconds between updates of a thumbnail.
+    thumbnail_interval = 1.0
+    #: Bytes of output a full stream may hold back before skipping ahead.
+    max_stream_backlog = 65536
+
+    def initialize(self, term_manager):
+        self.term_manager = term_manager
+        self.streams = {}
+        # How often full streams have skipped ahead
+        self.mux_stats = Counter()
+
+    def get_compression_options(self):
+        return self.term_manager.websocket_compression_options()
+
+    def get_websocket_protocol(self):
+        protocol = super(TermMuxSocket, self).get_websocket_protocol()
+        if (type(protocol) is tornado.websocket.WebSocketProtocol13
+                and hasattr(protocol, '_create_compressors')):
+            protocol = TermWebSocketProtocol(self, False, protocol.params)
+        return protocol
+
+    def on_message(self, message):
+        command = json.loads(message)
+        msg_type = command[0]
+        if msg_type == "subscribe":
+            self.subscribe(command[1], command[2] == "thumbnail")
+        elif msg_type == "unsubscribe":
+            self.unsubscribe(command[1])
+
+    def subscribe(self, name, thumbnail=False):
+        stream = self.streams.get(name)
+        if stream is not None:
+            stream.set_mode(thumbnail)
+            return
+        terminal = self.term_manager.terminals.get(name)
+        if terminal is None:
+            self.send_mux_message(["disconnect", name])
+            return
+        stream = _MuxStream(self, name, terminal, thumbnail)
+        self.streams[name] = stream
+        terminal.clients.append(stream)
+        self.term_manager.update_flow_control(terminal)
+
+    def unsubscribe(self, name):
+        stream = self.streams.pop(name, None)
+        if stream is not None:
+            stream.close()
+            self.term_manager.update_flow_control(stream.terminal)
+
+    def stream_died(self, stream):
+        self.streams.pop(stream.name, None)
+        self.send_mux_message(["disconnect", stream.name])
+
+    def send_mux_message(self, content):
+        try:
+            self.write_message(json.dumps(content))
+        except tornado.websocket.WebSocketClosedError:
+            pass    # on_close will drop our streams
+
+    def on_close(self):
+        for name in list(self.streams):
+            self.unsubscribe(name)